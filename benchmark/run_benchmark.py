@@ -0,0 +1,247 @@
+#!/usr/bin/python
+#
+#############################################################################################
+# Scriptname          : run_benchmark.py
+# Description         : Measures how satellite6-automation.py scales. Every scenario runs a
+#                       copy of the script against the stub commands in stub_command.py and
+#                       reports wall time, spawned subprocesses, bytes read from them and
+#                       the peak RSS of the script. Results can be stored as baseline and
+#                       later runs are compared against it.
+#############################################################################################
+#
+# Examples:
+#
+#  ./benchmark/run_benchmark.py
+#  ./benchmark/run_benchmark.py --sizes 1000 --scenarios single,batch-workers
+#  ./benchmark/run_benchmark.py --save-baseline benchmark/baseline.json
+#  ./benchmark/run_benchmark.py --baseline benchmark/baseline.json
+#
+#############################################################################################
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIR = os.path.dirname(BENCHMARK_DIR)
+SCRIPT = os.path.join(REPOSITORY_DIR, "satellite6-automation.py")
+PARTITIONING_HEADER = os.path.join(REPOSITORY_DIR, "KN_RHEL_default_partitioning_header")
+STUB = os.path.join(BENCHMARK_DIR, "stub_command.py")
+
+SCENARIOS = ["single", "single-warm", "batch", "batch-workers", "batch-shell"]
+STUB_COMMANDS = {
+	"HAMMER_CMD":		"hammer",
+	"IPA_CMD":		"ipa",
+	"KINIT_CMD":		"kinit",
+	"KLIST_CMD":		"klist",
+	"KDESTROY_CMD":		"kdestroy",
+	"IPA_GETKEYTAB_CMD":	"ipa-getkeytab",
+}
+
+# Values for the "# Change this variable" settings of the script copy
+SITE_CONFIG = [
+	("ORGANIZATION", "ACME"),
+	("REALM", "EXAMPLE.COM"),
+	("MEDIUM", "RHEL mirror"),
+	("OS", "RHEL 7.2"),
+	("DEFAULT_CONTENT_VIEW", "ccv_rhel"),
+	("PRINCIPAL", "svc-ipa-automation"),
+	("KDC", "ipa.example.com"),
+	("DNS_PRIMARY", "10.0.0.53"),
+	('"dev"', "ak-dev"),
+	('"test"', "ak-test"),
+	('"preprod"', "ak-preprod"),
+	('"prod"', "ak-prod"),
+	("INTRANET_PUPPET_PROXY", "capsule.example.com"),
+	("INTRANET_PUPPET_CA_PROXY", "capsule.example.com"),
+	("DMZ_PUPPET_PROXY", "capsule-dmz.example.com"),
+	("DMZ_PUPPET_CA_PROXY", "capsule-dmz.example.com"),
+]
+
+HOST_OPTIONS = ["--trange", "tr01", "--location", "Hamburg", "--application", "--intranet", "--primary-nic-network", "10.1.1.0", "--primary-nic-mask", "255.255.255.0", "--primary-nic-gateway", "10.1.1.1", "--partitioning", "/:10;/var:8;/data:20"]
+
+# Runs the script in a child interpreter and records its own peak RSS on exit, so the
+# stub processes it starts do not count. The script is loaded as a module and kept in
+# sys.modules (runpy would clear its globals before its atexit handlers run).
+MEASURE = """
+import atexit, imp, json, resource, sys
+report_file = sys.argv[1]
+def report():
+	with open(report_file, "w") as report:
+		json.dump({"peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}, report)
+atexit.register(report)
+sys.argv = sys.argv[2:]
+imp.load_source("satellite6_automation", sys.argv[0]).main()
+"""
+
+class Workspace(object):
+	# Temporary home directory, ISO store, stub commands and patched copy of the script
+	def __init__(self, python, size, latency):
+		self.directory = tempfile.mkdtemp(prefix="satellite6-benchmark-")
+		self.home = os.path.join(self.directory, "home")
+		self.state = os.path.join(self.directory, "state")
+		self.iso_store = os.path.join(self.directory, "iso") + "/"
+		self.script = os.path.join(self.directory, "satellite6-automation.py")
+		for directory in (os.path.join(self.home, "tmp"), os.path.join(self.home, "satellite6_automation"), self.state, self.iso_store, os.path.join(self.directory, "bin")):
+			os.makedirs(directory)
+		shutil.copy(PARTITIONING_HEADER, os.path.join(self.home, "satellite6_automation"))
+
+		self.environment = dict(os.environ)
+		self.environment.update({"BENCH_STATE_DIR": self.state, "BENCH_LATENCY": latency, "BENCH_HOSTS": str(size), "BENCH_SUBNETS": str(size)})
+		for variable, command in STUB_COMMANDS.items():
+			path = os.path.join(self.directory, "bin", command)
+			with open(path, "w") as wrapper:
+				wrapper.write("#!/bin/sh\nexec " + python + " " + STUB + " " + command + ' "$@"\n')
+			os.chmod(path, 0755)
+			self.environment[variable] = path
+
+		source = open(SCRIPT).read().replace("/home/svc-satellite-automation", self.home)
+		for name, value in SITE_CONFIG + [("NFS_HOST_ISO_STORE", self.iso_store)]:
+			source, count = re.subn(r'(?m)^(\s*' + re.escape(name) + r'\s*[=:]\s*)""', lambda match: match.group(1) + json.dumps(value), source, 1)
+			if count != 1:
+				raise Exception("could not set " + name + " in the copy of " + SCRIPT)
+		with open(self.script, "w") as script:
+			script.write(source)
+
+	def write_manifest(self, hosts, offset=0):
+		manifest = os.path.join(self.directory, "hosts-" + str(offset) + ".csv")
+		with open(manifest, "w") as manifest_file:
+			manifest_file.write("client-fqdn,primary-nic-ip,primary-nic-mac,application-id,environment\n")
+			for number in range(offset, offset + hosts):
+				manifest_file.write("web%04d.example.com,10.1.%d.%d,aa:bb:cc:00:%02x:%02x,app%02d,%s\n" % (number, number / 250 + 1, number % 250 + 2, number / 256, number % 256, number % 5, ("dev", "test", "preprod", "prod")[number % 4]))
+		return manifest
+
+	def remove(self):
+		shutil.rmtree(self.directory, ignore_errors=True)
+
+def run_script(python, workspace, arguments):
+	report_file = os.path.join(workspace.directory, "report.json")
+	call_log = os.path.join(workspace.state, "calls.log")
+	for old_file in (report_file, call_log):
+		if os.path.exists(old_file):
+			os.remove(old_file)
+	with open(os.path.join(workspace.directory, "output.log"), "a") as output:
+		start = time.time()
+		exit_code = subprocess.call([python, "-c", MEASURE, report_file, workspace.script] + arguments, stdout=output, stderr=subprocess.STDOUT, env=workspace.environment, cwd=workspace.directory)
+		wall_seconds = time.time() - start
+
+	calls = []
+	if os.path.exists(call_log):
+		calls = [json.loads(line) for line in open(call_log)]
+	try:
+		peak_rss_kb = json.load(open(report_file))["peak_rss_kb"]
+	except (IOError, ValueError):
+		peak_rss_kb = None
+	return {
+		"exit_code": exit_code,
+		"wall_seconds": round(wall_seconds, 3),
+		"subprocesses": len([call for call in calls if call["spawned"]]),
+		"commands": len(calls),
+		"bytes_read": sum([call["bytes"] for call in calls]),
+		"peak_rss_kb": peak_rss_kb,
+	}
+
+def run_scenario(options, scenario, size):
+	workspace = Workspace(options.python, size, options.latency)
+	single_host = ["--client-fqdn", "web0001.example.com", "--create-host", "--application-id", "app01", "--environment", "dev", "--primary-nic-ip", "10.1.1.5", "--primary-nic-mac", "aa:bb:cc:dd:ee:01"] + HOST_OPTIONS
+	try:
+		if scenario == "single":
+			return run_script(options.python, workspace, single_host)
+		if scenario == "single-warm":
+			# second run of the same setup: cache, Kerberos ticket and prerequisites exist
+			run_script(options.python, workspace, single_host)
+			second_host = {"web0001.example.com": "web0002.example.com", "10.1.1.5": "10.1.1.6", "aa:bb:cc:dd:ee:01": "aa:bb:cc:dd:ee:02"}
+			return run_script(options.python, workspace, [second_host.get(argument, argument) for argument in single_host])
+		manifest = workspace.write_manifest(options.batch_hosts)
+		arguments = ["--manifest", manifest, "--create-host"] + HOST_OPTIONS
+		if scenario == "batch":
+			return run_script(options.python, workspace, arguments)
+		if scenario == "batch-workers":
+			return run_script(options.python, workspace, arguments + ["--workers", str(options.workers)])
+		if scenario == "batch-shell":
+			return run_script(options.python, workspace, arguments + ["--workers", str(options.workers), "--hammer-shell"])
+		raise Exception("unknown scenario " + scenario)
+	finally:
+		if options.keep:
+			print "workspace of " + scenario + "/" + str(size) + ": " + workspace.directory
+		else:
+			workspace.remove()
+
+def compare(results, baseline, tolerance):
+	# A metric regresses if it grows by more than tolerance (wall time and RSS also get a
+	# small absolute slack because they are noisy). Subprocess counts may differ by one list
+	# fetch depending on the order in which parallel steps finish.
+	regressions = []
+	for key, result in sorted(results.items()):
+		base = baseline.get("results", {}).get(key)
+		if not base:
+			continue
+		limits = {
+			"wall_seconds":	base["wall_seconds"] * (1 + tolerance) + 0.5,
+			"peak_rss_kb":	(base["peak_rss_kb"] or 0) * (1 + tolerance) + 2048,
+			"subprocesses":	base["subprocesses"] + 1,
+			"bytes_read":	base["bytes_read"] * (1 + tolerance),
+		}
+		for metric, limit in sorted(limits.items()):
+			if result.get(metric) is not None and result[metric] > limit:
+				regressions.append("%s: %s %s > baseline %s" % (key, metric, result[metric], base[metric]))
+	return regressions
+
+parser = OptionParser(usage="%prog [options]")
+parser.add_option("--python", dest="python", default=sys.executable, help="Python 2 interpreter for the script and the stubs (default: %default)")
+parser.add_option("--sizes", dest="sizes", default="1000,10000,50000", help="Comma separated numbers of hosts and subnets already on the fake Satellite (default: %default)")
+parser.add_option("--scenarios", dest="scenarios", default=",".join(SCENARIOS), help="Comma separated scenarios out of " + ", ".join(SCENARIOS) + " (default: all)")
+parser.add_option("--batch-hosts", dest="batch_hosts", type="int", default=20, help="Hosts in the manifest of the batch scenarios (default: %default)")
+parser.add_option("--workers", dest="workers", type="int", default=8, help="--workers for batch-workers and batch-shell (default: %default)")
+parser.add_option("--latency", dest="latency", default="hammer=0.05,hammer bootdisk=0.2,ipa=0.05,kinit=0.02,ipa-getkeytab=0.02", help="Latency per stub command in seconds (default: %default)")
+parser.add_option("--baseline", dest="baseline", help="Compare the results with this baseline and exit 1 on regressions")
+parser.add_option("--tolerance", dest="tolerance", type="float", default=0.25, help="Allowed relative growth of wall time, peak RSS and bytes read (default: %default)")
+parser.add_option("--save-baseline", dest="save_baseline", help="Write the results as new baseline to this file")
+parser.add_option("--output", dest="output", help="Write the results as JSON to this file")
+parser.add_option("--keep", dest="keep", action="store_true", help="Keep the temporary workspaces (script output is in output.log)")
+(options, args) = parser.parse_args()
+
+for scenario in options.scenarios.split(","):
+	if scenario not in SCENARIOS:
+		parser.error("unknown scenario " + scenario)
+
+results = {}
+print "%-28s %9s %6s %8s %11s %10s %5s" % ("scenario/size", "wall[s]", "procs", "commands", "bytes read", "RSS[kB]", "exit")
+for size in [int(size) for size in options.sizes.split(",")]:
+	for scenario in options.scenarios.split(","):
+		key = scenario + "/" + str(size)
+		results[key] = run_scenario(options, scenario, size)
+		result = results[key]
+		print "%-28s %9.2f %6d %8d %11d %10s %5d" % (key, result["wall_seconds"], result["subprocesses"], result["commands"], result["bytes_read"], result["peak_rss_kb"], result["exit_code"])
+		sys.stdout.flush()
+
+report = {"parameters": {"batch_hosts": options.batch_hosts, "workers": options.workers, "latency": options.latency}, "results": results}
+if options.output:
+	with open(options.output, "w") as output:
+		json.dump(report, output, indent=2, sort_keys=True)
+if options.save_baseline:
+	with open(options.save_baseline, "w") as baseline_file:
+		json.dump(report, baseline_file, indent=2, sort_keys=True)
+
+failed = [key for key, result in sorted(results.items()) if result["exit_code"] != 0]
+for key in failed:
+	print "FAILED: " + key + " exited with " + str(results[key]["exit_code"]) + " (rerun with --keep to see its output)"
+
+regressions = []
+if options.baseline:
+	baseline = json.load(open(options.baseline))
+	if baseline.get("parameters") != report["parameters"]:
+		print "WARNING: baseline was recorded with different parameters " + json.dumps(baseline.get("parameters"))
+	regressions = compare(results, baseline, options.tolerance)
+	for regression in regressions:
+		print "REGRESSION: " + regression
+	if not regressions:
+		print "No regressions against " + options.baseline
+
+if failed or regressions:
+	sys.exit(1)
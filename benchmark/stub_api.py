@@ -0,0 +1,267 @@
+#!/usr/bin/python
+#
+#############################################################################################
+# Scriptname          : stub_api.py
+# Description         : Fake Satellite REST API and IPA JSON-RPC API for the tests of the
+#                       API clients ("--api", "--ipa-api"). Runs in a thread of the test
+#                       or standalone, e.g. "stub_api.py 8080" and "hammer/cli_config.yml"
+#                       with :host: 'http://127.0.0.1:8080'.
+#############################################################################################
+#
+# Satellite: every /api/<resource> and /katello/api/<resource> path is a collection.
+#   GET <collection>?search=...&page=..&per_page=..   list (searches: field = "value", joined
+#                                                     with " or "; other searches match all)
+#   GET/PUT/DELETE <collection>/<id or name>          one entry
+#   POST <collection> {"<entry>": {...}}              create, a taken name answers 422
+# Requests need Basic authentication with USERNAME/PASSWORD.
+#
+# IPA:
+#   POST /ipa/session/login_password      user=USERNAME&password=PASSWORD, sets the ipa_session cookie
+#   POST /ipa/session/json                JSON-RPC with the cookie: hostgroup_find/_add/_show,
+#                                         automember_add/_show/_add_condition, host_find/_add
+#                                         and batch. Without a valid session it answers 401.
+# expire_sessions() invalidates all IPA sessions, like an IPA server after the session timeout.
+#
+# drop_connections() closes all kept-alive connections without telling the client, like
+# a Satellite (or load balancer) that dropped idle connections.
+#
+# delay makes every request wait that many seconds before it is processed, like a Satellite
+# slower than the client timeout.
+#
+#############################################################################################
+import re
+import sys
+import json
+import time
+import base64
+import socket
+import urllib
+import urlparse
+import threading
+import itertools
+import BaseHTTPServer
+import SocketServer
+
+USERNAME = "admin"
+PASSWORD = "secret"
+
+def matches(entry, search):
+	if not search:
+		return True
+	conditions = [re.match(r'^\s*\(?\s*(\w+)\s*=\s*"?([^"]*?)"?\s*\)?\s*$', condition) for condition in search.split(" or ")]
+	if None in conditions:
+		return True
+	for condition in conditions:
+		if str(entry.get(condition.group(1))) == condition.group(2):
+			return True
+	return False
+
+class IPARequestError(Exception):
+	def __init__(self, code, name, message):
+		Exception.__init__(self, message)
+		self.code = code
+		self.name = name
+
+def ipa_command(ipa, method, arguments, options):
+	# Returns the result of one IPA command on the entries in ipa, raises IPARequestError
+	name = arguments and arguments[0] or options.get("cn") or options.get("fqdn")
+	if method in ("hostgroup_find", "host_find"):
+		entries = ipa[method.split("_")[0]]
+		found = [dict(entries[key], cn=[key]) for key in sorted(entries) if not name or key == name]
+		return {"result": found, "count": len(found), "truncated": False, "summary": str(len(found)) + " matched"}
+	if method in ("hostgroup_add", "host_add", "automember_add"):
+		entries = ipa[method.split("_")[0]]
+		if name in entries:
+			raise IPARequestError(4002, "DuplicateEntry", method.split("_")[0] + ' with name "' + name + '" already exists')
+		entries[name] = {}
+		return {"result": {"cn": [name]}, "value": name, "summary": 'Added "' + name + '"'}
+	if method in ("hostgroup_show", "automember_show"):
+		entries = ipa[method.split("_")[0]]
+		if name not in entries:
+			raise IPARequestError(4001, "NotFound", name + ": " + method.split("_")[0] + " not found")
+		return {"result": dict(entries[name], cn=[name]), "value": name}
+	if method == "automember_add_condition":
+		if name not in ipa["automember"]:
+			raise IPARequestError(4001, "NotFound", name + ": automember rule not found")
+		conditions = ipa["automember"][name].setdefault("automemberinclusiveregex", [])
+		added = [condition for condition in options.get("automemberinclusiveregex", []) if condition not in conditions]
+		conditions.extend(added)
+		return {"result": {"cn": [name]}, "completed": len(added), "failed": {}}
+	raise IPARequestError(4999, "CommandError", "unknown command '" + method + "'")
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def log_message(self, *arguments):
+		pass
+
+	def setup(self):
+		BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+		with self.server.lock:
+			self.server.connections.add(self.connection)
+			self.server.connection_count = self.server.connection_count + 1
+
+	def finish(self):
+		with self.server.lock:
+			self.server.connections.discard(self.connection)
+		try:
+			BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+		except socket.error:
+			pass
+
+	def reply(self, status, body, headers=None):
+		data = json.dumps(body)
+		self.send_response(status)
+		for name, value in (headers or {}).items():
+			self.send_header(name, value)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def read_body(self):
+		length = int(self.headers.getheader("content-length") or 0)
+		return self.rfile.read(length)
+
+	def handle_request(self, method):
+		url = urlparse.urlparse(self.path)
+		body = self.read_body()
+		with self.server.lock:
+			self.server.requests.append((method, url.path))
+		time.sleep(self.server.delay)
+		if url.path.startswith("/ipa/"):
+			return self.handle_ipa_request(url.path, body)
+		if self.headers.getheader("authorization") != "Basic " + base64.b64encode(USERNAME + ":" + PASSWORD):
+			return self.reply(401, {"error": {"message": "Unable to authenticate user " + USERNAME}})
+		match = re.match(r"^(/(?:katello/)?api/\w+)(?:/([^/]+))?$", url.path)
+		if not match:
+			return self.reply(404, {"error": {"message": "Route not found"}})
+		collection, key = match.group(1), match.group(2) and urllib.unquote(match.group(2))
+		with self.server.lock:
+			entries = self.server.data.setdefault(collection, [])
+			if key is None and method == "GET":
+				query = dict(urlparse.parse_qsl(url.query))
+				found = [entry for entry in entries if matches(entry, query.get("search"))]
+				per_page, page = int(query.get("per_page", 20)), int(query.get("page", 1))
+				return self.reply(200, {"total": len(entries), "subtotal": len(found), "page": page, "per_page": per_page, "results": found[(page - 1) * per_page:page * per_page]})
+			if key is None and method == "POST":
+				attributes = json.loads(body).values()[0]
+				if [entry for entry in entries if entry.get("name") == attributes.get("name")]:
+					return self.reply(422, {"error": {"id": None, "errors": {"name": ["has already been taken"]}, "full_messages": ["Name has already been taken"]}})
+				self.server.next_id = self.server.next_id + 1
+				entry = dict(attributes, id=self.server.next_id)
+				entries.append(entry)
+				return self.reply(201, entry)
+			found = [entry for entry in entries if key in (str(entry.get("id")), entry.get("name"))]
+			if not found:
+				return self.reply(404, {"error": {"message": "Resource not found"}})
+			if method == "PUT":
+				found[0].update(json.loads(body).values()[0])
+			elif method == "DELETE":
+				entries.remove(found[0])
+			return self.reply(200, found[0])
+
+	def handle_ipa_request(self, path, body):
+		if not self.headers.getheader("referer", "").startswith(self.server.url() + "/ipa"):
+			return self.reply(400, {"error": "missing or invalid Referer"})
+		if path == "/ipa/session/login_password":
+			form = dict(urlparse.parse_qsl(body))
+			if (form.get("user"), form.get("password")) != (USERNAME, PASSWORD):
+				return self.reply(401, {"error": "invalid password"})
+			with self.server.lock:
+				self.server.ipa_logins = self.server.ipa_logins + 1
+				session = "MagBearerToken=" + str(next(self.server.session_numbers))
+				self.server.ipa_sessions.add(session)
+			return self.reply(200, "", {"Set-Cookie": "ipa_session=" + session + "; Path=/ipa; Secure; HttpOnly"})
+		if path != "/ipa/session/json":
+			return self.reply(404, {"error": "not found"})
+		cookie = self.headers.getheader("cookie", "")
+		with self.server.lock:
+			if not cookie.startswith("ipa_session=") or cookie[len("ipa_session="):] not in self.server.ipa_sessions:
+				return self.reply(401, {"error": "session expired"})
+			request = json.loads(body)
+			arguments, options = request["params"]
+			self.server.ipa_calls.append(request["method"])
+			if request["method"] == "batch":
+				results = []
+				for command in arguments:
+					try:
+						results.append(dict(ipa_command(self.server.ipa, command["method"], command["params"][0], command["params"][1]), error=None))
+					except IPARequestError as e:
+						results.append({"error": str(e), "error_code": e.code, "error_name": e.name})
+				return self.reply(200, {"result": {"count": len(results), "results": results}, "error": None, "id": request.get("id")})
+			try:
+				result = ipa_command(self.server.ipa, request["method"], arguments, options)
+			except IPARequestError as e:
+				return self.reply(200, {"result": None, "error": {"code": e.code, "name": e.name, "message": str(e)}, "id": request.get("id")})
+			return self.reply(200, {"result": result, "error": None, "id": request.get("id")})
+
+	def do_GET(self):
+		self.handle_request("GET")
+
+	def do_POST(self):
+		self.handle_request("POST")
+
+	def do_PUT(self):
+		self.handle_request("PUT")
+
+	def do_DELETE(self):
+		self.handle_request("DELETE")
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, port=0):
+		BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port), StubHandler)
+		self.lock = threading.Lock()
+		self.data = {}
+		self.next_id = 1000
+		self.requests = []
+		self.connections = set()
+		self.connection_count = 0
+		self.delay = 0
+		self.ipa = {"hostgroup": {}, "host": {}, "automember": {}}
+		self.ipa_sessions = set()
+		self.ipa_logins = 0
+		self.ipa_calls = []
+		self.session_numbers = itertools.count(1)
+
+	def url(self):
+		return "http://127.0.0.1:" + str(self.server_address[1])
+
+	def start(self):
+		thread = threading.Thread(target=self.serve_forever)
+		thread.daemon = True
+		thread.start()
+		return self
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+
+	def handle_error(self, request, client_address):
+		# a client that gave up waiting (see delay) is not an error of the stub
+		if not isinstance(sys.exc_info()[1], socket.error):
+			BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+	def expire_sessions(self):
+		with self.lock:
+			self.ipa_sessions.clear()
+
+	def drop_connections(self):
+		with self.lock:
+			for connection in self.connections:
+				try:
+					connection.shutdown(socket.SHUT_RDWR)
+				except socket.error:
+					pass
+
+if __name__ == "__main__":
+	server = StubServer(len(sys.argv) > 1 and int(sys.argv[1]) or 0)
+	print "listening on " + server.url()
+	sys.stdout.flush()
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
@@ -0,0 +1,241 @@
+#!/usr/bin/python
+#
+#############################################################################################
+# Scriptname          : stub_command.py
+# Description         : Fake hammer, ipa, kinit, klist, kdestroy and ipa-getkeytab for the
+#                       benchmark. The command to emulate is the first argument, e.g.
+#                       "stub_command.py hammer --csv host list".
+#############################################################################################
+#
+# Environment:
+#
+#  BENCH_STATE_DIR   directory for the fake Satellite/IPA state and the call log (required)
+#  BENCH_LATENCY     per command latency in seconds, e.g. "hammer=0.05,ipa=0.05,hammer bootdisk=0.5"
+#                    (the most specific key wins: "hammer host create", "hammer host", "hammer")
+#  BENCH_HOSTS       number of hosts already present on the fake Satellite (default 1000)
+#  BENCH_SUBNETS     number of subnets already present on the fake Satellite (default 1000)
+#
+# Every call appends one JSON line {"command", "arguments", "bytes", "spawned"} to
+# $BENCH_STATE_DIR/calls.log. "bytes" is the size of the output written to stdout and
+# "spawned" is false for commands sent to an already running "hammer shell".
+#
+#############################################################################################
+import os
+import sys
+import csv
+import json
+import time
+import fcntl
+import shlex
+import cStringIO
+from datetime import datetime, timedelta
+
+STATE_DIR = os.environ["BENCH_STATE_DIR"]
+STATE_FILE = os.path.join(STATE_DIR, "state.json")
+CALL_LOG = os.path.join(STATE_DIR, "calls.log")
+TICKET_FILE = os.path.join(STATE_DIR, "ticket")
+
+ORGANIZATION = "ACME"
+LOCATIONS = ["Hamburg", "Berlin"]
+OS = "RHEL 7.2"
+PUPPET_ENVIRONMENTS = ["KT_ACME_%s_ccv_rhel" % environment for environment in ("dev", "test", "preprod", "prod")]
+
+def get_latency(command, arguments):
+	latencies = {}
+	for entry in os.environ.get("BENCH_LATENCY", "").split(","):
+		if "=" in entry:
+			key, value = entry.split("=", 1)
+			latencies[" ".join(key.split())] = float(value)
+	words = [command] + [argument for argument in arguments if not argument.startswith("-")][:2]
+	for length in range(len(words), 0, -1):
+		key = " ".join(words[:length])
+		if key in latencies:
+			return latencies[key]
+	return 0.0
+
+class State(object):
+	# Objects created during a benchmark run, shared by all stub processes
+	def __enter__(self):
+		self.lock_file = open(STATE_FILE + ".lock", "a")
+		fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+		try:
+			with open(STATE_FILE) as state_file:
+				self.data = json.load(state_file)
+		except (IOError, ValueError):
+			self.data = {}
+		return self
+
+	def get(self, resource):
+		return self.data.setdefault(resource, [])
+
+	def save(self):
+		with open(STATE_FILE + ".tmp", "w") as state_file:
+			json.dump(self.data, state_file)
+		os.rename(STATE_FILE + ".tmp", STATE_FILE)
+
+	def __exit__(self, *exc_info):
+		fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+		self.lock_file.close()
+
+def get_option(arguments, name, default=None):
+	if name in arguments and arguments.index(name) + 1 < len(arguments):
+		return arguments[arguments.index(name) + 1]
+	return default
+
+def generated_subnet(number):
+	return "10.%d.%d.0" % (100 + number / 256, number % 256)
+
+def hammer_list(resource, arguments, state):
+	# Returns (header, rows) of "hammer --csv <resource> list"
+	hosts = int(os.environ.get("BENCH_HOSTS", "1000"))
+	subnets = int(os.environ.get("BENCH_SUBNETS", "1000"))
+	created = state.get(resource)
+	if resource == "organization":
+		return ["Id", "Name", "Label", "Description"], [["1", ORGANIZATION, ORGANIZATION, ""]]
+	if resource == "location":
+		return ["Id", "Name"], [[str(index + 1), location] for index, location in enumerate(LOCATIONS)]
+	if resource == "lifecycle-environment":
+		return ["ID", "NAME", "PRIOR"], [["1", "Library", ""], ["2", "dev", "Library"], ["3", "test", "dev"], ["4", "preprod", "test"], ["5", "prod", "preprod"]]
+	if resource == "environment":
+		return ["Id", "Name"], [[str(index + 1), name] for index, name in enumerate(PUPPET_ENVIRONMENTS)]
+	if resource == "os":
+		return ["Id", "Title", "Release name", "Family"], [["1", OS, "", "Redhat"]]
+	if resource == "hostgroup":
+		return ["Id", "Name", "Title", "Operating System", "Environment", "Model"], [["1", "hg-application", "hg-application", "", "", ""], ["2", "hg-infrastructure", "hg-infrastructure", "", "", ""]] + created
+	if resource == "partition-table":
+		return ["Id", "Name", "OS Family"], [["1", "Kickstart default", "Redhat"]] + created
+	if resource == "subnet":
+		return ["Id", "Name", "Network", "Mask"], [[str(number + 1000), generated_subnet(number), generated_subnet(number), "255.255.255.0"] for number in xrange(subnets)] + created
+	if resource == "host":
+		return ["Id", "Name", "Operating System", "Host Group", "IP", "MAC"], [[str(number + 1000), "bench%05d.example.com" % number, OS, "", "10.200.%d.%d" % (number / 250, number % 250 + 1), "aa:bb:dd:%02x:%02x:%02x" % (number / 65536, number / 256 % 256, number % 256)] for number in xrange(hosts)] + created
+	return ["Id", "Name"], created
+
+def hammer_search(header, rows, search):
+	# Only the searches the script uses: <column> = "value", e.g. name = "web0001.example.com"
+	if not search:
+		return rows
+	field, value = search.split("=", 1)
+	column = [name.lower() for name in header].index(field.strip().lower())
+	value = value.strip().strip("\"'")
+	return [row for row in rows if row[column] == value]
+
+def hammer(arguments):
+	# Returns (exit code, output)
+	arguments = [argument for argument in arguments if argument != "--csv"]
+	if len(arguments) < 2:
+		return 64, "Error: unknown command\n"
+	resource, action = arguments[0], arguments[1]
+	with State() as state:
+		if action == "list":
+			header, rows = hammer_list(resource, arguments, state)
+			search = get_option(arguments, "--search")
+			if search and search.startswith("updated_at"):	# changed since the last sync: created by this benchmark
+				rows = state.get(resource)
+			else:
+				rows = hammer_search(header, rows, search)
+			output = cStringIO.StringIO()
+			writer = csv.writer(output, lineterminator="\n")
+			writer.writerow(header)
+			writer.writerows(rows)
+			return 0, output.getvalue()
+		if action == "create":
+			created = state.get(resource)
+			object_id = str(100000 + len(created))
+			name = get_option(arguments, "--name", "")
+			if resource == "subnet":
+				created.append([object_id, name, get_option(arguments, "--network", name), get_option(arguments, "--mask", "")])
+			elif resource == "host":
+				created.append([object_id, name + "." + get_option(arguments, "--domain", "example.com"), OS, get_option(arguments, "--hostgroup", ""), get_option(arguments, "--ip", ""), get_option(arguments, "--mac", "")])
+			elif resource == "hostgroup":
+				created.append([object_id, name, name, "", "", ""])
+			elif resource == "partition-table":
+				created.append([object_id, name, "Redhat"])
+			else:
+				created.append([object_id, name])
+			state.save()
+			return 0, resource.capitalize() + " created\n"
+	if resource == "bootdisk":
+		with open(get_option(arguments, "--file"), "wb") as iso_file:
+			iso_file.write("\0" * 4096)
+		return 0, "Successfully downloaded host disk image to " + get_option(arguments, "--file") + "\n"
+	return 0, "Done\n"
+
+def ipa(arguments):
+	if not arguments:
+		return 1, ""
+	with State() as state:
+		hostgroups = state.get("ipa-hostgroup")
+		name = arguments[-1]
+		if arguments[0] == "hostgroup-find":
+			if name in hostgroups:
+				return 0, "1 hostgroup matched\n  Host-group: " + name + "\n"
+			return 1, "0 hostgroups matched\n"
+		if arguments[0] == "hostgroup-show":
+			if name in hostgroups:
+				return 0, "  Host-group: " + name + "\n  Member hosts: \n"
+			return 2, "ipa: ERROR: " + name + ": host group not found\n"
+		if arguments[0] == "hostgroup-add":
+			hostgroups.append(name)
+			state.save()
+			return 0, "Added hostgroup \"" + name + "\"\n"
+	return 0, "Done\n"
+
+def kerberos(command, arguments):
+	if command == "kinit":
+		with open(TICKET_FILE, "w") as ticket:
+			ticket.write((datetime.now() + timedelta(hours=10)).strftime("%m/%d/%y %H:%M:%S"))
+		return 0, ""
+	if command == "kdestroy":
+		if os.path.exists(TICKET_FILE):
+			os.remove(TICKET_FILE)
+		return 0, ""
+	if command == "ipa-getkeytab":
+		with open(get_option(arguments, "-k"), "w") as keytab:
+			keytab.write("keytab")
+		return 0, "Keytab successfully retrieved and stored in: " + get_option(arguments, "-k") + "\n"
+	if command == "klist":
+		if not os.path.exists(TICKET_FILE):
+			return 1, ""
+		expires = open(TICKET_FILE).read().strip()
+		return 0, "Ticket cache: " + os.environ.get("KRB5CCNAME", "") + "\nDefault principal: svc@EXAMPLE.COM\n\nValid starting       Expires              Service principal\n01/01/16 00:00:00  " + expires + "  krbtgt/EXAMPLE.COM@EXAMPLE.COM\n"
+	return 0, ""
+
+def run(command, arguments, spawned):
+	time.sleep(get_latency(command, arguments))
+	if command == "hammer":
+		exit_code, output = hammer(arguments)
+	elif command == "ipa":
+		exit_code, output = ipa(arguments)
+	else:
+		exit_code, output = kerberos(command, arguments)
+	sys.stdout.write(output)
+	sys.stdout.flush()
+	with open(CALL_LOG, "a") as call_log:
+		call_log.write(json.dumps({"command": command, "arguments": arguments, "bytes": len(output), "spawned": spawned}) + "\n")
+	return exit_code
+
+def hammer_shell():
+	# Emulates "hammer shell": commands are read from stdin, unknown sub-commands answer
+	# with hammer's error message (the script uses this as frame marker).
+	with open(CALL_LOG, "a") as call_log:
+		call_log.write(json.dumps({"command": "hammer", "arguments": ["shell"], "bytes": 0, "spawned": True}) + "\n")
+	while True:
+		line = sys.stdin.readline()
+		if not line:
+			return 0
+		arguments = shlex.split(line)
+		if not arguments:
+			continue
+		if arguments[0] == "exit":
+			return 0
+		if arguments[0].startswith("__"):
+			sys.stdout.write("Error: No such sub-command '" + arguments[0] + "'.\n\nSee: 'hammer --help'.\n")
+			sys.stdout.flush()
+			continue
+		run("hammer", arguments, False)
+
+if __name__ == "__main__":
+	command = os.path.basename(sys.argv[1])
+	if command == "hammer" and sys.argv[2:] == ["shell"]:
+		sys.exit(hammer_shell())
+	sys.exit(run(command, sys.argv[2:], True))
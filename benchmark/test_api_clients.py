@@ -0,0 +1,140 @@
+#!/usr/bin/python
+#
+#############################################################################################
+# Scriptname          : test_api_clients.py
+# Description         : Tests of the Satellite REST client ("--api") and the IPA JSON-RPC
+#                       client ("--ipa-api") against the stub server in stub_api.py, e.g.
+#                       "./benchmark/test_api_clients.py -v".
+#############################################################################################
+import os
+import imp
+import socket
+import unittest
+
+import stub_api
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(os.path.dirname(BENCHMARK_DIR), "satellite6-automation.py")
+satellite6_automation = imp.load_source("satellite6_automation", SCRIPT)
+
+class SatelliteAPITest(unittest.TestCase):
+	def setUp(self):
+		self.server = stub_api.StubServer().start()
+		self.api = satellite6_automation.SatelliteAPI(self.server.url(), stub_api.USERNAME, stub_api.PASSWORD)
+
+	def tearDown(self):
+		self.api.close()
+		self.server.stop()
+
+	def test_create_and_search(self):
+		created = self.api.create_host({"name": "web01.example.com", "ip": "10.1.1.5"})
+		self.api.create_host({"name": "web02.example.com", "ip": "10.1.1.6"})
+		self.assertEqual(self.api.hosts(search='name = "web01.example.com"'), [created])
+		self.assertEqual(self.api.get_host("web02.example.com")["ip"], "10.1.1.6")
+		self.assertEqual(self.api.get_host("web03.example.com"), None)
+		self.assertEqual(self.api.resolve_id("/api/hosts", "web02.example.com"), created["id"] + 1)
+
+	def test_create_error(self):
+		self.api.create_host({"name": "web01.example.com"})
+		with self.assertRaises(satellite6_automation.SatelliteAPIError) as raised:
+			self.api.create_host({"name": "web01.example.com"})
+		self.assertEqual(raised.exception.status, 422)
+		self.assertIn("Name has already been taken", str(raised.exception))
+
+	def test_list_pages(self):
+		self.server.data["/api/subnets"] = [{"id": number, "name": "subnet%d" % number} for number in range(2500)]
+		self.assertEqual(len(self.api.subnets()), 2500)
+		self.assertEqual(len([request for request in self.server.requests if request[1] == "/api/subnets"]), 3)
+
+	def test_connections_are_kept_alive(self):
+		for number in range(5):
+			self.api.hosts()
+		self.assertEqual(self.server.connection_count, 1)
+
+	def test_reconnect_after_dropped_connections(self):
+		# two idle connections in the pool, both dropped by the server: the retry has to use
+		# a new connection instead of the next stale one. A create is not retried with
+		# backoff, so only this retry saves it.
+		self.api.hosts()
+		held = self.api.acquire_connection()
+		self.api.hosts()
+		self.api.release_connection(held)
+		self.assertEqual(len(self.api.idle_connections), 2)
+		self.server.drop_connections()
+		self.api.create_host({"name": "web01.example.com"})
+		self.assertEqual(len(self.api.hosts(search='name = "web01.example.com"')), 1)
+		self.assertEqual(self.server.connection_count, 3)
+
+	def test_create_not_sent_again_after_timeout(self):
+		# Satellite may still create the host after the client gave up, so the POST must
+		# reach it only once; the timeout is left to the caller.
+		api = satellite6_automation.SatelliteAPI(self.server.url(), stub_api.USERNAME, stub_api.PASSWORD, timeout=0.5)
+		api.hosts()
+		self.server.delay = 1
+		with self.assertRaises(socket.timeout):
+			api.create_host({"name": "web01.example.com"})
+		api.close()
+		self.assertEqual([request for request in self.server.requests if request[0] == "POST"], [("POST", "/api/hosts")])
+
+	def test_authentication(self):
+		api = satellite6_automation.SatelliteAPI(self.server.url(), stub_api.USERNAME, "wrong")
+		with self.assertRaises(satellite6_automation.SatelliteAPIError) as raised:
+			api.hosts()
+		self.assertEqual(raised.exception.status, 401)
+
+class IPAAPITest(unittest.TestCase):
+	def setUp(self):
+		self.server = stub_api.StubServer().start()
+		self.api = satellite6_automation.IPAAPI(self.server.url() + "/ipa", stub_api.USERNAME, stub_api.PASSWORD)
+
+	def tearDown(self):
+		self.api.close()
+		self.server.stop()
+
+	def test_host_add_and_find_reuse_session(self):
+		self.assertEqual(self.api.call("host_find", [], {"fqdn": "web01.example.com"})["count"], 0)
+		self.api.call("host_add", ["web01.example.com"], {"force": True})
+		self.assertEqual(self.api.call("host_find", [], {"fqdn": "web01.example.com"})["count"], 1)
+		self.assertEqual(self.server.ipa_logins, 1)
+		self.assertEqual(self.server.connection_count, 1)
+		self.assertEqual(self.server.ipa_calls, ["host_find", "host_add", "host_find"])
+
+	def test_error(self):
+		self.api.call("host_add", ["web01.example.com"])
+		with self.assertRaises(satellite6_automation.IPAError) as raised:
+			self.api.call("host_add", ["web01.example.com"])
+		self.assertEqual(raised.exception.code, satellite6_automation.IPAAPI.DUPLICATE_ENTRY)
+
+	def test_login_again_after_session_expired(self):
+		self.api.call("host_find")
+		self.server.expire_sessions()
+		self.api.call("host_find")
+		self.assertEqual(self.server.ipa_logins, 2)
+
+	def test_wrong_password(self):
+		api = satellite6_automation.IPAAPI(self.server.url() + "/ipa", stub_api.USERNAME, "wrong")
+		with self.assertRaises(satellite6_automation.IPAError) as raised:
+			api.call("host_find")
+		self.assertEqual(raised.exception.code, 401)
+
+	def test_ensure_hostgroup_in_one_batch(self):
+		result = self.api.ensure_hostgroup("hg-app-dev")
+		self.assertEqual(result, {"hostgroup": "hg-app-dev", "found": False, "hostgroup_created": True, "automember_rule_created": True, "automember_condition_created": True})
+		self.assertEqual(self.server.ipa_calls, ["batch"])
+		self.assertEqual(self.server.ipa["automember"]["hg-app-dev"]["automemberinclusiveregex"], ["hg-app-dev"])
+		# a second run finds everything and creates nothing
+		result = self.api.ensure_hostgroup("hg-app-dev")
+		self.assertEqual(result, {"hostgroup": "hg-app-dev", "found": True, "hostgroup_created": False, "automember_rule_created": False, "automember_condition_created": False})
+
+	def test_find_hostgroups(self):
+		self.api.ensure_hostgroup("hg-app-dev")
+		self.api.call("hostgroup_add", ["hg-app-test"])
+		self.assertEqual(self.api.find_hostgroups(["hg-app-dev", "hg-app-test", "hg-app-prod"]), {
+			"hg-app-dev": {"hostgroup": True, "automember_rule": True},
+			"hg-app-test": {"hostgroup": True, "automember_rule": False},
+			"hg-app-prod": {"hostgroup": False, "automember_rule": False},
+		})
+		self.assertEqual(self.api.show_hostgroup("hg-app-test")["cn"], ["hg-app-test"])
+
+if __name__ == "__main__":
+	unittest.main()
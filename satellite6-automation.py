@@ -39,20 +39,109 @@ import platform
 import os.path
 import string
 import fileinput
+import hashlib
+import time
+import base64
+import httplib
+import socket
+import errno
+import ssl
+import threading
+import urllib
+import urlparse
+import cStringIO
+import Queue
+import BaseHTTPServer
+import SocketServer
+import atexit
+import fcntl
+import signal
+import tempfile
+import random
+import pipes
+import sqlite3
+import traceback
 from datetime import datetime
 from optparse import OptionParser
 from uuid import getnode
 from itertools import islice
+try:
+	import kerberos
+except ImportError:
+	kerberos = None
 
 devnull = open(os.devnull, 'w')
 
 current_date = datetime.now().strftime('%Y-%m-%d_%H:%M:%S')
-hammer_cmd = "/usr/bin/hammer"
-cmd_kdestroy = "/usr/bin/kdestroy"
-cmd_kinit = "/usr/bin/kinit"
-cmd_klist = "/usr/bin/klist"
-cmd_getkeytab = "/usr/sbin/ipa-getkeytab"
-cmd_ipa = "/usr/bin/ipa"
+# The paths of the external commands can be overridden from the environment (e.g. by the
+# benchmark in benchmark/, which replaces them with stubs).
+hammer_cmd = os.environ.get("HAMMER_CMD", "/usr/bin/hammer")
+cmd_kdestroy = os.environ.get("KDESTROY_CMD", "/usr/bin/kdestroy")
+cmd_kinit = os.environ.get("KINIT_CMD", "/usr/bin/kinit")
+cmd_klist = os.environ.get("KLIST_CMD", "/usr/bin/klist")
+cmd_getkeytab = os.environ.get("IPA_GETKEYTAB_CMD", "/usr/sbin/ipa-getkeytab")
+cmd_ipa = os.environ.get("IPA_CMD", "/usr/bin/ipa")
+
+# Satellite REST API client (--api). Credentials are read from the hammer configuration.
+SATELLITE_API = None
+HAMMER_CONFIG = os.path.expanduser("~/.hammer/cli_config.yml")
+# IPA JSON-RPC client (--ipa-api).
+IPA_API = None
+
+# On-disk cache for "hammer --csv <resource> list" output. Every entry is stored as
+# <resource>[_<organization>].json and is considered fresh for INVENTORY_CACHE_TTL
+# seconds. A TTL of 0 disables caching for that resource.
+INVENTORY_CACHE_ENABLED = True
+INVENTORY_CACHE_DIR = "/home/svc-satellite-automation/tmp/inventory-cache"			# Change this variable to a local directory writable by the service user
+INVENTORY_CACHE_TTL = {										# Change these values according to how often your Satellite inventory changes
+	"organization":			86400,
+	"location":			86400,
+	"lifecycle-environment":	3600,
+	"environment":			3600,
+	"os":				86400,
+	"subnet":			3600,
+	"hostgroup":			900,
+	"host":				300,
+	"proxy":			86400,
+}
+# Local SQLite index of all Satellite hosts (FQDN, id, primary IP and MAC) for existence and
+# conflict checks. It is seeded with one host list; afterwards only the hosts changed since the
+# last sync are fetched, at most every INVENTORY_CACHE_TTL["host"] seconds. Hosts deleted on
+# Satellite are dropped by a full host list every HOST_INDEX_RECONCILE seconds.
+HOST_INDEX_FILE = "/home/svc-satellite-automation/tmp/hosts.sqlite"				# Change this variable to a local file writable by the service user
+HOST_INDEX_RECONCILE = 86400
+HOST_INDEX_OVERLAP = 300									# Search for changes this many seconds before the last sync (clock skew to Satellite)
+HOST_INDEX = None
+HOST_INDEX_LOCK = threading.Lock()
+
+# Prometheus textfile collector file for the metrics of the last run, e.g.
+# "/var/lib/node_exporter/textfile_collector/satellite6_automation.prom". Empty disables it.
+METRICS_TEXTFILE = ""										# Change this variable to enable Prometheus metrics
+
+# Client side concurrency limits per backend. Every limit starts at "initial" and adapts to
+# how the backend copes during the run, between "minimum" and "maximum" calls in flight.
+# Calls slower than "latency" seconds count as overload.
+GOVERNOR_SETTINGS = {										# Change these values according to the size of your Satellite and IPA servers
+	"satellite":	{"initial": 8, "minimum": 1, "maximum": 32, "latency": 60.0},
+	"ipa":		{"initial": 4, "minimum": 1, "maximum": 16, "latency": 20.0},
+}
+# Transient failures (overloaded or unreachable Satellite/IPA) are retried with jittered
+# exponential backoff: up to RETRY_ATTEMPTS attempts, waiting at most RETRY_MAX_DELAY seconds.
+RETRY_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+# Host creations run in the background (--create-workers). If a create call times out or its
+# connection breaks, Satellite may still finish the host: all such hosts are looked up with one
+# host search every HOST_CREATE_POLL_INTERVAL seconds, for at most HOST_CREATE_TIMEOUT seconds.
+HOST_CREATE_POLL_INTERVAL = 10
+HOST_CREATE_TIMEOUT = 900
+HAMMER_FINAL_EXIT_CODES = (64, 65, 77, 128)							# hammer usage, validation, permission and not found errors: the host was not created
+# --gc removes the partition tables and boot ISOs of hosts that no longer exist on Satellite in
+# batches of GC_BATCH_SIZE objects with a pause of GC_BATCH_PAUSE seconds between them. Temporary
+# files of interrupted ISO downloads are removed once they are GC_PART_AGE seconds old.
+GC_BATCH_SIZE = 20
+GC_BATCH_PAUSE = 5.0
+GC_PART_AGE = 86400
 
 
 class log:
@@ -63,223 +152,2263 @@ class log:
 	SUMM	= '\033[1;35m'
 	END	= '\033[0m'
 
+# Instrumentation: every external call (hammer, ipa, Kerberos tools, Satellite and IPA API
+# requests) is recorded with its kind, a short argument summary, duration, exit code and
+# the bytes read. Calls are tagged with the phase of the provisioning step that made them
+# and are written as JSON lines (--metrics-log) and as Prometheus textfile
+# (METRICS_TEXTFILE). A summary per phase is printed at the end of the run.
+CALLS = []
+CALLS_LOCK = threading.Lock()
+CALLS_LIMIT = 0
+CALL_CONTEXT = threading.local()
+METRICS_LOG = None
+RUN_STARTED = time.time()
+PHASES = ["setup", "verification", "hostgroups", "ipa", "ptable", "host create", "host update", "iso"]
+
+def get_phase():
+	return getattr(CALL_CONTEXT, "phase", "setup")
+
+def set_phase(phase):
+	CALL_CONTEXT.phase = phase
+
+def summarize_command(cmd):
+	# "hammer --csv host list --search ..." -> ("hammer", "host list"). Only sub-commands are
+	# kept, so host names, keytabs or passwords never end up in the metrics.
+	try:
+		words = shlex.split(cmd)
+	except ValueError:
+		words = cmd.split()
+	kind = words and os.path.basename(words[0]) or "unknown"
+	arguments = [word for word in words[1:] if not word.startswith("-")]
+	if kind == "hammer":
+		return kind, " ".join(arguments[:2])
+	if kind == "ipa":
+		return kind, " ".join(arguments[:1])
+	return kind, ""
+
+def record_call(kind,summary,started,exit_code,bytes_read,error=None):
+	entry = {"timestamp": round(started, 3), "phase": get_phase(), "kind": kind, "summary": summary, "duration": round(time.time() - started, 6), "exit_code": exit_code, "bytes": bytes_read}
+	if error:
+		entry["error"] = error
+	with CALLS_LOCK:
+		CALLS.append(entry)
+		if CALLS_LIMIT and len(CALLS) > CALLS_LIMIT:	# long running --serve process, keep the newest calls
+			del CALLS[:len(CALLS) - CALLS_LIMIT / 2]
+		if METRICS_LOG:
+			METRICS_LOG.write(json.dumps(entry) + "\n")
+			METRICS_LOG.flush()
+
+class GovernorSlot(object):
+	def __init__(self, governor):
+		self.governor = governor
+		self.started = time.time()
+		self.failed = False
+		self.observe = True
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, exc_traceback):
+		self.governor.release(self)
+
+class Governor(object):
+	# Client side limit of the requests in flight to one backend (Satellite or IPA). The
+	# limit adapts to the backend (AIMD): every call that succeeds faster than "latency"
+	# seconds raises it by 1/limit, i.e. by one per limit calls, a failed, timed out or slow
+	# call halves it. Only calls started after the last decrease can decrease it again, so
+	# one overload episode halves the limit once and not once per call in flight.
+	def __init__(self, name, initial, minimum, maximum, latency):
+		self.name = name
+		self.limit = float(initial)
+		self.minimum = minimum
+		self.maximum = maximum
+		self.latency = latency
+		self.in_flight = 0
+		self.last_decrease = 0.0
+		self.decreases = 0
+		self.retries = 0
+		self.condition = threading.Condition()
+
+	def slot(self):
+		# with governor.slot() as slot: ... set slot.failed for a transient failure
+		with self.condition:
+			while self.in_flight >= int(self.limit):
+				self.condition.wait(1)		# wait with timeout, otherwise Ctrl-C is not delivered in Python 2
+			self.in_flight = self.in_flight + 1
+		return GovernorSlot(self)
+
+	def release(self, slot, failed=False):
+		duration = time.time() - slot.started
+		with self.condition:
+			self.in_flight = self.in_flight - 1
+			if slot.failed or failed or (slot.observe and duration > self.latency):
+				if slot.started > self.last_decrease:
+					self.limit = max(float(self.minimum), self.limit / 2)
+					self.last_decrease = time.time()
+					self.decreases = self.decreases + 1
+			elif slot.observe:
+				self.limit = min(float(self.maximum), self.limit + 1.0 / self.limit)
+			self.condition.notify_all()
+
+GOVERNORS = dict((name, Governor(name, **settings)) for name, settings in GOVERNOR_SETTINGS.items())
+GOVERNED_COMMANDS = {"hammer": "satellite", "ipa": "ipa"}
+
+# Error messages of an overloaded or unreachable server. Reads are retried on all of them,
+# writes only on those that guarantee the server did not process the request.
+TRANSIENT_ERRORS = ("502 Bad Gateway", "503 Service Unavailable", "504 Gateway Time", "429 Too Many Requests", "Timed out", "timed out", "execution expired", "Connection refused", "Connection reset", "ECONNREFUSED", "ECONNRESET")
+UNPROCESSED_ERRORS = ("503 Service Unavailable", "429 Too Many Requests", "Connection refused", "ECONNREFUSED")
+
+def is_transient_error(text,read=True):
+	for pattern in read and TRANSIENT_ERRORS or UNPROCESSED_ERRORS:
+		if pattern in text:
+			return True
+	return False
+
+def first_line(text):
+	for line in text.splitlines():
+		if line.strip():
+			return line.strip()[:200]
+	return ""
+
+def retry_delay(attempt):
+	# Exponential backoff with full jitter, so retrying workers do not hit the backend in lockstep
+	return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+def retry_wait(governor,attempt,what,error):
+	delay = retry_delay(attempt)
+	with governor.condition:
+		governor.retries = governor.retries + 1
+	print log.WARN + "WARNING: " + what + " failed (" + error + "), retrying in %.1fs (attempt %d of %d)." % (delay, attempt + 2, RETRY_ATTEMPTS) + log.END
+	time.sleep(delay)
+
+def run_command(cmd,env=None,stderr=None):
+	# Runs an external command line and returns (exit code, output). All external commands
+	# go through here, so each of them is timed and recorded.
+	exit_code, output, errors = execute_command(cmd,env,stderr)
+	return exit_code, output
+
+def execute_command(cmd,env=None,stderr=None):
+	# Like run_command(), returns (exit code, output, error output). hammer and ipa calls
+	# wait for a slot of their backend's governor.
+	kind, summary = summarize_command(cmd)
+	governor = GOVERNORS.get(GOVERNED_COMMANDS.get(kind))
+	slot = governor and governor.slot()
+	started = time.time()
+	try:
+		process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=stderr, env=env, close_fds=True)
+		output, errors = process.communicate()
+	except OSError as e:
+		record_call(kind, summary, started, None, 0, str(e))
+		if slot:
+			governor.release(slot, True)
+		raise
+	record_call(kind, summary, started, process.returncode, len(output))
+	if slot:
+		slot.failed = process.returncode != 0 and is_transient_error(errors or output)
+		governor.release(slot)
+	return process.returncode, output, errors or ""
+
+def report_metrics():
+	with CALLS_LOCK:
+		calls = list(CALLS)
+	if not calls:
+		return
+	phases = {}
+	for call in calls:
+		phase = phases.setdefault(call["phase"], {"calls": 0, "duration": 0.0, "errors": 0, "kinds": {}})
+		phase["calls"] = phase["calls"] + 1
+		phase["duration"] = phase["duration"] + call["duration"]
+		if call["exit_code"] not in (0, 200, 201, 202, 204):
+			phase["errors"] = phase["errors"] + 1
+		kind = phase["kinds"].setdefault(call["kind"], [0, 0.0])
+		kind[0], kind[1] = kind[0] + 1, kind[1] + call["duration"]
+
+	print log.SUMM + "### External calls per phase (call time, parallel calls add up) ###" + log.END
+	for phase_name in PHASES + sorted(set(phases) - set(PHASES)):
+		if phase_name in phases:
+			phase = phases[phase_name]
+			kinds = ", ".join(["%s %d/%.2fs" % (kind, count, duration) for kind, (count, duration) in sorted(phase["kinds"].items())])
+			print "%-13s %4d calls %8.2fs %3d failed  (%s)" % (phase_name, phase["calls"], phase["duration"], phase["errors"], kinds)
+	print "%-13s %8.2fs wall time" % ("total", time.time() - RUN_STARTED)
+	for name, governor in sorted(GOVERNORS.items()):
+		if governor.retries or governor.decreases:
+			print "%-13s %d retries, concurrency limit lowered %d times, now %.1f" % (name, governor.retries, governor.decreases, governor.limit)
+
+	if METRICS_TEXTFILE:
+		write_metrics_textfile(calls)
+
+def write_metrics_textfile(calls):
+	# Prometheus node_exporter textfile collector format, written atomically
+	def labels(call):
+		return 'kind="%s",phase="%s"' % (call["kind"].replace('"', '\\"'), call["phase"].replace('"', '\\"'))
+	counts, durations, read, errors = {}, {}, {}, {}
+	for call in calls:
+		key = labels(call)
+		counts[key] = counts.get(key, 0) + 1
+		durations[key] = durations.get(key, 0.0) + call["duration"]
+		read[key] = read.get(key, 0) + call["bytes"]
+		errors[key] = errors.get(key, 0) + (call["exit_code"] not in (0, 200, 201, 202, 204) and 1 or 0)
+	lines = []
+	for name, help_text, values in (
+		("satellite6_automation_external_calls_total", "External calls of the last run.", counts),
+		("satellite6_automation_external_call_errors_total", "Failed external calls of the last run.", errors),
+		("satellite6_automation_external_call_duration_seconds_total", "Time spent in external calls of the last run.", durations),
+		("satellite6_automation_external_call_read_bytes_total", "Bytes read from external calls of the last run.", read)):
+		lines.append("# HELP " + name + " " + help_text)
+		lines.append("# TYPE " + name + " gauge")
+		for key in sorted(values):
+			lines.append(name + "{" + key + "} " + repr(values[key]))
+	for name, help_text, attribute in (
+		("satellite6_automation_governor_limit", "Concurrency limit per backend at the end of the last run.", "limit"),
+		("satellite6_automation_governor_retries_total", "Retried calls per backend of the last run.", "retries"),
+		("satellite6_automation_governor_decreases_total", "Concurrency limit decreases per backend of the last run.", "decreases")):
+		lines.append("# HELP " + name + " " + help_text)
+		lines.append("# TYPE " + name + " gauge")
+		for backend, governor in sorted(GOVERNORS.items()):
+			lines.append(name + '{backend="' + backend + '"} ' + repr(getattr(governor, attribute)))
+	lines.append("# HELP satellite6_automation_run_duration_seconds Wall time of the last run.")
+	lines.append("# TYPE satellite6_automation_run_duration_seconds gauge")
+	lines.append("satellite6_automation_run_duration_seconds " + repr(time.time() - RUN_STARTED))
+	lines.append("# HELP satellite6_automation_last_run_timestamp_seconds End of the last run.")
+	lines.append("# TYPE satellite6_automation_last_run_timestamp_seconds gauge")
+	lines.append("satellite6_automation_last_run_timestamp_seconds " + repr(time.time()))
+	try:
+		tmp_fd, tmp_name = tempfile.mkstemp(prefix=".", suffix=".prom.tmp", dir=os.path.dirname(METRICS_TEXTFILE) or ".")
+		with os.fdopen(tmp_fd, 'w') as textfile:
+			textfile.write("\n".join(lines) + "\n")
+		os.chmod(tmp_name, 0644)
+		os.rename(tmp_name, METRICS_TEXTFILE)
+	except (IOError, OSError) as e:
+		print log.WARN + "WARNING: could not write metrics to " + METRICS_TEXTFILE + ": " + str(e) + log.END
+
+
+class HammerShellError(Exception):
+	pass
+
+class HammerError(Exception):
+	def __init__(self, cmd, exit_code, errors=""):
+		Exception.__init__(self, cmd + " failed with exit code " + str(exit_code))
+		self.exit_code = exit_code
+		self.errors = errors
+
+class HammerShell(object):
+	# One long-lived "hammer shell" per run. Commands are written to its stdin, the answer is
+	# read back until a frame marker: after every command an unknown sub-command
+	# "__frame_<n>__" is sent, whose error message tells us that the previous command has
+	# finished. The message has several lines ("Error: No such sub-command '__frame_<n>__'.",
+	# an empty line, "See: 'hammer --help'."), all of them are read, otherwise they would
+	# start the output of the next command. hammer shell does not report exit codes, so a
+	# command is considered failed when its output contains an error line.
+	ERROR_PREFIXES = ("Error:", "Could not", "Failed", "[ERROR")
+	MARKER_END = "See: 'hammer --help'."
+
+	def __init__(self, command):
+		self.command = command
+		self.process = None
+		self.frame = 0
+		self.lock = threading.Lock()
+
+	def start(self):
+		self.process = subprocess.Popen([self.command, "shell"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=0, close_fds=True)
+
+	def stop(self):
+		if self.process and self.process.poll() is None:
+			try:
+				self.process.stdin.write("exit\n")
+				self.process.stdin.close()
+			except IOError:
+				pass
+			self.process.wait()
+		self.process = None
+
+	def run(self, arguments):
+		with self.lock:
+			if self.process is None or self.process.poll() is not None:
+				self.start()
+			self.frame = self.frame + 1
+			marker = "__frame_" + str(self.frame) + "__"
+			try:
+				self.process.stdin.write(arguments.replace("\n", " ") + "\n" + marker + "\n")
+				self.process.stdin.flush()
+			except IOError:
+				self.process = None
+				raise HammerShellError("hammer shell terminated unexpectedly")
+			lines = []
+			line = self.read_line()
+			while marker not in line:
+				lines.append(line)
+				line = self.read_line()
+			while self.MARKER_END not in line:
+				line = self.read_line()
+		output = "".join(lines).replace("hammer> ", "")
+		for line in output.splitlines():
+			if line.strip().startswith(self.ERROR_PREFIXES):
+				return 1, output
+		return 0, output
+
+	def read_line(self):
+		line = self.process.stdout.readline()
+		if not line:
+			self.process = None
+			raise HammerShellError("hammer shell terminated unexpectedly")
+		return line
+
+HAMMER_SHELL = None
+
+def run_hammer(cmd,use_shell=True):
+	# Runs a hammer command line (starting with hammer_cmd) and returns (exit code, output).
+	# With --hammer-shell the command is sent to the persistent hammer shell instead of
+	# starting a new hammer process. Long running commands pass use_shell=False, so they do
+	# not block the shell for everybody else. Transient failures are retried with backoff,
+	# writes only if Satellite did not process them.
+	exit_code, output, errors = execute_hammer(cmd,use_shell)
+	return exit_code, output
+
+def execute_hammer(cmd,use_shell=True):
+	# Like run_hammer(), returns (exit code, output, error output). hammer shell reports its
+	# errors in the output.
+	kind, summary = summarize_command(cmd)
+	read = summary.split(" ")[-1] in ("list", "info")
+	for attempt in range(RETRY_ATTEMPTS):
+		exit_code, output, errors = run_hammer_once(cmd,use_shell)
+		if exit_code == 0 or attempt == RETRY_ATTEMPTS - 1 or not is_transient_error(errors or output, read):
+			if errors:
+				sys.stderr.write(errors)
+			return exit_code, output, errors
+		retry_wait(GOVERNORS["satellite"], attempt, "hammer " + summary, first_line(errors or output))
+
+def run_hammer_once(cmd,use_shell=True):
+	global HAMMER_SHELL
+	if HAMMER_SHELL and use_shell:
+		kind, summary = summarize_command(cmd)
+		with GOVERNORS["satellite"].slot() as slot:
+			started = time.time()
+			try:
+				exit_code, output = HAMMER_SHELL.run(cmd[len(hammer_cmd):].strip())
+				record_call("hammer shell", summary, started, exit_code, len(output))
+				slot.failed = exit_code != 0 and is_transient_error(output)
+				return exit_code, output, ""
+			except HammerShellError as e:
+				record_call("hammer shell", summary, started, None, 0, str(e))
+				print log.WARN + "WARNING: " + str(e) + ", falling back to running hammer directly." + log.END
+				HAMMER_SHELL = None
+	return execute_command(cmd, stderr=subprocess.PIPE)
+
+class SatelliteAPIError(Exception):
+	def __init__(self, status, message):
+		Exception.__init__(self, "HTTP " + str(status) + ": " + message)
+		self.status = status
+
+def is_stale_connection_error(error):
+	# A kept-alive connection the server closed in the meantime fails on its next request
+	# before any response byte arrives: an empty status line, a reset or a broken pipe.
+	# A timeout is none of them, the server may still be processing the request.
+	if isinstance(error, httplib.BadStatusLine):
+		return error.line in ("''", "No status line received - the server has closed the connection")
+	return not isinstance(error, socket.timeout) and getattr(error, "errno", None) in (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+class SatelliteAPI(object):
+	# Minimal client for the Foreman/Katello REST API. Connections are kept alive and
+	# handed out from a small pool, so a run pays for one TLS handshake per connection
+	# instead of one hammer process (Ruby boot, TLS, authentication) per call.
+	def __init__(self, url, username, password, ca_file=None, timeout=120, pool_size=4):
+		parsed_url = urlparse.urlparse(url)
+		self.scheme = parsed_url.scheme or "https"
+		self.host = parsed_url.hostname
+		self.port = parsed_url.port
+		self.authorization = "Basic " + base64.b64encode(username + ":" + password)
+		self.ca_file = ca_file
+		self.timeout = timeout
+		self.pool_size = pool_size
+		self.idle_connections = []
+		self.pool_lock = threading.Lock()
+		self.id_cache = {}
+
+	def new_connection(self):
+		if self.scheme == "http":
+			return httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+		context = ssl.create_default_context(cafile=self.ca_file)
+		return httplib.HTTPSConnection(self.host, self.port, timeout=self.timeout, context=context)
+
+	def acquire_connection(self):
+		with self.pool_lock:
+			if self.idle_connections:
+				return self.idle_connections.pop()
+		return self.new_connection()
+
+	def release_connection(self, connection):
+		with self.pool_lock:
+			if len(self.idle_connections) < self.pool_size:
+				self.idle_connections.append(connection)
+				return
+		connection.close()
+
+	def close(self):
+		with self.pool_lock:
+			for connection in self.idle_connections:
+				connection.close()
+			self.idle_connections = []
+
+	def request(self, method, path, params=None, body=None, raw=False):
+		if params:
+			path = path + "?" + urllib.urlencode(params)
+		headers = {"Authorization": self.authorization, "Accept": "application/json", "Connection": "keep-alive"}
+		if body is not None:
+			body = json.dumps(body)
+			headers["Content-Type"] = "application/json"
+		summary = method + " " + path.split("?")[0]
+		# Overload and connection failures are retried with backoff: reads always, writes
+		# only if Satellite did not process them (429, 503, connection refused).
+		for attempt in range(RETRY_ATTEMPTS):
+			with GOVERNORS["satellite"].slot() as slot:
+				try:
+					response, data = self.send(method, path, body, headers, summary)
+				except (httplib.HTTPException, socket.error) as e:
+					slot.failed = True
+					if attempt == RETRY_ATTEMPTS - 1 or not (method == "GET" or getattr(e, "errno", None) == errno.ECONNREFUSED):
+						raise
+					error = str(e)
+				else:
+					slot.failed = response.status in (429, 502, 503, 504)
+					if not slot.failed or attempt == RETRY_ATTEMPTS - 1 or not (method == "GET" or response.status in (429, 503)):
+						break
+					error = "HTTP " + str(response.status)
+			retry_wait(GOVERNORS["satellite"], attempt, summary, error)
+
+		if response.status >= 400:
+			try:
+				message = json.loads(data)["error"]
+				message = message.get("message") or message.get("full_messages") or str(message)
+			except (ValueError, KeyError, TypeError, AttributeError):
+				message = data.strip() or response.reason
+			raise SatelliteAPIError(response.status, str(message))
+		if raw:
+			return data
+		if not data.strip():
+			return None
+		return json.loads(data)
+
+	def send(self, method, path, body, headers, summary):
+		started = time.time()
+		for attempt in (1, 2):
+			# a pooled connection first; the retry must not pick the next stale one from the pool
+			connection = attempt == 1 and self.acquire_connection() or self.new_connection()
+			reused = connection.sock is not None
+			response = None
+			try:
+				connection.request(method, path, body, headers)
+				response = connection.getresponse()
+				data = response.read()
+				break
+			except (httplib.HTTPException, socket.error) as e:
+				connection.close()
+				# Satellite did not see the request only if a kept-alive connection was closed
+				# before any response byte arrived; everything else, above all a timeout, goes
+				# to request(), which knows which calls may be sent again.
+				if not (reused and response is None and is_stale_connection_error(e)):
+					record_call("satellite-api", summary, started, None, 0, str(e))
+					raise
+		record_call("satellite-api", summary, started, response.status, len(data))
+		if response.getheader("connection", "").lower() == "close":
+			connection.close()
+		else:
+			self.release_connection(connection)
+		return response, data
+
+	def get(self, path, params=None, raw=False):
+		return self.request("GET", path, params=params, raw=raw)
+
+	def post(self, path, body):
+		return self.request("POST", path, body=body)
+
+	def put(self, path, body):
+		return self.request("PUT", path, body=body)
+
+	def delete(self, path):
+		return self.request("DELETE", path)
+
+	def list(self, path, search=None, params=None):
+		query = dict(params or {})
+		query["per_page"] = 1000
+		if search:
+			query["search"] = search
+		results = []
+		page = 1
+		while True:
+			query["page"] = page
+			response = self.get(path, query)
+			results.extend(response.get("results", []))
+			if not response.get("results") or len(results) >= int(response.get("subtotal") or 0):
+				return results
+			page = page + 1
+
+	def find(self, path, name, field="name"):
+		for result in self.list(path, search=field + '="' + name + '"'):
+			if result.get(field) == name:
+				return result
+		return None
+
+	def resolve_id(self, path, name, field="name"):
+		# name -> id lookups do not change during a run, so each one is done at most once
+		if (path, name) not in self.id_cache:
+			result = self.find(path, name, field)
+			if result is None:
+				raise SatelliteAPIError(404, "could not find " + name + " in " + path)
+			self.id_cache[(path, name)] = result["id"]
+		return self.id_cache[(path, name)]
+
+	def organizations(self):
+		return self.list("/katello/api/organizations")
+
+	def locations(self):
+		return self.list("/api/locations")
+
+	def lifecycle_environments(self, organization):
+		return self.list("/katello/api/environments", params={"organization_id": self.resolve_id("/katello/api/organizations", organization)})
+
+	def lifecycle_environment_id(self, organization, name):
+		for environment in self.lifecycle_environments(organization):
+			if environment.get("name") == name:
+				return environment["id"]
+		raise SatelliteAPIError(404, "could not find lifecycle environment " + name + " in organization " + organization)
+
+	def hostgroups(self):
+		return self.list("/api/hostgroups")
+
+	def subnets(self):
+		return self.list("/api/subnets")
+
+	def environments(self):
+		return self.list("/api/environments")
+
+	def operatingsystems(self):
+		return self.list("/api/operatingsystems")
+
+	def hosts(self, search=None):
+		return self.list("/api/hosts", search=search)
+
+	def ptables(self):
+		return self.list("/api/ptables")
+
+	def create_hostgroup(self, attributes):
+		return self.post("/api/hostgroups", {"hostgroup": attributes})
+
+	def set_hostgroup_parameter(self, hostgroup, name, value):
+		hostgroup_id = self.resolve_id("/api/hostgroups", hostgroup)
+		return self.post("/api/hostgroups/" + str(hostgroup_id) + "/parameters", {"parameter": {"name": name, "value": value}})
+
+	def create_subnet(self, attributes):
+		return self.post("/api/subnets", {"subnet": attributes})
+
+	def create_host(self, attributes):
+		return self.post("/api/hosts", {"host": attributes})
+
+	def get_host(self, name):
+		try:
+			return self.get("/api/hosts/" + urllib.quote(name))
+		except SatelliteAPIError as e:
+			if e.status == 404:
+				return None
+			raise
 
-def verify_organization(organization):
-	cmd_get_orgas = hammer_cmd + " --csv organization list"
+	def update_host(self, host_id, attributes):
+		return self.put("/api/hosts/" + str(host_id), {"host": attributes})
+
+	def set_host_parameter(self, host_id, name, value):
+		# The parameters of a host are addressed by id or name, an unknown one is created
+		try:
+			return self.put("/api/hosts/" + str(host_id) + "/parameters/" + urllib.quote(name), {"parameter": {"value": value}})
+		except SatelliteAPIError as e:
+			if e.status != 404:
+				raise
+		return self.post("/api/hosts/" + str(host_id) + "/parameters", {"parameter": {"name": name, "value": value}})
+
+	def create_ptable(self, attributes):
+		return self.post("/api/ptables", {"ptable": attributes})
+
+	def add_ptable_operatingsystem(self, ptable, operatingsystem):
+		ptable_id = self.resolve_id("/api/ptables", ptable)
+		current = self.get("/api/ptables/" + str(ptable_id))
+		os_ids = [os_entry["id"] for os_entry in current.get("operatingsystems", [])]
+		os_id = self.resolve_id("/api/operatingsystems", operatingsystem, "title")
+		if os_id not in os_ids:
+			self.put("/api/ptables/" + str(ptable_id), {"ptable": {"operatingsystem_ids": os_ids + [os_id]}})
+
+	def delete_ptable(self, ptable):
+		# Returns False if the partition table is already gone
+		try:
+			ptable_id = self.resolve_id("/api/ptables", ptable)
+			self.delete("/api/ptables/" + str(ptable_id))
+		except SatelliteAPIError as e:
+			if e.status != 404:
+				raise
+			return False
+		return True
+
+	def download(self, path, output_file, chunk_size=1024*1024):
+		# Streams a (large) response body into output_file instead of holding it in memory
+		connection = self.acquire_connection()
+		started = time.time()
+		bytes_read = 0
+		try:
+			connection.request("GET", path, None, {"Authorization": self.authorization, "Connection": "keep-alive"})
+			response = connection.getresponse()
+			if response.status >= 400:
+				raise SatelliteAPIError(response.status, response.read().strip() or response.reason)
+			while True:
+				chunk = response.read(chunk_size)
+				if not chunk:
+					break
+				bytes_read = bytes_read + len(chunk)
+				output_file.write(chunk)
+		except Exception as e:
+			connection.close()
+			record_call("satellite-api", "GET " + path, started, getattr(e, "status", None), bytes_read, str(e))
+			raise
+		record_call("satellite-api", "GET " + path, started, response.status, bytes_read)
+		self.release_connection(connection)
+
+	def bootdisk_host(self, host, output_file):
+		self.download("/bootdisk/api/hosts/" + urllib.quote(host), output_file)
+
+# Column layout of "hammer --csv <resource> list" and the matching API attributes. The API
+# backend renders its results in this layout, so everything that parses hammer output
+# works unchanged on top of the REST client.
+API_INVENTORY_COLUMNS = {
+	"organization":			(("Id", "id"), ("Name", "name"), ("Label", "label"), ("Description", "description")),
+	"location":			(("Id", "id"), ("Name", "name")),
+	"lifecycle-environment":	(("ID", "id"), ("NAME", "name"), ("PRIOR", "prior")),
+	"environment":			(("Id", "id"), ("Name", "name")),
+	"os":				(("Id", "id"), ("Title", "title"), ("Release name", "release_name"), ("Family", "family")),
+	"subnet":			(("Id", "id"), ("Name", "name"), ("Network", "network"), ("Mask", "mask")),
+	"hostgroup":			(("Id", "id"), ("Name", "name"), ("Title", "title"), ("Operating System", "operatingsystem_name"), ("Environment", "environment_name"), ("Model", "model_name")),
+	"host":				(("Id", "id"), ("Name", "name"), ("Operating System", "operatingsystem_name"), ("Host Group", "hostgroup_title"), ("IP", "ip"), ("MAC", "mac")),
+	"partition-table":		(("Id", "id"), ("Name", "name"), ("OS Family", "os_family")),
+	"proxy":			(("Id", "id"), ("Name", "name"), ("URL", "url")),
+}
+
+API_INVENTORY_PATHS = {
+	"organization":			"/katello/api/organizations",
+	"location":			"/api/locations",
+	"environment":			"/api/environments",
+	"os":				"/api/operatingsystems",
+	"subnet":			"/api/subnets",
+	"hostgroup":			"/api/hostgroups",
+	"host":				"/api/hosts",
+	"partition-table":		"/api/ptables",
+	"proxy":			"/api/smart_proxies",
+}
+
+def get_api_inventory(resource,organization=None,search=None):
+	if resource == "lifecycle-environment":
+		results = SATELLITE_API.lifecycle_environments(organization)
+	else:
+		results = SATELLITE_API.list(API_INVENTORY_PATHS[resource], search=search)
+	columns = API_INVENTORY_COLUMNS[resource]
+	output = cStringIO.StringIO()
+	writer = csv.writer(output, lineterminator="\n")
+	writer.writerow([header for header, attribute in columns])
+	for result in results:
+		row = []
+		for header, attribute in columns:
+			value = result.get(attribute)
+			if isinstance(value, dict):		# e.g. "prior" of a lifecycle environment
+				value = value.get("name")
+			if value is None:
+				value = ""
+			if isinstance(value, unicode):
+				value = value.encode("utf-8")
+			row.append(str(value))
+		writer.writerow(row)
+	return output.getvalue()
+
+def api_location_ids(locations):
+	return [SATELLITE_API.resolve_id("/api/locations", location) for location in locations.split(",") if location]
+
+def api_organization_id(organization):
+	return SATELLITE_API.resolve_id("/katello/api/organizations", organization)
+
+def read_hammer_config(config_file):
+	# Reads :host:, :username: and :password: from the hammer cli_config.yml that is already
+	# required for hammer (see README), so the API client needs no extra credentials file.
+	config = {}
+	with open(config_file) as hammer_config:
+		for line in hammer_config:
+			line = line.strip()
+			for key in ("host", "username", "password", "ssl_ca_file"):
+				if line.startswith(":" + key + ":"):
+					config[key] = line.split(":", 2)[2].strip().strip("'\"")
+	return config
+
+def connect_satellite_api(satellite_fqdn=None):
 	try:
-		perform_cmd = subprocess.Popen(cmd_get_orgas, shell=True, stdout=subprocess.PIPE)
-		organizations = perform_cmd.stdout.read()
-		for line in  islice(organizations.strip().split("\n"), 1, None):	# print output without CSV header
-			if organization in line:	
-				return True
+		config = read_hammer_config(HAMMER_CONFIG)
+	except IOError:
+		print log.ERROR + "ERROR: could not read hammer configuration " + HAMMER_CONFIG + " for Satellite API credentials." + log.END
+		sys.exit(1)
+	url = config.get("host")
+	if satellite_fqdn:
+		url = "https://" + satellite_fqdn
+	if not (url and config.get("username") and config.get("password")):
+		print log.ERROR + "ERROR: " + HAMMER_CONFIG + " must define :host:, :username: and :password: to use the Satellite API." + log.END
+		sys.exit(1)
+	return SatelliteAPI(url, config["username"], config["password"], ca_file=config.get("ssl_ca_file"))
+
+class IPAError(Exception):
+	def __init__(self, code, name, message):
+		Exception.__init__(self, str(name) + " (" + str(code) + "): " + message)
+		self.code = code
+		self.name = name
+
+class IPAAPI(object):
+	# Minimal client for the IPA JSON-RPC API. It logs in once (Kerberos via python-kerberos
+	# using the ticket from KRB5CCNAME, or user/password), keeps the session cookie and one
+	# kept-alive connection, so IPA calls no longer start the ipa CLI (Python boot, schema
+	# download and Kerberos negotiation) every time.
+	DUPLICATE_ENTRY = 4002
+	NOT_FOUND = 4001
+
+	def __init__(self, url, username=None, password=None, ca_file=None, timeout=60):
+		parsed_url = urlparse.urlparse(url)
+		self.scheme = parsed_url.scheme or "https"
+		self.host = parsed_url.hostname
+		self.port = parsed_url.port
+		self.base_path = parsed_url.path.rstrip("/") or "/ipa"
+		self.referer = self.scheme + "://" + parsed_url.netloc + self.base_path
+		self.username = username
+		self.password = password
+		self.ca_file = ca_file
+		self.timeout = timeout
+		self.connection = None
+		self.session = None
+		self.lock = threading.RLock()
+
+	def new_connection(self):
+		if self.scheme == "http":
+			return httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+		context = ssl.create_default_context(cafile=self.ca_file)
+		return httplib.HTTPSConnection(self.host, self.port, timeout=self.timeout, context=context)
+
+	def close(self):
+		with self.lock:
+			if self.connection:
+				self.connection.close()
+				self.connection = None
+
+	def send(self, path, body, headers):
+		headers = dict(headers)
+		headers["Referer"] = self.referer
+		headers["Connection"] = "keep-alive"
+		for attempt in (1, 2):
+			if self.connection is None:
+				self.connection = self.new_connection()
+			reused = self.connection.sock is not None
+			response = None
+			try:
+				self.connection.request("POST", self.base_path + path, body, headers)
+				response = self.connection.getresponse()
+				data = response.read()
+				break
+			except (httplib.HTTPException, socket.error) as e:
+				self.close()
+				# like SatelliteAPI.send(): only a kept-alive connection closed by the server is retried
+				if not (reused and response is None and is_stale_connection_error(e)):
+					raise
+		if response.getheader("connection", "").lower() == "close":
+			self.close()
+		return response, data
+
+	def login(self):
+		with self.lock:
+			if kerberos is not None and not self.password:
+				result, context = kerberos.authGSSClientInit("HTTP@" + self.host)
+				kerberos.authGSSClientStep(context, "")
+				headers = {"Authorization": "Negotiate " + kerberos.authGSSClientResponse(context)}
+				response, data = self.send("/session/login_kerberos", None, headers)
+			elif self.username and self.password:
+				body = urllib.urlencode({"user": self.username, "password": self.password})
+				headers = {"Content-Type": "application/x-www-form-urlencoded", "Accept": "text/plain"}
+				response, data = self.send("/session/login_password", body, headers)
 			else:
-				return False
+				raise IPAError(401, "AuthenticationError", "python-kerberos is not installed and no IPA password is configured")
+			cookie = response.getheader("set-cookie", "")
+			if response.status >= 400 or "ipa_session=" not in cookie:
+				raise IPAError(response.status, "AuthenticationError", "login to " + self.referer + " failed: " + (data.strip() or response.reason))
+			self.session = cookie[cookie.index("ipa_session="):].split(";")[0]
+
+	def call(self, method, arguments=None, options=None):
+		# Returns the "result" member of the JSON-RPC answer, raises IPAError on errors.
+		body = json.dumps({"method": method, "params": [arguments or [], options or {}], "id": 0})
+		summary = method
+		if method == "batch":
+			summary = "batch " + ",".join([command["method"] for command in arguments or []])
+		# The calls of this script are safe to repeat (ensure_hostgroup accepts existing
+		# entries), so overload and connection failures are retried with backoff.
+		for retry in range(RETRY_ATTEMPTS):
+			with GOVERNORS["ipa"].slot() as slot:
+				started = time.time()
+				with self.lock:
+					try:
+						for attempt in (1, 2):
+							if self.session is None:
+								self.login()
+							headers = {"Content-Type": "application/json", "Accept": "application/json", "Cookie": self.session}
+							response, data = self.send("/session/json", body, headers)
+							if response.status == 401 and attempt == 1:	# session expired, log in again
+								self.session = None
+								continue
+							break
+					except (httplib.HTTPException, socket.error) as e:
+						record_call("ipa-api", summary, started, None, 0, str(e))
+						slot.failed = True
+						if retry == RETRY_ATTEMPTS - 1:
+							raise
+						error = str(e)
+					except Exception as e:
+						record_call("ipa-api", summary, started, getattr(e, "code", None), 0, str(e))
+						raise
+					else:
+						record_call("ipa-api", summary, started, response.status, len(data))
+						slot.failed = response.status in (429, 502, 503, 504)
+						if not slot.failed or retry == RETRY_ATTEMPTS - 1:
+							break
+						error = "HTTP " + str(response.status)
+			retry_wait(GOVERNORS["ipa"], retry, "IPA " + summary, error)
+		if response.status >= 400:
+			raise IPAError(response.status, "HTTPError", data.strip() or response.reason)
+		answer = json.loads(data)
+		error = answer.get("error")
+		if error:
+			raise IPAError(error.get("code"), error.get("name"), error.get("message", ""))
+		return answer.get("result")
+
+	def batch(self, calls):
+		# Sends several commands in one request. calls is a list of (method, arguments, options);
+		# returns one dict per call, failed calls carry "error", "error_code" and "error_name".
+		commands_list = [{"method": method, "params": [arguments or [], options or {}]} for method, arguments, options in calls]
+		return self.call("batch", commands_list).get("results", [])
+
+	def find_hostgroup(self, hostgroup):
+		result = self.call("hostgroup_find", [], {"cn": hostgroup})
+		for entry in result.get("result", []):
+			if hostgroup in entry.get("cn", []):
+				return entry
+		return None
+
+	def show_hostgroup(self, hostgroup):
+		return self.call("hostgroup_show", [hostgroup]).get("result", {})
+
+	def find_hostgroups(self, hostgroups):
+		# Looks up several hostgroups and their automember rules in one batch request.
+		# Returns {hostgroup: {"hostgroup": found, "automember_rule": found}}.
+		calls = []
+		for hostgroup in hostgroups:
+			calls.append(("hostgroup_find", [], {"cn": hostgroup}))
+			calls.append(("automember_show", [hostgroup], {"type": "hostgroup"}))
+		results = self.batch(calls)
+		if len(results) != len(calls):
+			raise IPAError(None, "BatchError", "unexpected number of results for " + str(len(hostgroups)) + " hostgroups")
+		found = {}
+		for index, hostgroup in enumerate(hostgroups):
+			hostgroup_result, rule_result = results[2 * index], results[2 * index + 1]
+			if hostgroup_result.get("error"):
+				raise IPAError(hostgroup_result.get("error_code"), hostgroup_result.get("error_name"), hostgroup_result.get("error"))
+			if rule_result.get("error") and rule_result.get("error_code") != self.NOT_FOUND:
+				raise IPAError(rule_result.get("error_code"), rule_result.get("error_name"), rule_result.get("error"))
+			found[hostgroup] = {
+				"hostgroup": bool([entry for entry in hostgroup_result.get("result", []) if hostgroup in entry.get("cn", [])]),
+				"automember_rule": not rule_result.get("error"),
+			}
+		return found
+
+	def ensure_hostgroup(self, hostgroup):
+		# Finds the hostgroup and creates it, its automember rule and the rule condition in one
+		# batch. Entries that already exist are not an error, so the batch is safe to send
+		# whether the hostgroup exists or not. Returns a dict with the outcome of each part.
+		results = self.batch([
+			("hostgroup_find", [], {"cn": hostgroup}),
+			("hostgroup_add", [hostgroup], {}),
+			("automember_add", [hostgroup], {"type": "hostgroup"}),
+			("automember_add_condition", [hostgroup], {"type": "hostgroup", "key": "userclass", "automemberinclusiveregex": [hostgroup]}),
+		])
+		if len(results) != 4:
+			raise IPAError(None, "BatchError", "unexpected number of results for hostgroup " + hostgroup)
+		for result in results[1:]:
+			if result.get("error") and result.get("error_code") != self.DUPLICATE_ENTRY:
+				raise IPAError(result.get("error_code"), result.get("error_name"), result.get("error"))
+		if results[0].get("error"):
+			raise IPAError(results[0].get("error_code"), results[0].get("error_name"), results[0].get("error"))
+		return {
+			"hostgroup": hostgroup,
+			"found": bool([entry for entry in results[0].get("result", []) if hostgroup in entry.get("cn", [])]),
+			"hostgroup_created": not results[1].get("error"),
+			"automember_rule_created": not results[2].get("error"),
+			"automember_condition_created": bool(results[3].get("completed")),
+		}
+
+def read_ipa_config(config_file):
+	# Reads the IPA server from the ipa client configuration that the ipa CLI uses as well.
+	config = {}
+	with open(config_file) as ipa_config:
+		for line in ipa_config:
+			if "=" in line:
+				key, value = line.split("=", 1)
+				config[key.strip()] = value.strip()
+	if config.get("xmlrpc_uri"):
+		parsed_url = urlparse.urlparse(config["xmlrpc_uri"])
+		return parsed_url.scheme + "://" + parsed_url.netloc + parsed_url.path.rsplit("/", 1)[0]
+	if config.get("server"):
+		return "https://" + config["server"] + "/ipa"
+	return None
+
+def connect_ipa_api():
+	try:
+		url = read_ipa_config(IPA_CONFIG)
+	except IOError:
+		print log.ERROR + "ERROR: could not read IPA client configuration " + IPA_CONFIG + "." + log.END
+		sys.exit(1)
+	if not url:
+		print log.ERROR + "ERROR: " + IPA_CONFIG + " must define xmlrpc_uri or server to use the IPA API." + log.END
+		sys.exit(1)
+	if kerberos is None and not IPA_PASSWORD:
+		print log.ERROR + "ERROR: the IPA API needs python-kerberos or IPA_PASSWORD set in this script." + log.END
+		sys.exit(1)
+	return IPAAPI(url, PRINCIPAL, IPA_PASSWORD, ca_file=IPA_CA_FILE)
+
+def get_inventory_cache_file(resource,organization=None):
+	cache_key = resource
+	if organization:
+		cache_key = cache_key + "_" + organization
+	return os.path.join(INVENTORY_CACHE_DIR, cache_key.replace('/','_').replace(' ','_') + ".json")
+
+def read_inventory_cache(resource,organization=None):
+	if not INVENTORY_CACHE_ENABLED or INVENTORY_CACHE_TTL.get(resource, 0) <= 0:
+		return None
+	try:
+		with open(get_inventory_cache_file(resource,organization)) as cache_file:
+			entry = json.load(cache_file)
+	except (IOError, ValueError):
+		return None
+	if time.time() - entry.get("timestamp", 0) > INVENTORY_CACHE_TTL[resource]:
+		return None
+	return entry.get("output")
+
+def write_inventory_cache(resource,output,organization=None):
+	if not INVENTORY_CACHE_ENABLED or INVENTORY_CACHE_TTL.get(resource, 0) <= 0:
+		return
+	cache_file = get_inventory_cache_file(resource,organization)
+	try:
+		if not os.path.isdir(INVENTORY_CACHE_DIR):
+			os.makedirs(INVENTORY_CACHE_DIR)
+		tmp_fd, tmp_name = tempfile.mkstemp(dir=INVENTORY_CACHE_DIR, suffix=".tmp")
+		with os.fdopen(tmp_fd, 'w') as tmp_file:
+			json.dump({"timestamp": time.time(), "output": output}, tmp_file)
+		os.rename(tmp_name, cache_file)		# atomic replace, concurrent runs and workers never read a half written entry
+	except (IOError, OSError):
+		print log.WARN + "WARNING: could not write inventory cache " + cache_file + log.END
+
+def invalidate_inventory_cache(resource,organization=None,indexes=True):
+	# indexes=False keeps the in-memory indexes, for callers that update them themselves
+	cache_file = get_inventory_cache_file(resource,organization)
+	with INVENTORY_INDEXES_LOCK:
+		for key in INVENTORY_INDEXES.keys():
+			if indexes and key[0] == resource and key[1] == organization:
+				del INVENTORY_INDEXES[key]
+	try:
+		if os.path.exists(cache_file):
+			os.remove(cache_file)
+	except OSError:
+		print log.WARN + "WARNING: could not invalidate inventory cache " + cache_file + log.END
+
+INVENTORY_FETCH_LOCK = threading.Lock()
+INVENTORY_FETCH_LOCKS = {}
+
+def get_inventory(resource,organization=None):
+	output = read_inventory_cache(resource,organization)
+	if output is not None:
+		return output
+
+	# Concurrent steps and workers that miss the cache at the same time fetch a list only once
+	with INVENTORY_FETCH_LOCK:
+		fetch_lock = INVENTORY_FETCH_LOCKS.setdefault((resource, organization), threading.Lock())
+	with fetch_lock:
+		output = read_inventory_cache(resource,organization)
+		if output is not None:
+			return output
+		return fetch_inventory(resource,organization)
+
+def get_inventory_command(resource,organization=None):
+	cmd_get_inventory = hammer_cmd + " --csv " + resource + " list"
+	if organization:
+		cmd_get_inventory = cmd_get_inventory + " --organization " + organization
+	return cmd_get_inventory
+
+def fetch_inventory(resource,organization=None):
+	if SATELLITE_API:
+		output = get_api_inventory(resource,organization)
+		write_inventory_cache(resource,output,organization)
+		return output
+
+	cmd_get_inventory = get_inventory_command(resource,organization)
+	exit_code, output = run_hammer(cmd_get_inventory)
+	if exit_code != 0:		# never cache or parse the output of a failed hammer call
+		raise HammerError(cmd_get_inventory, exit_code)
+	write_inventory_cache(resource,output,organization)
+	return output
+
+def iter_csv_rows(lines):
+	# CSV lines -> rows keyed by lower case column name. Older hammer versions print some
+	# headers in upper case (e.g. "ID,NAME,PRIOR"). The csv module takes care of quoted
+	# fields that contain commas or line breaks.
+	reader = csv.reader(lines)
+	header = [column.strip().lower() for column in next(reader, [])]
+	for row in reader:
+		if row:
+			yield dict(zip(header, row))
+
+def parse_inventory(output):
+	return list(iter_csv_rows(cStringIO.StringIO(output.strip())))
+
+def stream_hammer_csv(cmd):
+	# Yields the rows of a "hammer --csv" command while hammer is still printing them. If the
+	# caller stops early (break, return or close()), hammer is terminated and reaped instead
+	# of producing the rest of the list, otherwise its exit status is checked at the end.
+	if HAMMER_SHELL:
+		exit_code, output = run_hammer(cmd)
+		if exit_code != 0:
+			raise HammerError(cmd, exit_code)
+		for row in iter_csv_rows(cStringIO.StringIO(output.strip())):
+			yield row
+		return
+
+	# A list that fails with a transient error before its first row is retried with backoff.
+	kind, summary = summarize_command(cmd)
+	for attempt in range(RETRY_ATTEMPTS):
+		slot = GOVERNORS["satellite"].slot()
+		slot.observe = False	# the duration depends on the size of the list and on the caller
+		started = time.time()
+		error_file = tempfile.TemporaryFile()	# a file, a full stderr pipe would block hammer
+		try:
+			process = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=error_file, close_fds=True)
+		except OSError:
+			error_file.close()
+			GOVERNORS["satellite"].release(slot)
+			raise
+		bytes_read = [0]
+		def read_lines():
+			for line in iter(process.stdout.readline, ""):
+				bytes_read[0] = bytes_read[0] + len(line)
+				yield line
+		rows = 0
+		finished = False
+		try:
+			for row in iter_csv_rows(read_lines()):
+				rows = rows + 1
+				yield row
+			finished = True
+		finally:
+			if not finished and process.poll() is None:
+				process.terminate()
+			process.stdout.close()
+			exit_code = process.wait()
+			error_file.seek(0)
+			errors = error_file.read()
+			error_file.close()
+			record_call(kind, summary, started, exit_code, bytes_read[0])
+			slot.failed = finished and exit_code != 0 and is_transient_error(errors)
+			GOVERNORS["satellite"].release(slot)
+		if exit_code == 0:
+			return
+		if rows or attempt == RETRY_ATTEMPTS - 1 or not is_transient_error(errors):
+			sys.stderr.write(errors)
+			raise HammerError(cmd, exit_code)
+		retry_wait(GOVERNORS["satellite"], attempt, "hammer " + summary, first_line(errors))
+
+def find_hammer_row(cmd,predicate):
+	# First row of a "hammer --csv" command for which predicate(row) is true, or None
+	rows = stream_hammer_csv(cmd)
+	try:
+		for row in rows:
+			if predicate(row):
+				return row
+	finally:
+		rows.close()
+	return None
+
+def iter_inventory(resource,organization=None):
+	# Rows of a resource list. Cached lists are read from the cache (fetched and written
+	# first if needed), lists that are not cached are streamed straight from hammer.
+	if SATELLITE_API or HAMMER_SHELL or (INVENTORY_CACHE_ENABLED and INVENTORY_CACHE_TTL.get(resource, 0) > 0):
+		return iter(parse_inventory(get_inventory(resource,organization)))
+	return stream_hammer_csv(get_inventory_command(resource,organization))
+
+INVENTORY_INDEXES = {}
+INVENTORY_INDEXES_LOCK = threading.Lock()
+
+def get_inventory_index(resource,column,organization=None):
+	# Hash index {exact column value: row} over the (cached) inventory list, so checks are
+	# exact O(1) lookups instead of substring scans ("web1" must not match "web10").
+	# Indexes are kept in memory for the TTL of the resource and dropped on invalidation.
+	def build_index(rows):
+		index = {}
+		for row in rows:
+			if row.get(column):
+				index.setdefault(row[column], row)
+		return index
+	return get_cached_index(resource,column,organization,build_index)
+
+def get_cached_index(resource,name,organization,build_index):
+	key = (resource, organization, name)
+	with INVENTORY_INDEXES_LOCK:
+		if key in INVENTORY_INDEXES:
+			built, index = INVENTORY_INDEXES[key]
+			if time.time() - built <= INVENTORY_CACHE_TTL.get(resource, 0):
+				return index
+	index = build_index(iter_inventory(resource,organization))
+	with INVENTORY_INDEXES_LOCK:
+		# Threads that missed at the same time all use the index stored first, indexes that
+		# are updated in place (the hostgroup tree) must not be replaced by a second copy
+		if key in INVENTORY_INDEXES and time.time() - INVENTORY_INDEXES[key][0] <= INVENTORY_CACHE_TTL.get(resource, 0):
+			return INVENTORY_INDEXES[key][1]
+		INVENTORY_INDEXES[key] = (time.time(), index)
+	return index
+
+def search_inventory(resource,search,predicate=None):
+	# Server side filtered list, used where the full list is too big to fetch (hosts).
+	# Returns the first row matching predicate (or None), hammer stops at that row.
+	if predicate is None:
+		predicate = lambda row: True
+	if SATELLITE_API:
+		for row in parse_inventory(get_api_inventory(resource,search=search)):
+			if predicate(row):
+				return row
+		return None
+	return find_hammer_row(hammer_cmd + " --csv " + resource + " list --search '" + search + "'", predicate)
+
+def verify_organization(organization):
+	try:
+		return organization in get_inventory_index("organization","name") or organization in get_inventory_index("organization","label")
 
 	except:
 		print log.ERROR + "ERROR" + log.END
 		sys.exit(1)
 
 def verify_location(location):
-	cmd_get_locations = hammer_cmd + " --csv location list"
 	try:
-		perform_cmd = subprocess.Popen(cmd_get_locations, shell=True, stdout=subprocess.PIPE)
-		locations = perform_cmd.stdout.read()
-		for line in  islice(locations.strip().split("\n"), 1, None):	# print output without CSV header
-			if location in line:	
-				return True
-				break
-			#else:
-			#	return False
+		return location in get_inventory_index("location","name") or location in get_inventory_index("location","title")
 
 	except:
 		print log.ERROR + "ERROR" + log.END
 		sys.exit(1)
 
 def verify_lifecycle(environment):
-	cmd_get_lifecycle = hammer_cmd + " --csv lifecycle-environment list --organization " + ORGANIZATION
-	print cmd_get_lifecycle
 	try:
-		perform_cmd = subprocess.Popen(cmd_get_lifecycle, shell=True, stdout=subprocess.PIPE)
-		lifecycle = perform_cmd.stdout.read()
-		for line in islice(lifecycle.strip().split("\n"), 1, None):	# print output without CSV header
-			if environment in line:	
-				return True
-				break
+		return environment in get_inventory_index("lifecycle-environment","name",ORGANIZATION)
 
 	except:
 		print log.ERROR + "ERROR" + log.END
 		sys.exit(1)
 
 def verify_parent_hostgroup(parenthg):
-	cmd_get_parent_hostgroup = hammer_cmd + " --csv hostgroup info --name " + parenthg
 	try:
-		perform_cmd = subprocess.Popen(cmd_get_parent_hostgroup, shell=True, stdout=subprocess.PIPE)
-		parenthostgroup = perform_cmd.stdout.read()
-		for line in  islice(parenthostgroup.strip().split("\n"), 1, None):	# print output without CSV header
-			if parenthg in line:	
-				return True
-			else:
-				return False
+		return get_hostgroup_tree().find(parenthg) is not None
 
 	except:
 		print log.ERROR + "ERROR" + log.END
 		sys.exit(1)
 
 def verify_hostname(hostname):
-	cmd_get_hostname = hammer_cmd + " --csv host list"
 	try:
-		perform_cmd = subprocess.Popen(cmd_get_hostname, shell=True, stdout=subprocess.PIPE)
-		find_host = perform_cmd.stdout.read()
-		for line in  islice(find_host.strip().split("\n"), 1, None):	# print output without CSV header
-			if hostname in line:
-				return True
-				break
+		index = get_host_index()
+		if index and index.find(hostname) is None:
+			return False
+		# The index learns about deleted hosts only when it is reconciled, so a host it knows
+		# is confirmed on Satellite
+		present = search_inventory("host", 'name = "' + hostname + '"', lambda host: host.get("name") == hostname) is not None
+		if index and not present:
+			index.remove(hostname)
+		return present
 	except:
 		print log.ERROR + "ERROR" + log.END
 		sys.exit(1)
 
-def create_parent_hostgroup(parenthg,initial_hostgroup):
-	cmd_create_parent_hostgroup = hammer_cmd + " hostgroup create --name " + parenthg + " --parent " + initial_hostgroup + " --organization " + ORGANIZATION + " --locations " + SATELLITE_LOCATIONS
+class HostIndex(object):
+	# SQLite index of the Satellite hosts, keyed by FQDN with indexes on primary IP and MAC.
+	# The first sync lists all hosts, later syncs only the hosts with updated_at after the
+	# last one; every "reconcile" seconds a full list drops the hosts deleted on Satellite.
+	# Concurrent runs and workers share the file.
+	def __init__(self, path, reconcile):
+		self.lock = threading.Lock()
+		self.sync_lock = threading.Lock()
+		self.reconcile = reconcile
+		self.synced = 0
+		self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+		with self.lock:
+			self.connection.execute("CREATE TABLE IF NOT EXISTS hosts (name TEXT PRIMARY KEY, id TEXT, ip TEXT, mac TEXT, synced REAL)")
+			for column in ("id", "ip", "mac"):
+				self.connection.execute("CREATE INDEX IF NOT EXISTS hosts_" + column + " ON hosts (" + column + ")")
+			self.connection.execute("CREATE TABLE IF NOT EXISTS sync (name TEXT PRIMARY KEY, value REAL)")
+			self.connection.commit()
+
+	def get_sync_time(self, name):
+		with self.lock:
+			row = self.connection.execute("SELECT value FROM sync WHERE name = ?", (name,)).fetchone()
+		return row and row[0] or 0
+
+	def store(self, rows, synced):
+		# Rows of a host list. A host that was renamed on Satellite replaces its old name.
+		with self.lock:
+			self.connection.executemany("DELETE FROM hosts WHERE id = ? AND name != ?", [(row["id"], row["name"]) for row in rows if row.get("id")])
+			self.connection.executemany("INSERT OR REPLACE INTO hosts (name, id, ip, mac, synced) VALUES (?, ?, ?, ?, ?)", [(row["name"], row.get("id") or "", row.get("ip") or "", (row.get("mac") or "").lower(), synced) for row in rows])
+			self.connection.commit()
+
+	def sync(self):
+		# Brings the index up to date, at most once per INVENTORY_CACHE_TTL["host"] seconds
+		with self.sync_lock:
+			if time.time() - self.synced <= INVENTORY_CACHE_TTL.get("host", 0):
+				return
+			started = time.time()
+			watermark = self.get_sync_time("watermark")
+			search = None
+			if watermark and started - self.get_sync_time("reconciled") <= self.reconcile:
+				search = 'updated_at > "' + time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime(watermark - HOST_INDEX_OVERLAP)) + '"'
+			rows = []
+			for row in iter_hosts(search):
+				rows.append(row)
+				if len(rows) == 1000:
+					self.store(rows, started)
+					rows = []
+			self.store(rows, started)
+			with self.lock:
+				if search is None:	# full list, hosts that are not in it were deleted on Satellite
+					self.connection.execute("DELETE FROM hosts WHERE synced < ?", (started,))
+					self.connection.execute("INSERT OR REPLACE INTO sync (name, value) VALUES ('reconciled', ?)", (started,))
+				self.connection.execute("INSERT OR REPLACE INTO sync (name, value) VALUES ('watermark', ?)", (started,))
+				self.connection.commit()
+			self.synced = started
+
+	def add(self, host, host_id=""):
+		# A host created or changed by this run, so later lookups see it before the next sync
+		primary_nic = host["nics"][0]
+		self.store([{"id": host_id, "name": host["client_fqdn"], "ip": primary_nic["ip"], "mac": primary_nic["mac"]}], time.time())
+
+	def remove(self, name):
+		with self.lock:
+			self.connection.execute("DELETE FROM hosts WHERE name = ?", (name,))
+			self.connection.commit()
+
+	def find(self, name):
+		with self.lock:
+			row = self.connection.execute("SELECT name, id, ip, mac FROM hosts WHERE name = ?", (name,)).fetchone()
+		if row is None:
+			return None
+		return dict(zip(("name", "id", "ip", "mac"), [str(value) for value in row]))
+
+	def find_conflicts(self, name, ip, mac):
+		# [(column, value, FQDN)] of the other hosts with this primary IP or MAC
+		conflicts = []
+		with self.lock:
+			for column, value in (("ip", ip), ("mac", mac.lower())):
+				if value:
+					for (other,) in self.connection.execute("SELECT name FROM hosts WHERE " + column + " = ? AND name != ?", (value, name)).fetchall():
+						conflicts.append((column, value, str(other)))
+		return conflicts
+
+def get_host_index():
+	# The synced host index, or None if the inventory cache is disabled for hosts
+	global HOST_INDEX
+	if not (INVENTORY_CACHE_ENABLED and INVENTORY_CACHE_TTL.get("host", 0) > 0 and HOST_INDEX_FILE):
+		return None
+	with HOST_INDEX_LOCK:
+		if HOST_INDEX is None:
+			try:
+				if not os.path.isdir(os.path.dirname(HOST_INDEX_FILE)):
+					os.makedirs(os.path.dirname(HOST_INDEX_FILE))
+				HOST_INDEX = HostIndex(HOST_INDEX_FILE, HOST_INDEX_RECONCILE)
+			except (sqlite3.Error, OSError) as e:
+				print log.WARN + "WARNING: could not open host index " + HOST_INDEX_FILE + ": " + str(e) + ". Hosts are looked up on Satellite." + log.END
+				HOST_INDEX = False
+	if not HOST_INDEX:
+		return None
+	HOST_INDEX.sync()
+	return HOST_INDEX
+
+def record_host(host,host_id=""):
+	index = get_host_index()
+	if index:
+		index.add(host, host_id)
+
+def find_host_conflicts(host):
+	# Other Satellite hosts that already use the primary IP or MAC of host. The host index
+	# finds the candidates, one search per address confirms them (the index may be stale).
+	index = get_host_index()
+	if not index:
+		return []
+	primary_nic = host["nics"][0]
+	conflicts = []
+	for column, value in sorted(set([(column, value) for column, value, other in index.find_conflicts(host["client_fqdn"], primary_nic["ip"], primary_nic["mac"])])):
+		row = search_inventory("host", column + ' = "' + value + '"', lambda row: row.get("name") != host["client_fqdn"] and (row.get(column) or "").lower() == value)
+		if row is not None:
+			conflicts.append(column.upper() + " " + value + " of " + host["client_fqdn"] + " is already used by host " + row["name"])
+	return conflicts
+
+def get_parent_option(parent):
+	# Rows read from Satellite carry the id, hostgroups created by hammer in this run only the name
+	if parent.get("id"):
+		return " --parent-id " + str(parent["id"])
+	return " --parent " + parent["name"]
+
+def get_parent_id(parent):
+	if parent.get("id"):
+		return int(parent["id"])
+	return SATELLITE_API.resolve_id("/api/hostgroups", parent["name"])
+
+def create_parent_hostgroup(parenthg,parent):
+	# Creates parenthg below the hostgroup row parent and returns the row of the new hostgroup
+	cmd_create_parent_hostgroup = hammer_cmd + " hostgroup create --name " + parenthg + get_parent_option(parent) + " --organization " + ORGANIZATION + " --locations " + CONFIG.satellite_locations
 	try:
-		perform_cmd = subprocess.Popen(cmd_create_parent_hostgroup, shell=True, stdout=subprocess.PIPE)
-		parenthostgroup = perform_cmd.stdout.read()
+		if SATELLITE_API:
+			result = SATELLITE_API.create_hostgroup({"name": parenthg, "parent_id": get_parent_id(parent), "organization_ids": [api_organization_id(ORGANIZATION)], "location_ids": api_location_ids(CONFIG.satellite_locations)})
+		else:
+			exit_code, result = run_hammer(cmd_create_parent_hostgroup)
+			if exit_code != 0:
+				raise HammerError(cmd_create_parent_hostgroup, exit_code)
+		invalidate_inventory_cache("hostgroup",indexes=False)
+		return get_created_hostgroup(parenthg,parent,result)
 
 	except:
+		row = find_concurrent_hostgroup(parenthg,parent)
+		if row:
+			return row
 		print log.ERROR + "ERROR" + log.END
 		sys.exit(1)
 
 def verify_child_hostgroup(childhg):
-	cmd_get_child_hostgroup = hammer_cmd + " --csv hostgroup info --name " + childhg
 	try:
-		perform_cmd = subprocess.Popen(cmd_get_child_hostgroup, shell=True, stdout=subprocess.PIPE)
-		childhostgroup = perform_cmd.stdout.read()
-		for line in  islice(childhostgroup.strip().split("\n"), 1, None):	# print output without CSV header
-			if childhg in line:
-				return True
-			else:
-				return False
+		return get_hostgroup_tree().find(childhg) is not None
 
 	except:
 		print log.ERROR + "ERROR" + log.END
 		sys.exit(1)
 
-def create_child_hostgroup(childhg,parenthg,puppetenv):
-	cmd_create_child_hostgroup = hammer_cmd + " hostgroup create --name " + childhg + " --parent " + parenthg + " --lifecycle-environment " + ENVIRONMENT + " --organization " + ORGANIZATION + " --environment-id " + puppetenv + " --locations " + SATELLITE_LOCATIONS
+def create_child_hostgroup(childhg,parent,puppetenv,lifecycle,activation_key):
+	# The activation key is passed with the create call, there is no separate set-parameter call
+	group_parameters = [{"name": "kt_activation_keys", "value": activation_key}]
+	cmd_create_child_hostgroup = hammer_cmd + " hostgroup create --name " + childhg + get_parent_option(parent) + " --lifecycle-environment " + lifecycle + " --organization " + ORGANIZATION + " --environment-id " + puppetenv + " --locations " + CONFIG.satellite_locations + " --group-parameters-attributes " + pipes.quote(json.dumps(group_parameters))
 	
 	try:
-		perform_cmd = subprocess.Popen(cmd_create_child_hostgroup, shell=True, stdout=subprocess.PIPE)
-		childhostgroup = perform_cmd.stdout.read()
+		if SATELLITE_API:
+			result = SATELLITE_API.create_hostgroup({"name": childhg, "parent_id": get_parent_id(parent), "lifecycle_environment_id": SATELLITE_API.lifecycle_environment_id(ORGANIZATION, lifecycle), "environment_id": int(puppetenv), "organization_ids": [api_organization_id(ORGANIZATION)], "location_ids": api_location_ids(CONFIG.satellite_locations), "group_parameters_attributes": group_parameters})
+		else:
+			exit_code, result = run_hammer(cmd_create_child_hostgroup)
+			if exit_code != 0:
+				raise HammerError(cmd_create_child_hostgroup, exit_code)
+		invalidate_inventory_cache("hostgroup",indexes=False)
+		return get_created_hostgroup(childhg,parent,result)
 
 	except:
+		row = find_concurrent_hostgroup(childhg,parent)
+		if row:
+			return row
 		print log.ERROR + "ERROR" + log.END
 		sys.exit(1)
 
-def create_partitioning_table(mountpoint,size):
+def find_concurrent_hostgroup(name,parent):
+	# The hostgroup tree only serializes the threads of this run. Another run (or the service)
+	# may have created the same hostgroup in the meantime, so a failed create looks it up again.
+	title = parent["title"] + "/" + name
+	invalidate_inventory_cache("hostgroup",indexes=False)
+	try:
+		row = search_inventory("hostgroup", 'title = "' + title + '"', lambda row: row.get("title") == title)
+	except:
+		return None
+	if row:
+		print log.INFO + "INFO: hostgroup " + title + " was created by another run. Proceed..." + log.END
+	return row
+
+def get_created_hostgroup(name,parent,result):
+	row = {"id": "", "name": name, "title": parent["title"] + "/" + name}
+	if isinstance(result, dict) and result.get("id"):	# API answer, the id saves the lookup when hosts are created
+		row["id"] = str(result["id"])
+		SATELLITE_API.id_cache[("/api/hostgroups", name)] = result["id"]
+	return row
+
+class HostgroupTree(object):
+	# Satellite hostgroups by title ("hg-application/hg-app/hg-app-dev-tr01") and by name,
+	# read with one hostgroup list. Hostgroups created during the run are added to the tree,
+	# so later hosts find them without another lookup.
+	def __init__(self, rows):
+		self.titles = {}
+		self.names = {}
+		self.lock = threading.Lock()
+		for row in rows:
+			self.add(row)
+
+	def add(self, row):
+		with self.lock:
+			self.titles[row.get("title") or row["name"]] = row
+			self.names.setdefault(row["name"], row)
+
+	def find(self, name, parent_title=None):
+		# The hostgroup called name below parent_title. Like hammer, a hostgroup with this name
+		# somewhere else in the tree is accepted too.
+		if parent_title and parent_title + "/" + name in self.titles:
+			return self.titles[parent_title + "/" + name]
+		return self.names.get(name)
+
+	def find_path(self, path):
+		# Rows of the levels of path (top level first), None for the levels that are missing
+		rows = []
+		parent = None
+		for depth, name in enumerate(path):
+			if depth > 0 and parent is None:	# below a missing level everything is missing
+				rows.append(None)
+				continue
+			parent = self.find(name, parent and (parent.get("title") or parent["name"]))
+			rows.append(parent)
+		return rows
+
+def get_hostgroup_tree():
+	return get_cached_index("hostgroup","tree",None,HostgroupTree)
+
+def ensure_hostgroup_path(path,puppetenv=None,lifecycle=None,activation_key=None,repair=False):
+	# One pass over path, e.g. ["hg-application", "hg-app", "hg-app-dev-tr01"]: every level
+	# is looked up in the hostgroup tree and only the missing ones are created, each below
+	# the level before it. With lifecycle, the last level is a child hostgroup with lifecycle
+	# environment, Puppet environment and activation key. Returns the row of the last level.
+	tree = get_hostgroup_tree()
+	rows = tree.find_path(path)
+	if rows[0] is None:
+		print log.ERROR + "ERROR: hostgroup " + path[0] + " not found. Please create it in Satellite." + log.END
+		sys.exit(1)
+	for depth in range(1, len(path)):
+		child = lifecycle is not None and depth == len(path) - 1
+		kind = child and "child" or "parent"
+		if rows[depth] is None:
+			print log.ERROR + "ERROR: " + kind + " hostgroup " + path[depth] + " not found. Create it now..." + log.END
+			if child:
+				rows[depth] = create_child_hostgroup(path[depth],rows[depth - 1],puppetenv,lifecycle,activation_key)
+			else:
+				rows[depth] = create_parent_hostgroup(path[depth],rows[depth - 1])
+			tree.add(rows[depth])
+		elif depth == len(path) - 1:
+			print log.INFO + "INFO: " + kind + " hostgroup " + path[depth] + " found. Proceed..." + log.END
+			if child and repair:	# an interrupted run may have created it without its activation key
+				update_child_hostgroup(path[depth],activation_key)
+	return rows[-1]
+
+PARTITIONING_HEADER_FILE = '/home/svc-satellite-automation/satellite6_automation/KN_RHEL_default_partitioning_header'
+PARTITIONING_HEADER = None
+
+def parse_partitioning(partitioning):
+	# "--partitioning" spec -> sorted list of (mountpoint, size in GB). Sorting makes the same
+	# layout written in a different order render to the same partition table.
+	entries = {}
+	for entry in str(partitioning).split(';'):
+		if not entry.strip():
+			continue
+		if len(entry.split(':')) != 2 or not entry.split(':')[1].strip().isdigit():
+			raise ValueError("invalid partitioning entry " + entry + ", use <mountpoint>:<size in GB>")
+		mountpoint = entry.split(':')[0].strip()
+		if mountpoint != "/":
+			mountpoint = mountpoint.rstrip('/')
+		if not mountpoint.startswith('/'):
+			raise ValueError("invalid mountpoint " + mountpoint + " in partitioning entry " + entry)
+		if mountpoint in entries:
+			raise ValueError("mountpoint " + mountpoint + " is defined twice")
+		entries[mountpoint] = int(entry.split(':')[1])
+	return sorted(entries.items())
+
+def render_partitioning_table(partitioning):
+	# Builds the complete partition table (header, one logvol per mountpoint, EOF) in memory
+	global PARTITIONING_HEADER
 	default_mountpoints = ['/','/tmp','/usr','/usr/local','/opt','/home','/var','/var/log','/var/log/audit']
 	default_volume_group = "vg00"
 	application_volume_group = "vg00"
-	newlines = []
-	header = file('/home/svc-satellite-automation/satellite6_automation/KN_RHEL_default_partitioning_header').read()
-	eof = "\nEOF"
-	size = str(int(size)*1024)
-	outfile = open('/home/svc-satellite-automation/tmp/'+HOSTNAME+'.ptable','a')
-
-	if str(mountpoint) == "/":
-		newlines.append('logvol ' + mountpoint + ' --fstype=<%= fstype %> --name=rootlv --vgname=' + default_volume_group + ' --size=' + size + ' --fsoptions="<%=  mountopts %>"\n')
-	
-	elif str(mountpoint) in default_mountpoints:
-		newlines.append('logvol ' + mountpoint + ' --fstype=<%= fstype %> --name=' + mountpoint.replace('/','') + 'lv --vgname=' + default_volume_group + ' --size=' + size + ' --fsoptions="<%=  mountopts %>"\n')
-		print "Mountpoint " + mountpoint + " found in default mounts."
-	else:
-		newlines.append('logvol ' + mountpoint + ' --fstype=<%= fstype %> --name=' + mountpoint.replace('/','') + 'lv --vgname=' + application_volume_group + ' --size=' + size + ' --fsoptions="<%=  mountopts %>"\n')
-	
-	outfile.writelines(newlines)
-
-def create_partitioning_table_header():
-	header = file('/home/svc-satellite-automation/satellite6_automation/KN_RHEL_default_partitioning_header').read()
-	outfile = open('/home/svc-satellite-automation/tmp/'+HOSTNAME+'.ptable','a')
-	outfile.writelines(header)
+	if PARTITIONING_HEADER is None:
+		PARTITIONING_HEADER = file(PARTITIONING_HEADER_FILE).read()
+	newlines = [PARTITIONING_HEADER]
+
+	for mountpoint, size in parse_partitioning(partitioning):
+		size = str(size*1024)
+		if mountpoint == "/":
+			newlines.append('logvol ' + mountpoint + ' --fstype=<%= fstype %> --name=rootlv --vgname=' + default_volume_group + ' --size=' + size + ' --fsoptions="<%=  mountopts %>"\n')
+		elif mountpoint in default_mountpoints:
+			newlines.append('logvol ' + mountpoint + ' --fstype=<%= fstype %> --name=' + mountpoint.replace('/','') + 'lv --vgname=' + default_volume_group + ' --size=' + size + ' --fsoptions="<%=  mountopts %>"\n')
+		else:
+			newlines.append('logvol ' + mountpoint + ' --fstype=<%= fstype %> --name=' + mountpoint.replace('/','') + 'lv --vgname=' + application_volume_group + ' --size=' + size + ' --fsoptions="<%=  mountopts %>"\n')
+
+	newlines.append("\nEOF")
+	return ''.join(newlines)
+
+def get_partitioning_table_name(layout):
+	# Partition tables are content addressed: the name is derived from the layout, so hosts
+	# with the same layout share one table on Satellite instead of one table per host.
+	return PTABLE_NAME_PREFIX + hashlib.sha1(layout).hexdigest()[:16]
+
+def verify_partitioning_table(ptable):
+	try:
+		return search_inventory("partition-table", 'name = "' + ptable + '"', lambda row: row.get("name") == ptable) is not None
 
-def create_partitioning_table_eof():
-	eof = "\nEOF"
-	outfile = open('/home/svc-satellite-automation/tmp/'+HOSTNAME+'.ptable','a')
-	outfile.writelines(eof)
+	except:
+		print log.ERROR + "ERROR" + log.END
+		sys.exit(1)
 
-def upload_partitioning_table():
-	ptable = "/home/svc-satellite-automation/tmp/"+ HOSTNAME + ".ptable"
-	cmd_upload_ptable = hammer_cmd + " partition-table create --os-family Redhat --name "+ HOSTNAME + "_ptable --file " + ptable + " --organizations " + ORGANIZATION + " --locations " + LOCATION
-	
-	if os.path.exists(ptable):
-		try:
-			print log.INFO + "INFO: try to upload partition table " + ptable + " to Satellite." + log.END
-			perform_cmd = subprocess.Popen(cmd_upload_ptable, shell=True, stdout=subprocess.PIPE)
-			upload_ptable = perform_cmd.stdout.read()
+def upload_partitioning_table(ptable,layout):
+	ptable_file = None
+	try:
+		print log.INFO + "INFO: try to upload partition table " + ptable + " to Satellite." + log.END
+		if SATELLITE_API:
+			SATELLITE_API.create_ptable({"name": ptable, "layout": layout, "os_family": "Redhat", "organization_ids": [api_organization_id(ORGANIZATION)], "location_ids": api_location_ids(CONFIG.satellite_locations)})
+		else:
+			# hammer only uploads from a file
+			tmp_fd, ptable_file = tempfile.mkstemp(suffix=".ptable", dir='/home/svc-satellite-automation/tmp/')
+			with os.fdopen(tmp_fd, 'w') as outfile:
+				outfile.write(layout)
+			cmd_upload_ptable = hammer_cmd + " partition-table create --os-family Redhat --name " + ptable + " --file " + ptable_file + " --organizations " + ORGANIZATION + " --locations " + CONFIG.satellite_locations
+			exit_code, upload_ptable = run_hammer(cmd_upload_ptable)
+			if exit_code != 0:
+				raise HammerError(cmd_upload_ptable, exit_code)
+		invalidate_inventory_cache("partition-table")
 
-		except:
-			print log.ERROR + "ERROR: could not upload partition table " + ptable + log.END
-			sys.exit(1)
-	else:
-		print log.ERROR + "ERROR: could not upload partition table " + ptable + ". File does not exist." + log.END
+	except:
+		# Another run with the same layout may have uploaded the same content addressed table
+		# in the meantime, its name is taken then
+		invalidate_inventory_cache("partition-table")
+		if verify_partitioning_table(ptable):
+			print log.INFO + "INFO: partition table " + ptable + " was uploaded by another run. Proceed..." + log.END
+			return
+		print log.ERROR + "ERROR: could not upload partition table " + ptable + log.END
 		sys.exit(1)
+	finally:
+		if ptable_file and os.path.exists(ptable_file):
+			os.remove(ptable_file)
 
-def assign_os_to_partitioning_table():
-	ptable = HOSTNAME+ "_ptable"
+def assign_os_to_partitioning_table(ptable):
 	cmd_assig_os_to_ptable = hammer_cmd + " partition-table add-operatingsystem --name " + ptable + " --operatingsystem " + OS
 	
 	try:
-		perform_cmd = subprocess.Popen(cmd_assig_os_to_ptable, shell=True, stdout=subprocess.PIPE)
-		upload_ptable = perform_cmd.stdout.read()
+		if SATELLITE_API:
+			SATELLITE_API.add_ptable_operatingsystem(ptable, OS)
+		else:
+			exit_code, upload_ptable = run_hammer(cmd_assig_os_to_ptable)
+			if exit_code != 0:
+				raise HammerError(cmd_assig_os_to_ptable, exit_code)
 
 	except:
 		print log.ERROR + "ERROR: could not assign partition table " + ptable + " to OS " + OS + log.END
 		sys.exit(1)
 
-def delete_partitioning_table():
-	ptable = "/home/svc-satellite-automation/tmp/"+ HOSTNAME + ".ptable"
-	if os.path.exists(ptable):
-		os.remove(ptable)
-
-def create_new_host(client_fqdn,organization,location,hostgroup,puppetenv,*nics):
-	if ( PRIMARY_NIC_IP and PRIMARY_NIC_MAC and SUBNET_ID_PRIMARY_NIC ) and not SECONDARY_NIC_IP:
-		cmd_create_new_host = hammer_cmd + " host create --name " + client_fqdn + " --organization " + organization + " --location " + location + " --hostgroup " + hostgroup + " --ip " + PRIMARY_NIC_IP + " --mac " + PRIMARY_NIC_MAC + " --subnet-id " + SUBNET_ID_PRIMARY_NIC + " --domain " + DOMAIN + " --realm " + REALM + " --environment-id " + puppetenv + " --puppet-ca-proxy " + PUPPET_CA_PROXY + " --puppet-proxy " + PUPPET_PROXY + " --partition-table " + HOSTNAME + "_ptable" + " --operatingsystem " + OS + " --architecture " + ARCHITECTURE + " --medium " + MEDIUM
-	#	print "1. NIC: " + cmd_create_new_host
-	
-	elif ( ( PRIMARY_NIC_IP and PRIMARY_NIC_MAC and SUBNET_ID_PRIMARY_NIC ) and ( SECONDARY_NIC_IP and SECONDARY_NIC_MAC and SUBNET_ID_SECONDARY_NIC )) and not THIRD_NIC_IP:
-		cmd_create_new_host = hammer_cmd + " host create --name " + client_fqdn + " --organization " + organization + " --location " + location + " --hostgroup " + hostgroup + " --ip " + PRIMARY_NIC_IP + " --mac " + PRIMARY_NIC_MAC + " --subnet-id " + SUBNET_ID_PRIMARY_NIC + " --domain " + DOMAIN + " --realm " + REALM + " --environment-id " + puppetenv + " --interface 'type=Nic::Interface,managed=true,mac="+SECONDARY_NIC_MAC+",ip="+SECONDARY_NIC_IP+",subnet_id="+SUBNET_ID_SECONDARY_NIC+",identifier=eth1'" + " --puppet-ca-proxy " + PUPPET_CA_PROXY + " --puppet-proxy " + PUPPET_PROXY + " --partition-table " + HOSTNAME + "_ptable" + " --operatingsystem " + OS + " --architecture " + ARCHITECTURE + " --medium " + MEDIUM
-	#	print "2. NICs: " + cmd_create_new_host
-	
-	elif ( ( PRIMARY_NIC_IP and PRIMARY_NIC_MAC and SUBNET_ID_PRIMARY_NIC ) and ( SECONDARY_NIC_IP and SECONDARY_NIC_MAC and SUBNET_ID_SECONDARY_NIC ) and ( THIRD_NIC_IP and THIRD_NIC_MAC and SUBNET_ID_THIRD_NIC ) ):
-		cmd_create_new_host = hammer_cmd + " host create --name " + client_fqdn + " --organization " + organization + " --location " + location + " --hostgroup " + hostgroup + " --ip " + PRIMARY_NIC_IP + " --mac " + PRIMARY_NIC_MAC + " --subnet-id " + SUBNET_ID_PRIMARY_NIC + " --domain " + DOMAIN + " --realm " + REALM + " --environment-id " + puppetenv + " --interface 'type=Nic::Interface,managed=true,mac="+SECONDARY_NIC_MAC+",ip="+SECONDARY_NIC_IP+",subnet_id="+SUBNET_ID_SECONDARY_NIC+",identifier=eth1'" + " --interface 'type=Nic::Interface,managed=true,mac="+THIRD_NIC_MAC+",ip="+THIRD_NIC_IP+",subnet_id="+SUBNET_ID_THIRD_NIC+",identifier=eth2'" + " --puppet-ca-proxy " + PUPPET_CA_PROXY + " --puppet-proxy " + PUPPET_PROXY + " --partition-table " + HOSTNAME + "_ptable" + " --operatingsystem " + OS + " --architecture " + ARCHITECTURE + " --medium " + MEDIUM
-	#	print "3. NICs: " + cmd_create_new_host 
+def create_new_host(host):
+	primary_nic = host["nics"][0]
+	cmd_create_new_host = hammer_cmd + " host create --name " + host["hostname"] + " --organization " + ORGANIZATION + " --location " + host["location"] + " --hostgroup " + host["hostgroup"] + " --ip " + primary_nic["ip"] + " --mac " + primary_nic["mac"] + " --subnet-id " + primary_nic["subnet_id"] + " --domain " + host["domain"] + " --realm " + REALM + " --environment-id " + host["puppet_env_id"]
+	for nic in host["nics"][1:]:	# eth1 (inguest storage) and eth2 (database replication)
+		cmd_create_new_host = cmd_create_new_host + " --interface 'type=Nic::Interface,managed=true,mac="+nic["mac"]+",ip="+nic["ip"]+",subnet_id="+nic["subnet_id"]+",identifier="+nic["identifier"]+"'"
+	if host["ptable"]:
+		cmd_create_new_host = cmd_create_new_host + " --partition-table " + host["ptable"]
+	cmd_create_new_host = cmd_create_new_host + " --puppet-ca-proxy " + host["puppet_ca_proxy"] + " --puppet-proxy " + host["puppet_proxy"] + " --operatingsystem " + OS + " --architecture " + ARCHITECTURE + " --medium " + MEDIUM
+
+	# Errors are raised, HostCreateQueue tells failed creations from those with unknown outcome
+	if SATELLITE_API:
+		create_new_host_api(host)
+	else:
+		exit_code, output, errors = execute_hammer(cmd_create_new_host)
+		if exit_code != 0:
+			raise HammerError(cmd_create_new_host, exit_code, errors or output)
+
+def create_new_host_api(host):
+	primary_nic = host["nics"][0]
+	attributes = {
+		"name": host["hostname"],
+		"organization_id": api_organization_id(ORGANIZATION),
+		"location_id": SATELLITE_API.resolve_id("/api/locations", host["location"]),
+		"hostgroup_id": SATELLITE_API.resolve_id("/api/hostgroups", host["hostgroup"]),
+		"ip": primary_nic["ip"],
+		"mac": primary_nic["mac"],
+		"subnet_id": int(primary_nic["subnet_id"]),
+		"domain_id": SATELLITE_API.resolve_id("/api/domains", host["domain"]),
+		"realm_id": SATELLITE_API.resolve_id("/api/realms", REALM),
+		"environment_id": int(host["puppet_env_id"]),
+		"puppet_ca_proxy_id": SATELLITE_API.resolve_id("/api/smart_proxies", host["puppet_ca_proxy"]),
+		"puppet_proxy_id": SATELLITE_API.resolve_id("/api/smart_proxies", host["puppet_proxy"]),
+		"operatingsystem_id": SATELLITE_API.resolve_id("/api/operatingsystems", OS, "title"),
+		"architecture_id": SATELLITE_API.resolve_id("/api/architectures", ARCHITECTURE),
+		"medium_id": SATELLITE_API.resolve_id("/api/media", MEDIUM),
+		"interfaces_attributes": [],
+	}
+	if host["ptable"]:
+		attributes["ptable_id"] = SATELLITE_API.resolve_id("/api/ptables", host["ptable"])
+	for nic in host["nics"][1:]:
+		attributes["interfaces_attributes"].append({"type": "interface", "managed": True, "mac": nic["mac"], "ip": nic["ip"], "subnet_id": int(nic["subnet_id"]), "identifier": nic["identifier"]})
+	return SATELLITE_API.create_host(attributes)
+
+def get_record_field(record,*labels):
+	# Value of the first of labels in a "hammer --output=json" record. The labels differ
+	# between hammer versions ("Host Group"/"Host group"), so they are compared case insensitive.
+	if not isinstance(record, dict):
+		return None
+	fields = dict((str(key).lower(), value) for key, value in record.items())
+	for label in labels:
+		if fields.get(label.lower()) not in (None, ""):
+			return fields[label.lower()]
+	return None
+
+def get_proxy_name(proxy_id):
+	row = get_inventory_index("proxy","id").get(str(proxy_id))
+	return row and row["name"] or str(proxy_id)
+
+def get_host_record(client_fqdn):
+	# Reads a host with one call and returns what --update-host compares: {"id", "hostgroup",
+	# "environment", "ptable", "puppet_proxy", "puppet_ca_proxy", "interfaces", "primary"}.
+	# Interfaces are keyed by identifier, the primary one is also stored as "primary" because
+	# hosts created with --ip/--mac have no identifier on it. None if the host does not exist.
+	if SATELLITE_API:
+		result = SATELLITE_API.get_host(client_fqdn)
+		if result is None:
+			return None
+		record = {"id": str(result["id"]), "hostgroup": result.get("hostgroup_title"), "environment": result.get("environment_name"), "ptable": result.get("ptable_name"), "puppet_proxy": result.get("puppet_proxy_name"), "puppet_ca_proxy": result.get("puppet_ca_proxy_name")}
+		interfaces = [(nic.get("id"), nic.get("identifier"), nic.get("ip"), nic.get("mac"), nic.get("primary")) for nic in result.get("interfaces") or []]
+	else:
+		cmd_get_host = hammer_cmd + " --output=json host info --name " + client_fqdn
+		exit_code, output, errors = execute_hammer(cmd_get_host)
+		# 128: hammer could not find the host. hammer shell reports every error as 1, only
+		# its message tells. 65 is a validation error, never a missing host.
+		if exit_code == 128 or (exit_code == 1 and [text for text in ("not found", "could not find") if text in (errors or output).lower()]):
+			return None
+		if exit_code != 0:
+			raise HammerError(cmd_get_host, exit_code, errors or output)
+		result = json.loads(output)
+		puppet_proxy = get_record_field(result, "Puppet Proxy", "Puppet Master Proxy")
+		puppet_ca_proxy = get_record_field(result, "Puppet CA Proxy")
+		if puppet_proxy is None and get_record_field(result, "Puppet Master Id") is not None:
+			puppet_proxy = get_proxy_name(get_record_field(result, "Puppet Master Id"))
+		if puppet_ca_proxy is None and get_record_field(result, "Puppet CA Id") is not None:
+			puppet_ca_proxy = get_proxy_name(get_record_field(result, "Puppet CA Id"))
+		record = {"id": str(get_record_field(result, "Id")), "hostgroup": get_record_field(result, "Host Group"), "environment": get_record_field(result, "Environment", "Puppet Environment"), "ptable": get_record_field(get_record_field(result, "Operating system"), "Partition Table"), "puppet_proxy": puppet_proxy, "puppet_ca_proxy": puppet_ca_proxy}
+		nics = get_record_field(result, "Network interfaces") or []
+		if isinstance(nics, dict):	# older hammer versions number the interfaces: {"1)": {...}}
+			nics = [nic for key, nic in sorted(nics.items())]
+		interfaces = [(get_record_field(nic, "Id"), get_record_field(nic, "Identifier"), get_record_field(nic, "IP address", "IPv4 address"), get_record_field(nic, "MAC address"), "primary" in str(get_record_field(nic, "Type"))) for nic in nics]
+
+	record["interfaces"] = {}
+	record["primary"] = None
+	for nic_id, identifier, ip, mac, primary in interfaces:
+		nic = {"id": str(nic_id), "ip": str(ip or ""), "mac": str(mac or "").lower()}
+		if identifier:
+			record["interfaces"][str(identifier)] = nic
+		if primary:
+			record["primary"] = nic
+	for field in ("hostgroup", "environment", "ptable", "puppet_proxy", "puppet_ca_proxy"):
+		record[field] = str(record[field] or "")
+	return record
+
+def diff_host(host,record):
+	# Compares the requested host with its current record. Returns the changes as
+	# [(field, current, requested)] and the interface attributes of the update.
+	changes = []
+	requested = {
+		"hostgroup": host["hostgroup"],
+		"environment": get_puppet_environment_name(DEFAULT_CONTENT_VIEW, host["environment"]),
+		"ptable": host["ptable"],
+		"puppet_proxy": host["puppet_proxy"],
+		"puppet_ca_proxy": host["puppet_ca_proxy"],
+	}
+	current = dict(record)
+	current["hostgroup"] = record["hostgroup"].split("/")[-1]	# the host shows the title of its hostgroup
+	for field in ("hostgroup", "environment", "ptable", "puppet_proxy", "puppet_ca_proxy"):
+		if requested[field] and requested[field] != current[field]:
+			changes.append((field, current[field], requested[field]))
+
+	interfaces = []
+	for nic in host["nics"]:
+		current_nic = record["interfaces"].get(nic["identifier"])
+		if nic is host["nics"][0] and record["primary"]:
+			current_nic = record["primary"]
+		if current_nic is None:
+			changes.append(("interface " + nic["identifier"], "", nic["ip"] + " " + nic["mac"]))
+			interfaces.append({"type": "interface", "managed": True, "mac": nic["mac"], "ip": nic["ip"], "subnet_id": int(nic["subnet_id"]), "identifier": nic["identifier"]})
+		elif current_nic["ip"] != nic["ip"] or current_nic["mac"] != nic["mac"].lower():
+			changes.append(("interface " + nic["identifier"], current_nic["ip"] + " " + current_nic["mac"], nic["ip"] + " " + nic["mac"]))
+			interfaces.append({"id": int(current_nic["id"]), "mac": nic["mac"], "ip": nic["ip"], "subnet_id": int(nic["subnet_id"])})
+	return changes, interfaces
+
+INTERFACE_FIELDS = ("id", "type", "managed", "mac", "ip", "subnet_id", "identifier")
+
+def update_existing_host(host,record,fields,interfaces):
+	# One update call with only the fields that differ
+	cmd_update_host = hammer_cmd + " host update --id " + record["id"]
+	if "hostgroup" in fields:
+		cmd_update_host = cmd_update_host + " --hostgroup " + host["hostgroup"]
+	if "environment" in fields:
+		cmd_update_host = cmd_update_host + " --environment-id " + host["puppet_env_id"]
+	if "ptable" in fields:
+		cmd_update_host = cmd_update_host + " --partition-table " + host["ptable"]
+	if "puppet_proxy" in fields:
+		cmd_update_host = cmd_update_host + " --puppet-proxy " + host["puppet_proxy"]
+	if "puppet_ca_proxy" in fields:
+		cmd_update_host = cmd_update_host + " --puppet-ca-proxy " + host["puppet_ca_proxy"]
+	for nic in interfaces:
+		values = {"type": "Nic::Interface", "managed": "true"}
+		cmd_update_host = cmd_update_host + " --interface '" + ",".join([field + "=" + str(values.get(field, nic[field])) for field in INTERFACE_FIELDS if field in nic]) + "'"
 
 	try:
-               	perform_cmd = subprocess.Popen(cmd_create_new_host, shell=True, stdout=subprocess.PIPE)
-               	childhostgroup = perform_cmd.stdout.read()
+		if SATELLITE_API:
+			attributes = {}
+			if "hostgroup" in fields:
+				attributes["hostgroup_id"] = SATELLITE_API.resolve_id("/api/hostgroups", host["hostgroup"])
+			if "environment" in fields:
+				attributes["environment_id"] = int(host["puppet_env_id"])
+			if "ptable" in fields:
+				attributes["ptable_id"] = SATELLITE_API.resolve_id("/api/ptables", host["ptable"])
+			if "puppet_proxy" in fields:
+				attributes["puppet_proxy_id"] = SATELLITE_API.resolve_id("/api/smart_proxies", host["puppet_proxy"])
+			if "puppet_ca_proxy" in fields:
+				attributes["puppet_ca_proxy_id"] = SATELLITE_API.resolve_id("/api/smart_proxies", host["puppet_ca_proxy"])
+			if interfaces:
+				attributes["interfaces_attributes"] = interfaces
+			SATELLITE_API.update_host(record["id"], attributes)
+		else:
+			exit_code, output = run_hammer(cmd_update_host)
+			if exit_code != 0:
+				raise HammerError(cmd_update_host, exit_code)
+		invalidate_inventory_cache("host")
+		if interfaces:
+			record_host(host, record["id"])
 
- 	except:
-               	print log.ERROR + "ERROR: could not create host " + client_fqdn + log.END
-               	sys.exit(1)
+	except:
+		print log.ERROR + "ERROR: could not update host " + host["client_fqdn"] + log.END
+		sys.exit(1)
 
-def get_host_iso():
-	cmd_get_host_iso = hammer_cmd + " bootdisk host --host " + CLIENT_FQDN + " --file " + NFS_HOST_ISO_STORE + HOSTNAME + ".iso"
-        try:
-                perform_cmd = subprocess.Popen(cmd_get_host_iso, shell=True, stdout=subprocess.PIPE)
-                hostiso = perform_cmd.stdout.read()
+def update_host(host):
+	# --update-host: reads the host once, compares hostgroup, puppet environment, partition
+	# table, puppet proxies and network interfaces with the requested values and sends one
+	# update with the differences. Hosts that already match are not touched.
+	set_phase("host update")
+	try:
+		record = get_host_record(host["client_fqdn"])
+	except:
+		print log.ERROR + "ERROR: could not read host " + host["client_fqdn"] + " from Satellite" + log.END
+		sys.exit(1)
+	if record is None:
+		print log.ERROR + "ERROR: host " + host["client_fqdn"] + " is not present on Satellite. If you want to create it, please run this script again with option --create-host." + log.END
+		sys.exit(1)
 
-        except:
-                print log.ERROR + "ERROR: could not download host iso from satellite to " + NFS_HOST_ISO_STORE + log.END
-                sys.exit(1)
+	changes, interfaces = diff_host(host, record)
+	if not changes:
+		print log.INFO + "INFO: host " + host["client_fqdn"] + " is up to date." + log.END
+		return "up to date"
+	for field, current, requested in changes:
+		print log.INFO + "INFO: " + host["client_fqdn"] + ": " + field + " " + (current or "(none)") + " -> " + requested + log.END
+	fields = [field for field, current, requested in changes]
+	update_existing_host(host, record, fields, interfaces)
+	if "interface " + host["nics"][0]["identifier"] in fields:	# the boot ISO carries the network configuration of the primary NIC
+		queue_host_iso(host)
+	return "updated"
+
+def iter_hosts(search=None):
+	if SATELLITE_API:
+		return iter(parse_inventory(get_api_inventory("host",search=search)))
+	if search is None:
+		return stream_hammer_csv(get_inventory_command("host"))
+	return stream_hammer_csv(hammer_cmd + " --csv host list --search " + pipes.quote(search))
+
+def set_host_parameter(host_id,name,value):
+	cmd_set_parameter = hammer_cmd + " host set-parameter --host-id " + host_id + " --name " + pipes.quote(name) + " --value " + pipes.quote(value)
+	if SATELLITE_API:
+		SATELLITE_API.set_host_parameter(host_id, name, value)
+		return
+	exit_code, output = run_hammer(cmd_set_parameter)
+	if exit_code != 0:
+		raise HammerError(cmd_set_parameter, exit_code)
+
+def set_host_hostgroup(host_id,hostgroup):
+	cmd_update_host = hammer_cmd + " host update --id " + host_id + " --hostgroup " + hostgroup
+	if SATELLITE_API:
+		SATELLITE_API.update_host(host_id, {"hostgroup_id": SATELLITE_API.resolve_id("/api/hostgroups", hostgroup)})
+		return
+	exit_code, output = run_hammer(cmd_update_host)
+	if exit_code != 0:
+		raise HammerError(cmd_update_host, exit_code)
+
+def bulk_update_hosts(search,hostgroup,parameters,workers):
+	# Moves all hosts matching a Satellite search to hostgroup and/or sets host parameters
+	# [(name, value)] on them. One host list finds the hosts and their hostgroups, one more
+	# list per parameter finds the hosts that already have its value, so only hosts that
+	# really change cost a call. Returns [(host, result)] like provision_hosts().
+	set_phase("host update")
+	if hostgroup and not verify_child_hostgroup(hostgroup):
+		print log.ERROR + "ERROR: hostgroup " + hostgroup + " is not present on Satellite." + log.END
+		sys.exit(1)
+	try:
+		hosts = list(iter_hosts(search))
+		if not hosts:
+			print log.WARN + "WARNING: no host matches " + search + log.END
+			return []
+		pending = dict((row["id"], []) for row in hosts)
+		if hostgroup:
+			for row in hosts:
+				if row.get("host group", "").split("/")[-1] != hostgroup:
+					pending[row["id"]].append(("hostgroup", hostgroup))
+		for name, value in parameters:
+			done = set([row["id"] for row in iter_hosts("(" + search + ") and params." + name + ' = "' + value.replace('"', '\\"') + '"')])
+			for row in hosts:
+				if row["id"] not in done:
+					pending[row["id"]].append(("parameter", (name, value)))
+	except:
+		print log.ERROR + "ERROR: could not list the hosts matching " + search + log.END
+		sys.exit(1)
+	print log.INFO + "INFO: " + str(len(hosts)) + " hosts match " + search + ", " + str(len([row for row in hosts if pending[row["id"]]])) + " of them need a change." + log.END
+
+	results = {}
+	host_queue = Queue.Queue()
+	for row in hosts:
+		if pending[row["id"]]:
+			host_queue.put(row)
+		else:
+			results[row["id"]] = "up to date"
+
+	def update_worker():
+		set_phase("host update")
+		while True:
+			try:
+				row = host_queue.get_nowait()
+			except Queue.Empty:
+				return
+			try:
+				for change, value in pending[row["id"]]:
+					if change == "hostgroup":
+						set_host_hostgroup(row["id"], value)
+					else:
+						set_host_parameter(row["id"], value[0], value[1])
+				results[row["id"]] = "updated"
+			except Exception as e:
+				print log.ERROR + "ERROR: could not update host " + row["name"] + ": " + str(e) + log.END
+				results[row["id"]] = "failed"
+
+	threads = []
+	for i in range(max(1, min(workers, host_queue.qsize()))):
+		thread = threading.Thread(target=update_worker, name="update-" + str(i))
+		thread.daemon = True
+		thread.start()
+		threads.append(thread)
+	for thread in threads:
+		while thread.is_alive():
+			thread.join(1)
+	if [change for row in hosts for change, value in pending[row["id"]] if change == "hostgroup"]:
+		invalidate_inventory_cache("host")
+	return [(row["name"], results.get(row["id"], "failed")) for row in hosts]
+
+def get_file_checksum(path):
+	checksum = hashlib.sha256()
+	with open(path, 'rb') as checked_file:
+		for chunk in iter(lambda: checked_file.read(1024*1024), ''):
+			checksum.update(chunk)
+	return checksum.hexdigest()
+
+def write_host_iso(client_fqdn,iso):
+	# Renders the boot ISO into a temporary file next to the final one (same filesystem),
+	# flushes it to disk, writes <iso>.sha256 and only then renames it into place. A crash
+	# leaves a hidden ".<name>.part" file behind, never a truncated <HOSTNAME>.iso.
+	iso_dir, iso_name = os.path.split(iso)
+	tmp_fd, tmp_iso = tempfile.mkstemp(prefix="." + iso_name + ".", suffix=".part", dir=iso_dir or ".")
+	tmp_checksum = None
+	try:
+		with os.fdopen(tmp_fd, 'wb') as iso_file:
+			if SATELLITE_API:
+				SATELLITE_API.bootdisk_host(client_fqdn, iso_file)
+		if not SATELLITE_API:
+			cmd_get_host_iso = hammer_cmd + " bootdisk host --host " + client_fqdn + " --file " + tmp_iso
+			exit_code, hostiso = run_hammer(cmd_get_host_iso, use_shell=False)
+			if exit_code != 0:
+				raise HammerError(cmd_get_host_iso, exit_code)
+		if os.path.getsize(tmp_iso) == 0:
+			raise IOError("boot ISO for " + client_fqdn + " is empty")
+		with open(tmp_iso, 'rb+') as iso_file:
+			os.fsync(iso_file.fileno())
+		os.chmod(tmp_iso, 0644)		# mkstemp creates 0600, the ISO has to be readable for the hypervisor
+		checksum = get_file_checksum(tmp_iso)
+
+		tmp_fd, tmp_checksum = tempfile.mkstemp(prefix="." + iso_name + ".", suffix=".sha256.part", dir=iso_dir or ".")
+		with os.fdopen(tmp_fd, 'w') as checksum_file:
+			checksum_file.write(checksum + "  " + iso_name + "\n")
+		os.chmod(tmp_checksum, 0644)
+		os.rename(tmp_checksum, iso + ".sha256")
+		os.rename(tmp_iso, iso)
+		return checksum
+	except:
+		for tmp_file in (tmp_iso, tmp_checksum):
+			if tmp_file and os.path.exists(tmp_file):
+				os.remove(tmp_file)
+		raise
+
+class IsoJob(object):
+	# Handle for one queued boot ISO. done() polls, wait() blocks until the ISO is in place
+	# (or failed) and returns True on success.
+	def __init__(self, client_fqdn, iso, callback=None):
+		self.client_fqdn = client_fqdn
+		self.iso = iso
+		self.callback = callback
+		self.state = "queued"
+		self.checksum = None
+		self.error = None
+		self.finished = threading.Event()
+
+	def done(self):
+		return self.finished.is_set()
+
+	def wait(self, timeout=None):
+		while not self.finished.is_set():
+			self.finished.wait(1 if timeout is None else timeout)	# wait with timeout, otherwise Ctrl-C is not delivered in Python 2
+			if timeout is not None:
+				break
+		return self.state == "done"
+
+class IsoQueue(object):
+	# Boot ISOs are rendered in the background by at most "workers" threads, so provisioning
+	# continues while Satellite renders and NFS writes. Threads are started on first use.
+	def __init__(self, workers):
+		self.workers = workers
+		self.queue = Queue.Queue()
+		self.jobs = []
+		self.threads = []
+		self.lock = threading.Lock()
+
+	def submit(self, client_fqdn, iso, callback=None):
+		job = IsoJob(client_fqdn, iso, callback)
+		with self.lock:
+			self.jobs.append(job)
+			if len(self.threads) < self.workers:
+				thread = threading.Thread(target=self.worker, name="iso-" + str(len(self.threads)))
+				thread.daemon = True
+				thread.start()
+				self.threads.append(thread)
+		self.queue.put(job)
+		return job
+
+	def worker(self):
+		set_phase("iso")
+		while True:
+			job = self.queue.get()
+			job.state = "running"
+			try:
+				job.checksum = write_host_iso(job.client_fqdn, job.iso)
+				job.state = "done"
+				print log.INFO + "INFO: boot ISO " + job.iso + " written (sha256 " + job.checksum + ")." + log.END
+			except Exception as e:
+				job.error = str(e)
+				job.state = "failed"
+				print log.ERROR + "ERROR: could not download host iso for " + job.client_fqdn + " from satellite to " + NFS_HOST_ISO_STORE + ": " + job.error + log.END
+			if job.callback:
+				try:
+					job.callback(job)
+				except Exception:
+					print log.ERROR + "ERROR: boot ISO callback for " + job.client_fqdn + " failed:\n" + traceback.format_exc() + log.END
+			job.finished.set()
+
+	def wait(self):
+		# Waits for all submitted ISOs, returns the failed jobs
+		for job in list(self.jobs):
+			job.wait()
+		return [job for job in self.jobs if job.state == "failed"]
+
+	def forget_finished(self):
+		# Drops finished jobs, used by --serve where the queue lives as long as the process
+		with self.lock:
+			self.jobs = [job for job in self.jobs if not job.done()]
+
+ISO_QUEUE = None
+ISO_QUEUE_LOCK = threading.Lock()
+
+def get_host_iso(client_fqdn,hostname,callback=None):
+	# Queues the boot ISO and returns its IsoJob handle, callback(job) runs when it is finished
+	global ISO_QUEUE
+	with ISO_QUEUE_LOCK:
+		if ISO_QUEUE is None:		# imported as a library, main() did not create the queue
+			ISO_QUEUE = IsoQueue(2)
+	return ISO_QUEUE.submit(client_fqdn, NFS_HOST_ISO_STORE + hostname + ".iso", callback)
+
+class HostCreateJob(IsoJob):
+	# Handle for one submitted host creation, states queued, running, pending (outcome
+	# unknown, checked on Satellite), done, present (created by someone else first) and failed
+	def __init__(self, host, callback=None):
+		IsoJob.__init__(self, host["client_fqdn"], None, callback)
+		self.host = host
+		self.deadline = None
+
+def is_unknown_create_error(error):
+	# True if Satellite may still create the host although the call failed: the connection
+	# timed out or broke while Satellite was running the orchestration (DNS, DHCP, realm).
+	# Any other error message (validation, duplicate name, ...) means the host was not created.
+	if isinstance(error, HammerError):
+		if error.exit_code in HAMMER_FINAL_EXIT_CODES:
+			return False
+		if not error.errors.strip():		# hammer died without a word
+			return True
+		return is_transient_error(error.errors) and not is_transient_error(error.errors, read=False)
+	if isinstance(error, SatelliteAPIError):
+		return error.status in (502, 504)
+	if isinstance(error, socket.error):
+		return getattr(error, "errno", None) != errno.ECONNREFUSED
+	return isinstance(error, httplib.HTTPException)
+
+class HostCreateQueue(object):
+	# Hosts are created in the background by at most "workers" threads, so provisioning goes
+	# on with the next host while Satellite runs the orchestration of this one. A creation
+	# whose outcome is unknown (see is_unknown_create_error()) is not retried but pending:
+	# one thread looks up all pending hosts with a single host search every
+	# HOST_CREATE_POLL_INTERVAL seconds until they exist or HOST_CREATE_TIMEOUT has passed.
+	# callback(job) runs when a job is finished, e.g. to queue the boot ISO.
+	def __init__(self, workers):
+		self.workers = workers
+		self.queue = Queue.Queue()
+		self.jobs = []
+		self.pending = {}
+		self.threads = []
+		self.poller = None
+		self.lock = threading.Lock()
+
+	def submit(self, host, callback=None):
+		job = HostCreateJob(host, callback)
+		with self.lock:
+			self.jobs.append(job)
+			if len(self.threads) < self.workers:
+				thread = threading.Thread(target=self.worker, name="create-" + str(len(self.threads)))
+				thread.daemon = True
+				thread.start()
+				self.threads.append(thread)
+		self.queue.put(job)
+		return job
+
+	def worker(self):
+		set_phase("host create")
+		while True:
+			job = self.queue.get()
+			job.state = "running"
+			try:
+				create_new_host(job.host)
+			except Exception as e:
+				job.error = isinstance(e, HammerError) and "hammer exit code " + str(e.exit_code) or str(e) or e.__class__.__name__
+				if is_unknown_create_error(e):
+					self.add_pending(job)
+					continue
+				if find_concurrent_host(job.client_fqdn):
+					self.finish(job, "present")
+					continue
+				print log.ERROR + "ERROR: could not create host " + job.client_fqdn + ": " + job.error + log.END
+				self.finish(job, "failed")
+				continue
+			self.finish(job, "done")
+
+	def add_pending(self, job):
+		print log.WARN + "WARNING: creating host " + job.client_fqdn + " did not finish (" + job.error + "), checking Satellite every " + str(HOST_CREATE_POLL_INTERVAL) + "s whether it was created." + log.END
+		with self.lock:
+			job.state = "pending"
+			job.deadline = time.time() + HOST_CREATE_TIMEOUT
+			self.pending[job.client_fqdn] = job
+			if self.poller is None:
+				self.poller = threading.Thread(target=self.poll, name="create-poll")
+				self.poller.daemon = True
+				self.poller.start()
+
+	def poll(self):
+		set_phase("host create")
+		while True:
+			time.sleep(HOST_CREATE_POLL_INTERVAL)
+			with self.lock:
+				pending = self.pending.values()
+			if not pending:
+				continue
+			try:
+				created = find_existing_hosts([job.client_fqdn for job in pending])
+			except Exception as e:
+				print log.WARN + "WARNING: could not look up pending hosts on Satellite: " + str(e) + log.END
+				created = set()
+			for job in pending:
+				if job.client_fqdn in created:
+					print log.INFO + "INFO: host " + job.client_fqdn + " was created." + log.END
+					self.finish(job, "done")
+				elif time.time() > job.deadline:
+					print log.ERROR + "ERROR: host " + job.client_fqdn + " was not created within " + str(HOST_CREATE_TIMEOUT) + "s (" + job.error + ")." + log.END
+					self.finish(job, "failed")
+
+	def finish(self, job, state):
+		with self.lock:
+			self.pending.pop(job.client_fqdn, None)
+		job.state = state
+		if state in ("done", "present"):
+			job.error = None
+		if job.callback:
+			try:
+				job.callback(job)
+			except Exception:
+				print log.ERROR + "ERROR: host create callback for " + job.client_fqdn + " failed:\n" + traceback.format_exc() + log.END
+		job.finished.set()
+
+	def wait(self):
+		# Waits for all submitted hosts, returns the failed jobs
+		for job in list(self.jobs):
+			job.wait()
+		return [job for job in self.jobs if job.state == "failed"]
+
+	def forget_finished(self):
+		with self.lock:
+			self.jobs = [job for job in self.jobs if not job.done()]
+
+def find_concurrent_host(client_fqdn):
+	# The host index trusts a missing host for up to INVENTORY_CACHE_TTL["host"] seconds, so
+	# a host created by another run or in the UI meanwhile fails "host create" with a taken
+	# name. Returns True if the host exists on Satellite now; its row is put into the index.
+	try:
+		row = search_inventory("host", 'name = "' + client_fqdn + '"', lambda row: row.get("name") == client_fqdn)
+		if row is None:
+			return False
+		index = get_host_index()
+		if index:
+			index.store([row], time.time())
+	except Exception as e:
+		print log.WARN + "WARNING: could not look up host " + client_fqdn + " on Satellite: " + str(e) + log.END
+		return False
+	print log.INFO + "INFO: host " + client_fqdn + " is already present on Satellite, it was created in the meantime. Maybe you want to update the host? If yes, please run this script again with option --update-host instead of --create-host." + log.END
+	return True
+
+def find_existing_hosts(names):
+	# FQDNs out of names that exist on Satellite, one host search per 50 names
+	found = set()
+	for start in range(0, len(names), 50):
+		search = " or ".join(['name = "' + name + '"' for name in names[start:start + 50]])
+		for row in iter_hosts(search):
+			found.add(row.get("name"))
+	return found
+
+HOST_CREATE_QUEUE = None
+HOST_CREATE_QUEUE_LOCK = threading.Lock()
+
+def get_host_create_queue():
+	global HOST_CREATE_QUEUE
+	with HOST_CREATE_QUEUE_LOCK:
+		if HOST_CREATE_QUEUE is None:		# imported as a library, main() did not create the queue
+			HOST_CREATE_QUEUE = HostCreateQueue(4)
+	return HOST_CREATE_QUEUE
+
+def get_host_result(result):
+	# provision_host() returns the HostCreateJob of a host that is being created
+	if isinstance(result, HostCreateJob):
+		result.wait()
+		return {"done": "created", "present": "already present"}.get(result.state, "failed")
+	return result
+
+def parse_ipv4(address):
+	# "10.1.1.5" -> 167837957. Python 2 has no ipaddress module, addresses are compared as
+	# 32 bit integers.
+	parts = str(address).strip().split(".")
+	if len(parts) != 4 or [part for part in parts if not part.isdigit() or int(part) > 255]:
+		raise ValueError(str(address) + " is not a valid IPv4 address")
+	return (int(parts[0]) << 24) | (int(parts[1]) << 16) | (int(parts[2]) << 8) | int(parts[3])
+
+def format_ipv4(value):
+	return ".".join([str(value >> shift & 255) for shift in (24, 16, 8, 0)])
+
+def prefix_to_netmask(prefix):
+	return (0xffffffff << (32 - prefix)) & 0xffffffff
+
+def parse_netmask(mask):
+	# "255.255.255.0" or "24" -> (netmask, prefix length)
+	mask = str(mask).strip().lstrip("/")
+	if mask.isdigit() and int(mask) <= 32:
+		return prefix_to_netmask(int(mask)), int(mask)
+	netmask = parse_ipv4(mask)
+	prefix = bin(netmask).count("1")
+	if netmask != prefix_to_netmask(prefix):
+		raise ValueError(mask + " is not a valid subnet mask")
+	return netmask, prefix
+
+class SubnetIndex(object):
+	# Satellite subnets by prefix length and network address. find() returns the most specific
+	# subnet that contains an IP, with one hash lookup per prefix length in use (longest
+	# first), instead of comparing network strings.
+	def __init__(self, rows):
+		self.networks = {}
+		for row in rows:
+			try:
+				netmask, prefix = parse_netmask(row.get("mask"))
+				network = parse_ipv4(row.get("network")) & netmask
+			except ValueError:
+				continue	# e.g. IPv6 subnets
+			self.networks.setdefault(prefix, {}).setdefault(network, row)
+		self.prefixes = sorted(self.networks, reverse=True)
+
+	def find(self, ip):
+		address = parse_ipv4(ip)
+		for prefix in self.prefixes:
+			row = self.networks[prefix].get(address & prefix_to_netmask(prefix))
+			if row:
+				return row
+		return None
+
+def get_subnet_index():
+	return get_cached_index("subnet",None,None,SubnetIndex)
+
+def get_nic_network(nic,option):
+	# Checks the addresses of a NIC and returns (network, mask): the network is derived from
+	# IP and mask if it is omitted, both are None if neither is given (they are then taken
+	# from the Satellite subnet that contains the IP, see locate_nic_subnet()).
+	def parse(field, parse_value):
+		try:
+			return parse_value(nic[field])
+		except ValueError as e:
+			raise ValueError(option + "-" + field + ": " + str(e))
+	address = parse("ip", parse_ipv4)
+	if nic["network"]:
+		network = parse("network", parse_ipv4)
+	if not nic["mask"]:
+		return nic["network"], None
+	netmask, prefix = parse("mask", parse_netmask)
+	if nic["network"] and network & netmask != network:
+		raise ValueError(option + "-network " + nic["network"] + " is not a network address for mask " + nic["mask"])
+	if nic["network"] and address & netmask != network:
+		raise ValueError(option + "-ip " + nic["ip"] + " is not in network " + nic["network"] + "/" + str(prefix))
+	return format_ipv4(address & netmask), format_ipv4(netmask)
+
+def locate_nic_subnet(nic):
+	# NICs given without network and mask belong to the Satellite subnet that contains their IP
+	try:
+		subnet = get_subnet_index().find(nic["ip"])
+	except:
+		print log.ERROR + "ERROR: could not read the subnets from Satellite." + log.END
+		sys.exit(1)
+	if subnet is None:
+		print log.ERROR + "ERROR: no Satellite subnet contains IP address " + nic["ip"] + " of " + nic["identifier"] + ". Please pass the network and mask of the interface to create the subnet." + log.END
+		sys.exit(1)
+	nic["network"], nic["mask"] = subnet["network"], subnet["mask"]
+	return subnet
+
+def get_nic_subnet_error(nic,subnet):
+	# NICs given with network but without mask: the IP has to be in the Satellite subnet of
+	# that network, which get_nic_network() could not check without the mask
+	netmask, prefix = parse_netmask(subnet["mask"])
+	if parse_ipv4(nic["ip"]) & netmask != parse_ipv4(nic["network"]) & netmask:
+		return "IP address " + nic["ip"] + " of " + nic["identifier"] + " is not in subnet " + nic["network"] + "/" + str(prefix)
+	return None
+
+def verify_nic_network(nic):
+	# Checks a NIC given with network but without mask against the Satellite subnet of the
+	# network and takes its mask. A missing subnet is left to ensure_subnet().
+	try:
+		subnet = get_inventory_index("subnet","network").get(nic["network"])
+		error = subnet and get_nic_subnet_error(nic, subnet)
+	except:
+		print log.ERROR + "ERROR: could not read the subnets from Satellite." + log.END
+		sys.exit(1)
+	if error:
+		print log.ERROR + "ERROR: " + error + ". Please check the IP address and network of the interface." + log.END
+		sys.exit(1)
+	if subnet:
+		nic["mask"] = subnet["mask"]
 
 def get_subnet_id(network):
 	SUBNET = str(network)
-        cmd_get_subnet_id = hammer_cmd + " --csv subnet list"
         try:
-                perform_cmd = subprocess.Popen(cmd_get_subnet_id, shell=True, stdout=subprocess.PIPE)
-                subnet_id = perform_cmd.stdout.read()
-                for line in  islice(subnet_id.strip().split("\n"), 1, None):        # print output without CSV header
-                        if SUBNET in line:
-                                return line.split(",")[0]
-				break
+                return get_inventory_index("subnet","network")[SUBNET]["id"]
 
         except:
                 print log.ERROR + "ERROR: subnet id not found. Please ensure that the needed subnet " + SUBNET + " is configured properly in Satellite." + log.END
@@ -287,54 +2416,54 @@ def get_subnet_id(network):
 
 def verify_subnet(network):
 	SUBNET = str(network)
-        cmd_verify_subnet = hammer_cmd + " --csv subnet list"
         try:
-                perform_cmd = subprocess.Popen(cmd_verify_subnet, shell=True, stdout=subprocess.PIPE)
-                subnet_id = perform_cmd.stdout.read()
-                for line in  islice(subnet_id.strip().split("\n"), 1, None):        # print output without CSV header
-                        if SUBNET in line:
-                                return True
-				break
+                return SUBNET in get_inventory_index("subnet","network")
 
         except:
                 print log.ERROR + "ERROR: subnet not found. Please ensure that the needed subnet " + SUBNET + " is configured properly in Satellite." + log.END
 
-def create_subnet(network,mask,gateway):
+def create_subnet(network,mask,gateway,domain):
 	SUBNET = str(network)
-        cmd_create_subnet = hammer_cmd + " subnet create --boot-mode Static --domains " + DOMAIN + " --locations " + SATELLITE_LOCATIONS + " --name " + SUBNET + " --network " + SUBNET + " --mask " + mask + " --gateway " + gateway +" --organizations " + ORGANIZATION + " --dns-primary " + DNS_PRIMARY + " --ipam None"
+        cmd_create_subnet = hammer_cmd + " subnet create --boot-mode Static --domains " + domain + " --locations " + CONFIG.satellite_locations + " --name " + SUBNET + " --network " + SUBNET + " --mask " + mask + " --gateway " + gateway +" --organizations " + ORGANIZATION + " --dns-primary " + DNS_PRIMARY + " --ipam None"
         try:
-                perform_cmd = subprocess.Popen(cmd_create_subnet, shell=True, stdout=subprocess.PIPE)
-                subnet_id = perform_cmd.stdout.read()
+                if SATELLITE_API:
+                        SATELLITE_API.create_subnet({"name": SUBNET, "network": SUBNET, "mask": mask, "gateway": gateway, "dns_primary": DNS_PRIMARY, "boot_mode": "Static", "ipam": "None", "domain_ids": [SATELLITE_API.resolve_id("/api/domains", domain)], "location_ids": api_location_ids(CONFIG.satellite_locations), "organization_ids": [api_organization_id(ORGANIZATION)]})
+                else:
+                        exit_code, subnet_id = run_hammer(cmd_create_subnet)
+                        if exit_code != 0:
+                                raise HammerError(cmd_create_subnet, exit_code)
+                invalidate_inventory_cache("subnet")
 
         except:
                 print log.ERROR + "ERROR: subnet id not found. Please ensure that the needed subnet " + SUBNET + " is configured properly in Satellite." + log.END
                 sys.exit(1)
 
-def get_environment_id(default_ccv):
+def get_puppet_environment_name(default_ccv,environment):
 	translation_table = string.maketrans('-','_')
-	CONVERT_CCV = DEFAULT_CONTENT_VIEW.translate(translation_table)
+	CONVERT_CCV = default_ccv.translate(translation_table)
 	CONVERT_ORGANIZATION = ORGANIZATION.translate(translation_table)
-	PUPPET_ENV = str("KT_" + CONVERT_ORGANIZATION + "_" + ENVIRONMENT + "_" + CONVERT_CCV)
+	return str("KT_" + CONVERT_ORGANIZATION + "_" + environment + "_" + CONVERT_CCV)
+
+def get_environment_id(default_ccv,environment):
+	PUPPET_ENV = get_puppet_environment_name(default_ccv,environment)
 
-        cmd_get_environment_id = hammer_cmd + " --csv environment list"
         try:
-                perform_cmd = subprocess.Popen(cmd_get_environment_id, shell=True, stdout=subprocess.PIPE)
-                puppet_env_id = perform_cmd.stdout.read()
-                for line in  islice(puppet_env_id.strip().split("\n"), 1, None):        # print output without CSV header
-                        if PUPPET_ENV in line:
-                                return line.split(",")[0]
-				break
+                return get_inventory_index("environment","name")[PUPPET_ENV]["id"]
 
         except:
                 print log.ERROR + "ERROR: Puppet environment id not found. Please ensure that the Puppet environment " + PUPPET_ENV + " is configured properly in Satellite." + log.END
                 sys.exit(1)
 
-def update_child_hostgroup(childhg):
-	cmd_update_childhg = hammer_cmd + " hostgroup set-parameter --name kt_activation_keys --value " + DEFAULT_ACTIVATION_KEY + " --hostgroup " + childhg
+def update_child_hostgroup(childhg,activation_key):
+	cmd_update_childhg = hammer_cmd + " hostgroup set-parameter --name kt_activation_keys --value " + activation_key + " --hostgroup " + childhg
 
 	try:
-		perform_cmd = subprocess.Popen(cmd_update_childhg, shell=True, stdout=subprocess.PIPE)
-		update_childhostgroup = perform_cmd.stdout.read()
+		if SATELLITE_API:
+			SATELLITE_API.set_hostgroup_parameter(childhg, "kt_activation_keys", activation_key)
+		else:
+			exit_code, update_childhostgroup = run_hammer(cmd_update_childhg)
+			if exit_code != 0:
+				raise HammerError(cmd_update_childhg, exit_code)
 
 	except:
 		print log.ERROR + "ERROR: could not update child hostgroup " + childhg + log.END
@@ -342,17 +2471,37 @@ def update_child_hostgroup(childhg):
 
 def kerberos_destroy_ticket():
     try:
-        subprocess.check_call(cmd_kdestroy, shell=True, stdout=subprocess.PIPE)
+        exit_code, output = run_command(cmd_kdestroy)
     except:
         return False
-    return True
+    return exit_code == 0
 
 def get_kerberos_login_status():
     try:
-        subprocess.check_call(cmd_klist, shell=True, stdout=subprocess.PIPE)
+        exit_code, output = run_command(cmd_klist)
     except:
         return False
-    return True
+    return exit_code == 0
+
+def get_kerberos_ticket_expiry():
+    # Returns the expiry time (epoch) of the TGT in the current credential cache or None.
+    # klist is run with LC_ALL=C so the date format does not depend on the locale.
+    environment = dict(os.environ, LC_ALL="C")
+    try:
+        exit_code, output = run_command(cmd_klist, env=environment, stderr=devnull)
+    except OSError:
+        return None
+    if exit_code != 0:
+        return None
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) >= 5 and fields[4].startswith("krbtgt/"):
+            for date_format in ("%m/%d/%y %H:%M:%S", "%m/%d/%Y %H:%M:%S"):
+                try:
+                    return time.mktime(time.strptime(fields[2] + " " + fields[3], date_format))
+                except ValueError:
+                    pass
+    return None
 
 def verify_ipa_users_home(user):
     if os.path.exists("/home/"+ user):
@@ -364,7 +2513,7 @@ def get_keytab(user,kdc,keytab):
     cmd_build_get_keytab = cmd_getkeytab + " -s " + kdc + " -p " + user + " -k " + keytab
     print cmd_build_get_keytab
     try:
-        subprocess.call(cmd_build_get_keytab, shell=True, stdout=subprocess.PIPE)
+        run_command(cmd_build_get_keytab)
     except:
         print log.ERROR + "ERROR: error getting users keytab. Please check your IPA settings." + log.END
         sys.exit(1)
@@ -372,7 +2521,7 @@ def get_keytab(user,kdc,keytab):
 def get_ticket(user):
     cmd_build_get_ticket = cmd_kinit + " " + user
     try:
-        subprocess.call(cmd_build_get_ticket, shell=True, stdout=subprocess.PIPE)
+        run_command(cmd_build_get_ticket)
     except:
         print log.ERROR + "ERROR: error getting Kerberos ticket. Please check your IPA settings." + log.END
         sys.exit(1)
@@ -380,30 +2529,33 @@ def get_ticket(user):
 def ipa_connect_with_keytab(principal,keytab):
     cmd_connect_with_keytab = cmd_kinit + " -k -t " + keytab + " " + principal
     try:
-        subprocess.call(cmd_connect_with_keytab, shell=True, stdout=subprocess.PIPE)
+        run_command(cmd_connect_with_keytab)
     except:
         print log.ERROR + "ERROR: connection to IPA via keytab did not work." + log.END
         sys.exit(1)
 
 def get_ipa_hostgroup(hostgroup):
+    if IPA_API:
+        try:
+            if IPA_API.find_hostgroup(hostgroup):
+                return 0
+            return 1
+        except (IPAError, httplib.HTTPException, socket.error, ValueError) as e:
+            print log.ERROR + "ERROR: could not search IPA hostgroup " + hostgroup + ": " + str(e) + log.END
+            sys.exit(1)
     cmd_build_cmd_get_ipahostgroup = cmd_ipa + " hostgroup-find " + hostgroup
-    process = subprocess.Popen(shlex.split(cmd_build_cmd_get_ipahostgroup), stdout=subprocess.PIPE)
-    process.communicate()
-    exit_code = process.wait()
+    exit_code, output = run_command(cmd_build_cmd_get_ipahostgroup)
     return exit_code
 
 def create_ipa_hostgroup(hostgroup):
     cmd_build_create_ipahostgroup = cmd_ipa + " hostgroup-add " + hostgroup
-    process = subprocess.Popen(shlex.split(cmd_build_create_ipahostgroup), stdout=subprocess.PIPE)
-    process.communicate()
-    exit_code = process.wait()
+    exit_code, output = run_command(cmd_build_create_ipahostgroup)
     return exit_code
 
 def create_ipa_automember_rule(hostgroup):
     cmd_create_ipa_automember_rule = cmd_ipa + " automember-add --type=hostgroup " + hostgroup
     try:
-	perform_cmd = subprocess.Popen(cmd_create_ipa_automember_rule, shell=True, stdout=subprocess.PIPE)
-	ipa_automember_rule = perform_cmd.stdout.read()
+	exit_code, ipa_automember_rule = run_command(cmd_create_ipa_automember_rule)
 
     except:
 	print log.ERROR + "ERROR: could not create IPA automember rule " + hostgroup + log.END
@@ -412,8 +2564,7 @@ def create_ipa_automember_rule(hostgroup):
 def create_ipa_automember_rule_condition(hostgroup):
     cmd_create_ipa_automember_rule_condition = cmd_ipa + " automember-add-condition --key=userclass --type=hostgroup --inclusive-regex=" + hostgroup + " " + hostgroup
     try:
-	perform_cmd = subprocess.Popen(cmd_create_ipa_automember_rule_condition, shell=True, stdout=subprocess.PIPE)
-	ipa_automember_rule = perform_cmd.stdout.read()
+	exit_code, ipa_automember_rule = run_command(cmd_create_ipa_automember_rule_condition)
 
     except:
 	print log.ERROR + "ERROR: could not create IPA automember rule condition for " + hostgroup + log.END
@@ -422,9 +2573,19 @@ def create_ipa_automember_rule_condition(hostgroup):
 def show_ipa_hostgroup(hostgroup):
     IPA_HOSTGROUP = ''
     IPA_HOSTGROUP_MEMBERS = ''
+    if IPA_API:
+        try:
+            result = IPA_API.show_hostgroup(hostgroup)
+        except IPAError as e:
+            if e.code != IPAAPI.NOT_FOUND:
+                print log.ERROR + "ERROR: could not show IPA hostgroup " + hostgroup + ": " + str(e) + log.END
+                sys.exit(1)
+            return(IPA_HOSTGROUP,IPA_HOSTGROUP_MEMBERS)
+        IPA_HOSTGROUP = ', '.join(result.get("cn", []))
+        IPA_HOSTGROUP_MEMBERS = ', '.join(result.get("member_host", []))
+        return(IPA_HOSTGROUP,IPA_HOSTGROUP_MEMBERS)
     cmd_build_cmd_show_ipahostgroup = cmd_ipa + " hostgroup-show " + hostgroup
-    process = subprocess.Popen(shlex.split(cmd_build_cmd_show_ipahostgroup), stdout=subprocess.PIPE)
-    for line in commands.getstatusoutput(cmd_build_cmd_show_ipahostgroup)[1].strip().replace('\n', '').replace('  ',';').split(';'):
+    for line in run_command(cmd_build_cmd_show_ipahostgroup, stderr=subprocess.STDOUT)[1].strip().replace('\n', '').replace('  ',';').split(';'):
         if "Host-group" in line:
                 #print line.split(':')[1].strip()
                 #IPA_HOSTGROUP.append(line.split(':')[1].strip())
@@ -435,308 +2596,1440 @@ def show_ipa_hostgroup(hostgroup):
                 #return IPA_HOSTGROUP_MEMBERS
     return(IPA_HOSTGROUP,IPA_HOSTGROUP_MEMBERS)
 
+class RemoteConfig(object):
+	# Configuration values that are read from Satellite. Every value is fetched on first use
+	# and kept for the rest of the run, so runs that fail the local validation or never
+	# need a value do not pay for the lookup.
+	def __init__(self):
+		self.values = {}
+		self.lock = threading.Lock()
+
+	def resolve(self, name, function):
+		with self.lock:
+			if name not in self.values:
+				self.values[name] = function()
+			return self.values[name]
+
+	@property
+	def satellite_locations(self):
+		return self.resolve("satellite_locations", lambda: ",".join(get_locations()))
+
+	@property
+	def operating_system_ids(self):
+		return self.resolve("operating_system_ids", lambda: ",".join(get_operating_system_ids()))
+
+CONFIG = RemoteConfig()
+
 def get_locations():
-        cmd_get_locations = hammer_cmd + " --csv location list"
         try:
-                perform_cmd = subprocess.Popen(cmd_get_locations, shell=True, stdout=subprocess.PIPE)
-                locations = perform_cmd.stdout.read()
-                all_locations = []
-                for line in islice(locations.strip().split("\n"), 1, None):     # print output without CSV header
-                        location = str(line.split(",")[1])
-                        all_locations.append(location)
-                return all_locations
+                return [str(location["name"]) for location in iter_inventory("location")]
         except:
                 print log.ERROR + "ERROR" + log.END
                 sys.exit(1)
 
 def get_operating_system_ids():
-        cmd_get_os_ids = hammer_cmd + " --csv os list"
         try:
-                perform_cmd = subprocess.Popen(cmd_get_os_ids, shell=True, stdout=subprocess.PIPE)
-                ids = perform_cmd.stdout.read()
-                all_os_ids = []
-                for line in islice(ids.strip().split("\n"), 1, None):   # print output without CSV header
-                        os_id = str(line.split(",")[0])
-                        all_os_ids.append(os_id)
-                return all_os_ids
+                return [str(os_entry["id"]) for os_entry in iter_inventory("os")]
         except:
                 print log.ERROR + "ERROR" + log.END
                 sys.exit(1)
 
-################################## OPTIONS PARSER AND VARIABLES ##################################
-
-parser = OptionParser()
-parser.add_option("--satellite-server", dest="sat6_fqdn", help="FQDN of Satellite - omit https://", metavar="SAT6_FQDN")
-parser.add_option("--client-fqdn", dest="client_fqdn", help="FQDN of the client you want to deploy", metavar="CLIENT_FQDN")
-parser.add_option("--location", dest="location", help="Label of the Location in Satellite that the host is to be associated with", metavar="LOCATION")
-parser.add_option("--application-id", dest="application_id", help="Application ID as basis for the hostgroup the client should be assigned to", metavar="APPLICATION_ID")
-parser.add_option("--environment", dest="environment", help="Environment should be one of dev/test/preprod/prod", metavar="ENVIRONMENT")
-parser.add_option("--partitioning", dest="partitioning", help="Customized partitioning table", metavar="PARTITIONING")
-parser.add_option("--primary-nic-ip", dest="primary_nic_ip", help="IP address of the primary/public network interface", metavar="PRIMARY_NIC_IP")
-parser.add_option("--primary-nic-mask", dest="primary_nic_mask", help="Subnet mask of primary/public network interface", metavar="PRIMARY_NIC_MASK")
-parser.add_option("--primary-nic-gateway", dest="primary_nic_gateway", help="Gateway of primary/public network interface", metavar="PRIMARY_NIC_GATEWAY")
-parser.add_option("--primary-nic-mac", dest="primary_nic_mac", help="MAC address of the primary/public network interface", metavar="PRIMARY_NIC_MAC")
-parser.add_option("--primary-nic-network", dest="primary_nic_network", help="Network of the primary/public network interface", metavar="PRIMARY_NIC_NETWORK")
-parser.add_option("--secondary-nic-ip", dest="secondary_nic_ip", help="IP address of the inguest storage network interface", metavar="SECONDARY_NIC_IP")
-parser.add_option("--secondary-nic-mask", dest="secondary_nic_mask", help="Subnet mask of the inguest storage network interface", metavar="SECONDARY_NIC_MASK")
-parser.add_option("--secondary-nic-gateway", dest="secondary_nic_gateway", help="Gateway of the inguest storage network interface", metavar="SECONDARY_NIC_GATEWAY")
-parser.add_option("--secondary-nic-mac", dest="secondary_nic_mac", help="MAC address of the inguest storage network interface", metavar="SECONDARY_NIC_MAC")
-parser.add_option("--secondary-nic-network", dest="secondary_nic_network", help="Network of the inguest storage network interface", metavar="SECONDARY_NIC_NETWORK")
-parser.add_option("--third-nic-ip", dest="third_nic_ip", help="IP address of the database replication network interface", metavar="THIRD_NIC_IP")
-parser.add_option("--third-nic-mask", dest="third_nic_mask", help="Subnet mask of the database replication network interface", metavar="THIRD_NIC_MASK")
-parser.add_option("--third-nic-gateway", dest="third_nic_gateway", help="Gateway of the database replication network interface", metavar="THIRD_NIC_GATEWAY")
-parser.add_option("--third-nic-mac", dest="third_nic_mac", help="MAC address of the database replication network interface", metavar="THIRD_NIC_MAC")
-parser.add_option("--third-nic-network", dest="third_nic_network", help="Network address of the database replication network interface", metavar="THIRD_NIC_NETWORK")
-parser.add_option("--trange", dest="trange", help="Trange where you want to add your host [tr01 / tr02 / tr03] ", metavar="TRANGE")
-parser.add_option("--create-host", dest="create_host", action="store_true", help="Create new host")
-parser.add_option("--update-host", dest="update_host", action="store_true", help="Update existing host")
-parser.add_option("--intranet", dest="intranet", action="store_true", help="Host should be placed in INTRANET")
-parser.add_option("--dmz", dest="dmz", action="store_true", help="Host should be placed in DMZ")
-parser.add_option("--application", dest="application", action="store_true", help="True if you want to install an application on the host")
-parser.add_option("--infrastructure", dest="infrastructure", action="store_true", help="True if you want to install an infrastructure service on the host")
-parser.add_option("-v", "--verbose", dest="verbose", action="store_true", help="Verbose output")
-(options, args) = parser.parse_args()
-
-if not (( options.client_fqdn and options.create_host ) or ( options.client_fqdn and options.update_host )):
-    print log.ERROR + "You must specify at least client fqdn and if you want to create a new host (--create-host) or update a host (--update-host). See usage:\n" + log.END
-    parser.print_help()
-    print "\nExample usage: ./satellite6-automation.py --client-fqdn client01.example.com --create-host"
-    sys.exit(1)
-else:
-    if options.trange == "tr01" or options.trange == "tr02" or options.trange == "tr03" :
-	TRANGE=options.trange
-    else:
-	print log.ERROR + "ERROR: you need to define the trange where you want to assign your host. See usage." + log.END
-	sys.exit(1)
-    SAT6_FQDN = options.sat6_fqdn
-    CLIENT_FQDN = options.client_fqdn
-    HOSTNAME = CLIENT_FQDN.split(".")[0]
-    DOMAIN = CLIENT_FQDN.split(".")[1]+"."+CLIENT_FQDN.split(".")[2]
-    ORGANIZATION  = ""                                                                                  # Change this variable according to your needs
-    LOCATION  = options.location
-    APPLICATION_ID = str(options.application_id)
-    ENVIRONMENT = str(options.environment)
-    PARTITIONING = options.partitioning
-    PARENT_HOSTGROUP = "hg-"+APPLICATION_ID
-    HOSTGROUP = str("hg-"+APPLICATION_ID+"-"+ENVIRONMENT+"-"+TRANGE)
-    IPA_HOSTGROUP = str("hg-"+APPLICATION_ID+"-"+ENVIRONMENT)
-    REALM = ""                                                                                          # Change this variable to your IPA Realm
-    ARCHITECTURE = "x86_64"
-    MEDIUM= ""                                                                                          # Change this variable to your default installation medium
-    OS = ""                                                                                             # Change this variable to your default operating system name in Satellite
-    DEFAULT_CONTENT_VIEW = ""                                                                           # Change this variable to your Satellite default (composite) content view
-    PUPPET_ENV_ID = get_environment_id(DEFAULT_CONTENT_VIEW)
-    PRINCIPAL = ""                                                                                      # Change this variable to your IPA automation service user name
-    KDC = ""                                                                                            # Change this variable to one of your IPA servers
-    KEYTAB = "/home/svc-satellite-automation/"+PRINCIPAL+".keytab"					# Change this variable to the path to your principals Kerberos keytab file
-    NFS_HOST_ISO_STORE = ""                                                                             # Change this variable to your NFS mount where you want to store host iso images
-    DNS_PRIMARY = ""                                                                                    # Change this variable to your primary DNS server
-    SATELLITE_LOCATIONS = ','.join(get_locations())
-    OPERATING_SYSTEM_IDS = ','.join(get_operating_system_ids())
-
-if ( ENVIRONMENT == "dev" ):
-	DEFAULT_ACTIVATION_KEY = ""                                                                     # Change this variable to your Satellite default activation key for environment "dev" 
-if ( ENVIRONMENT == "test" ):
-	DEFAULT_ACTIVATION_KEY = ""                                                                     # Change this variable to your Satellite default activation key for environment "test" 
-if ( ENVIRONMENT == "prod" ):
-	DEFAULT_ACTIVATION_KEY = ""                                                                     # Change this variable to your Satellite default activation key for environment "prod" 
-
-if options.primary_nic_ip:
-    PRIMARY_NIC_IP = str(options.primary_nic_ip)
-    PRIMARY_NIC_MASK = str(options.primary_nic_mask)	
-    PRIMARY_NIC_GATEWAY = str(options.primary_nic_gateway)
-    PRIMARY_NIC_NETWORK = str(options.primary_nic_network)
-    if not verify_subnet(PRIMARY_NIC_NETWORK):
-	create_subnet(PRIMARY_NIC_NETWORK,PRIMARY_NIC_MASK,PRIMARY_NIC_GATEWAY)
-    SUBNET_ID_PRIMARY_NIC = get_subnet_id(PRIMARY_NIC_NETWORK)
-else:
-    PRIMARY_NIC_IP = None
-    SUBNET_ID_PRIMARY_NIC = None
-    PRIMARY_NIC_MASK = None
-if options.primary_nic_mac:
-    PRIMARY_NIC_MAC = str(options.primary_nic_mac)
-else:
-    PRIMARY_NIC_MAC = None
-
-if options.secondary_nic_ip:
-    SECONDARY_NIC_IP = str(options.secondary_nic_ip)
-    SECONDARY_NIC_MASK = str(options.secondary_nic_mask)	
-    SECONDARY_NIC_GATEWAY = str(options.secondary_nic_gateway) 
-    SECONDARY_NIC_NETWORK = str(options.secondary_nic_network) 
-    if not verify_subnet(SECONDARY_NIC_NETWORK):
-	create_subnet(SECONDARY_NIC_NETWORK,SECONDARY_NIC_MASK,SECONDARY_NIC_GATEWAY)
-    SUBNET_ID_SECONDARY_NIC = get_subnet_id(SECONDARY_NIC_NETWORK)
-else:
-    SECONDARY_NIC_IP = None     
-    SUBNET_ID_SECONDARY_NIC = None
-if options.secondary_nic_mac:
-    SECONDARY_NIC_MAC = str(options.secondary_nic_mac)
-else:
-    SECONDARY_NIC_MAC = None
-
-if options.third_nic_ip:
-    THIRD_NIC_IP = str(options.third_nic_ip)
-    THIRD_NIC_MASK = str(options.third_nic_mask)	
-    THIRD_NIC_GATEWAY = str(options.third_nic_gateway) 
-    THIRD_NIC_NETWORK = str(options.third_nic_network) 
-    if not verify_subnet(THIRD_NIC_NETWORK):
-	create_subnet(THIRD_NIC_NETWORK,THIRD_NIC_MASK,THIRD_NIC_GATEWAY)
-    SUBNET_ID_THIRD_NIC = get_subnet_id(THIRD_NIC_NETWORK)
-else:
-    THIRD_NIC_IP = None
-    SUBNET_ID_THIRD_NIC = None
-if options.third_nic_mac:
-    THIRD_NIC_MAC = str(options.third_nic_mac)
-else:
-    THIRD_NIC_MAC = None
-
-if options.verbose:
-    VERBOSE=True
-else:
-    VERBOSE=False
-
-if options.create_host:
-    CREATE_HOST=True
-else:
-    CREATE_HOST=False
-
-if options.update_host:
-    UPDATE_HOST=True
-else:
-    UPDATE_HOST=False
-
-if options.intranet:
-    INTRANET=True
-    PUPPET_PROXY = ""                                                                                   # Change this variable to your Satellite or Capsule server
-    PUPPET_CA_PROXY = ""                                                                                # Change this variable to your Satellite or Capsule server
-else:
-    INTRANET=False
-
-if options.dmz:
-    DMZ=True
-    PUPPET_PROXY = ""                                                                                   # Change this variable to your Satellite or Capsule server
-    PUPPET_CA_PROXY = ""                                                                                # Change this variable to your Satellite or Capsule server
-else:
-    DMZ=False
-
-if options.trange == "tr01" or options.trange == "tr02" or options.trange == "tr03" :
-   TRANGE=options.trange
-else:
-   print log.ERROR + "ERROR: you need to define the trange where you want to assign your host. See usage." + log.END
-   sys.exit(1)
-
-if options.application:
-    APPLICATION=True
-else:
-    APPLICATION=False
-
-if options.infrastructure:
-    INFRASTRUCTURE=True
-else:
-    INFRASTRUCTURE=False
-
-if APPLICATION:
-    INITIAL_PARENT_HOSTGROUP = "hg-application"
-if INFRASTRUCTURE:
-    INITIAL_PARENT_HOSTGROUP = "hg-infrastructure"
-
-if VERBOSE:
-    print log.SUMM + "### Verbose output ###" + log.END
-    print "CLIENT FQDN - %s" % CLIENT_FQDN
-    print "ORGANIZATION - %s" % ORGANIZATION
-    print "LOCATION - %s" % LOCATION
-    print "APPLICATION_ID - %s" % APPLICATION_ID
-    print "ENVIRONMENT - %s" % ENVIRONMENT
-    print "ENVIRONMENT TABLE - %s" % PARTITIONING
-    print "HOSTGROUP - %s" % HOSTGROUP
-    print "CREATE_HOST - %s" % CREATE_HOST
-    print "UPDATE_HOST - %s" % UPDATE_HOST
+NIC_NAMES = (("primary", "eth0"), ("secondary", "eth1"), ("third", "eth2"))
+MANIFEST_FIELDS = ["client_fqdn", "location", "application_id", "environment", "partitioning", "trange", "intranet", "dmz", "application", "infrastructure"]
+for nic_name, identifier in NIC_NAMES:
+	MANIFEST_FIELDS.extend([nic_name + "_nic_ip", nic_name + "_nic_mask", nic_name + "_nic_gateway", nic_name + "_nic_mac", nic_name + "_nic_network"])
+MANIFEST_FLAGS = ("intranet", "dmz", "application", "infrastructure")
+
+def read_manifest(manifest,defaults):
+	# A manifest is a CSV file with one host per row or a JSON list of objects. Column names
+	# are the long option names (with or without leading dashes, "-" or "_" both work). Values
+	# not set in the manifest are taken from the command line options.
+	try:
+		with open(manifest) as manifest_file:
+			if manifest.endswith(".json"):
+				rows = json.load(manifest_file)
+				if isinstance(rows, dict):
+					rows = rows.get("hosts", [])
+			else:
+				rows = list(csv.DictReader(manifest_file))
+	except (IOError, ValueError, csv.Error) as e:
+		print log.ERROR + "ERROR: could not read manifest " + manifest + ": " + str(e) + log.END
+		sys.exit(1)
+
+	hosts = []
+	for row in rows:
+		try:
+			hosts.append(get_host_values(row,defaults))
+		except ValueError as e:
+			print log.ERROR + "ERROR: " + str(e) + " in " + manifest + "." + log.END
+			sys.exit(1)
+	return hosts
+
+def get_host_values(row,defaults):
+	# Merges one manifest row (or service request) into the defaults, raises ValueError on
+	# unknown fields.
+	values = dict(defaults)
+	for key, value in row.items():
+		field = str(key).strip().lstrip("-").replace("-", "_")
+		if field not in MANIFEST_FIELDS:
+			raise ValueError("unknown manifest column " + str(key))
+		if value is None or str(value).strip() == "":
+			continue
+		if field in MANIFEST_FLAGS:
+			value = str(value).strip().lower() in ("1", "true", "yes", "y")
+		values[field] = value
+	return values
+
+def build_host(values):
+	# Turns the option values of one host into a host record. Returns (host, errors).
+	errors = []
+	client_fqdn = values.get("client_fqdn")
+	if not client_fqdn or len(str(client_fqdn).split(".")) < 3:
+		return None, ["client fqdn " + str(client_fqdn) + " is not a fully qualified domain name"]
+	client_fqdn = str(client_fqdn)
+	host = {
+		"client_fqdn": client_fqdn,
+		"hostname": client_fqdn.split(".")[0],
+		"domain": client_fqdn.split(".")[1]+"."+client_fqdn.split(".")[2],
+		"location": values.get("location"),
+		"application_id": str(values.get("application_id")),
+		"environment": str(values.get("environment")),
+		"trange": values.get("trange"),
+		"partitioning": values.get("partitioning"),
+		"nics": [],
+	}
+	if host["trange"] not in ("tr01", "tr02", "tr03"):
+		errors.append("you need to define the trange where you want to assign your host")
+	if not host["location"]:
+		errors.append("you need to define the location of your host")
+	host["location"] = str(host["location"])
+	host["parent_hostgroup"] = "hg-" + host["application_id"]
+	host["hostgroup"] = str("hg-" + host["application_id"] + "-" + host["environment"] + "-" + str(host["trange"]))
+	host["ipa_hostgroup"] = str("hg-" + host["application_id"] + "-" + host["environment"])
+	host["activation_key"] = DEFAULT_ACTIVATION_KEYS.get(host["environment"])
+	if host["activation_key"] is None:
+		errors.append("no default activation key configured for environment " + host["environment"])
+
+	if values.get("application"):
+		host["initial_parent_hostgroup"] = "hg-application"
+	elif values.get("infrastructure"):
+		host["initial_parent_hostgroup"] = "hg-infrastructure"
+	else:
+		errors.append("you need to define if your host is an application (--application) or infrastructure (--infrastructure) host")
+	if values.get("intranet"):
+		host["puppet_proxy"], host["puppet_ca_proxy"] = INTRANET_PUPPET_PROXY, INTRANET_PUPPET_CA_PROXY
+	elif values.get("dmz"):
+		host["puppet_proxy"], host["puppet_ca_proxy"] = DMZ_PUPPET_PROXY, DMZ_PUPPET_CA_PROXY
+	else:
+		errors.append("you need to define if your host is placed in the intranet (--intranet) or the DMZ (--dmz)")
+
+	for nic_name, identifier in NIC_NAMES:
+		if not values.get(nic_name + "_nic_ip"):
+			break
+		nic = {"identifier": identifier}
+		for field in ("ip", "mask", "gateway", "mac", "network"):
+			nic[field] = values.get(nic_name + "_nic_" + field) and str(values.get(nic_name + "_nic_" + field)) or None
+		if not nic["mac"]:
+			errors.append("--" + nic_name + "-nic-mac is missing")
+		try:
+			nic["network"], nic["mask"] = get_nic_network(nic, "--" + nic_name + "-nic")
+		except ValueError as e:
+			errors.append(str(e))
+		host["nics"].append(nic)
+	if not host["nics"]:
+		errors.append("you need to define at least the primary network interface (--primary-nic-ip)")
+
+	host["ptable"] = None
+	if host["partitioning"]:
+		try:
+			host["ptable_layout"] = render_partitioning_table(host["partitioning"])
+			host["ptable"] = get_partitioning_table_name(host["ptable_layout"])
+		except ValueError as e:
+			errors.append(str(e))
+		except IOError as e:
+			errors.append("could not read partitioning header " + PARTITIONING_HEADER_FILE + ": " + str(e))
+	return host, errors
+
+class StepJournal(object):
+	# SQLite journal of the provisioning steps, keyed by run id and client FQDN. Every step
+	# is recorded as "started" before and as "done" (with its result) after it ran, so a
+	# retry of the same run id knows which steps finished and which were interrupted.
+	# Concurrent runs and workers share the file; entries older than "retention" seconds
+	# are removed when the journal is opened.
+	def __init__(self, path, retention):
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+		with self.lock:
+			self.connection.execute("CREATE TABLE IF NOT EXISTS steps (run_id TEXT, client_fqdn TEXT, step TEXT, state TEXT, value TEXT, updated REAL, PRIMARY KEY (run_id, client_fqdn, step))")
+			self.connection.execute("DELETE FROM steps WHERE updated < ?", (time.time() - retention,))
+			self.connection.commit()
+
+	def load(self, run_id, client_fqdn):
+		# Returns {step: (state, value)}
+		with self.lock:
+			rows = self.connection.execute("SELECT step, state, value FROM steps WHERE run_id = ? AND client_fqdn = ?", (run_id, client_fqdn)).fetchall()
+		return dict((str(step), (str(state), value is not None and json.loads(value) or None)) for step, state, value in rows)
+
+	def record(self, run_id, client_fqdn, step, state, value=None):
+		with self.lock:
+			self.connection.execute("INSERT OR REPLACE INTO steps (run_id, client_fqdn, step, state, value, updated) VALUES (?, ?, ?, ?, ?, ?)", (run_id, client_fqdn, step, state, json.dumps(value), time.time()))
+			self.connection.commit()
+
+	def start(self, run_id, client_fqdn, step):
+		self.record(run_id, client_fqdn, step, "started")
+
+	def finish(self, run_id, client_fqdn, step, value):
+		self.record(run_id, client_fqdn, step, "done", value)
+
+	def close(self):
+		with self.lock:
+			self.connection.close()
+
+def open_journal(path):
+	try:
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		return StepJournal(path, JOURNAL_RETENTION)
+	except (sqlite3.Error, OSError) as e:
+		print log.ERROR + "ERROR: could not open step journal " + path + ": " + str(e) + log.END
+		sys.exit(1)
+
+JOURNAL = None
+
+PREREQUISITES = {}
+PREREQUISITES_LOCK = threading.Lock()
+PREREQUISITE_KEY_LOCKS = {}
+
+def resolve_once(key,function,*args):
+	# Shared prerequisites (hostgroups, subnets, IPA hostgroups, ...) are resolved once per
+	# distinct value and then reused for every host of the run. Every key has its own lock,
+	# so with --workers the check-then-create of e.g. a hostgroup runs in exactly one worker
+	# while the others wait for its result. A failed resolution is not remembered.
+	with PREREQUISITES_LOCK:
+		if key in PREREQUISITES:
+			return PREREQUISITES[key]
+		key_lock = PREREQUISITE_KEY_LOCKS.setdefault(key, threading.Lock())
+	with key_lock:
+		if key not in PREREQUISITES:
+			PREREQUISITES[key] = function(*args)
+		return PREREQUISITES[key]
+
+def ensure_organization(organization):
+	if not verify_organization(organization):
+		print log.ERROR + "ERROR: Please verify that your organization is configured properly on Satellite." + log.END
+		sys.exit(1)
+	return True
+
+def ensure_location(location):
+	if not verify_location(location):
+		print log.ERROR + "ERROR: Please verify that your location " + location + " is configured properly on Satellite." + log.END
+		sys.exit(1)
+	return True
+
+def ensure_lifecycle(environment):
+	if not verify_lifecycle(environment):
+		print log.ERROR + "ERROR: Please verify that the lifecycle environment " + environment + " is configured properly on Satellite." + log.END
+		sys.exit(1)
+	return True
+
+def ensure_subnet(nic,domain):
+	if not verify_subnet(nic["network"]):
+		if not (nic["mask"] and nic["gateway"]):
+			print log.ERROR + "ERROR: subnet " + nic["network"] + " not found. Please pass the mask and gateway of " + nic["identifier"] + " to create it." + log.END
+			sys.exit(1)
+		create_subnet(nic["network"],nic["mask"],nic["gateway"],domain)
+	subnet_id = get_subnet_id(nic["network"])
+	if not subnet_id:
+		print log.ERROR + "ERROR: subnet id not found. Please ensure that the needed subnet " + nic["network"] + " is configured properly in Satellite." + log.END
+		sys.exit(1)
+	return subnet_id
+
+def ensure_parent_hostgroup(parenthg,initial_hostgroup):
+	ensure_hostgroup_path([initial_hostgroup,parenthg])
+	return True
+
+def ensure_child_hostgroup(childhg,parenthg,initial_hostgroup,puppetenv,lifecycle,activation_key,repair=False):
+	ensure_hostgroup_path([initial_hostgroup,parenthg,childhg],puppetenv,lifecycle,activation_key,repair)
+	return True
+
+def use_kerberos_cache():
+	# kinit, klist, ipa and the IPA API all use the dedicated credential cache. Set by main()
+	# and ipa_login(), never on import, so importing the script leaves KRB5CCNAME alone.
+	os.environ["KRB5CCNAME"] = "FILE:" + KRB5_CCACHE
+
+def ipa_login():
+	# The ticket lives in a credential cache of its own (KRB5_CCACHE), so it is reused across
+	# runs and parallel runs no longer destroy each other's ticket. A new ticket is only
+	# requested when the current one expires within KERBEROS_RENEW_BEFORE seconds. The lock
+	# file makes sure that only one of several concurrent runs talks to the KDC.
+	use_kerberos_cache()
+	try:
+		lock_file = open(KRB5_CCACHE_LOCK, 'a')
+	except IOError as e:
+		print log.ERROR + "ERROR: could not open the Kerberos lock file " + KRB5_CCACHE_LOCK + ": " + e.strerror + ". Please change TMP_DIR to a directory writable by the service user." + log.END
+		sys.exit(1)
+
+	with lock_file:
+		fcntl.flock(lock_file, fcntl.LOCK_EX)
+		try:
+			expiry = get_kerberos_ticket_expiry()
+			if expiry and expiry - time.time() > KERBEROS_RENEW_BEFORE:
+				print log.INFO + "INFO: Valid Kerberos ticket found (expires " + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(expiry)) + ")." + log.END
+				return True
+
+			if expiry:
+				print log.INFO + "INFO: Kerberos ticket expires soon, renewing it via keytab file " + log.SUMM + KEYTAB + "." + log.END
+			else:
+				print log.ERROR + "ERROR: No valid Kerberos ticket found." + log.END
+				print log.INFO + "INFO: try to connect to KDC via keytab file " + log.SUMM + KEYTAB + "." + log.END
+			if not os.path.exists(KEYTAB):		# under the lock, so only one run fetches (and rotates) the keytab
+				get_keytab(PRINCIPAL,KDC,KEYTAB)
+			ipa_connect_with_keytab(PRINCIPAL,KEYTAB)
+			if get_kerberos_login_status():
+				print log.INFO + "INFO: connection to IPA successfully established." + log.END
+			else:
+				print log.ERROR + "ERROR: could not get a Kerberos ticket for " + PRINCIPAL + "." + log.END
+				sys.exit(1)
+		finally:
+			fcntl.flock(lock_file, fcntl.LOCK_UN)
+	return True
+
+def ensure_ipa_hostgroup(hostgroup):
+	if IPA_API:
+		try:
+			result = IPA_API.ensure_hostgroup(hostgroup)
+		except (IPAError, httplib.HTTPException, socket.error, ValueError) as e:
+			print log.ERROR + "ERROR: could not create IPA hostgroup " + hostgroup + " and its automember rule: " + str(e) + log.END
+			sys.exit(1)
+		if result["hostgroup_created"]:
+			print log.WARN + "WARNING: did not find hostgroup " + hostgroup + " on IPA. Created it together with its automember rule." + log.END
+		else:
+			print log.INFO + "INFO: hostgroup " + hostgroup + " found in IPA." + log.END
+			if result["automember_rule_created"] or result["automember_condition_created"]:
+				print log.WARN + "WARNING: added missing automember rule for IPA hostgroup " + hostgroup + "." + log.END
+		return True
+	if not get_ipa_hostgroup(hostgroup) == 0:
+		print log.WARN + "WARNING: did not find hostgroup " + hostgroup + " on IPA. Will create it now." + log.END
+		create_ipa_hostgroup(hostgroup)
+		create_ipa_automember_rule(hostgroup)
+		create_ipa_automember_rule_condition(hostgroup)
+	else:
+		print log.INFO + "INFO: hostgroup " + hostgroup + " found in IPA." + log.END
+	return True
+
+STEP_PHASES = {
+	"organization":		"verification",
+	"location":		"verification",
+	"lifecycle":		"verification",
+	"puppet_env":		"verification",
+	"subnet":		"verification",
+	"parent_hostgroup":	"hostgroups",
+	"hostgroup":		"hostgroups",
+	"kerberos":		"ipa",
+	"ipa_hostgroup":	"ipa",
+	"ptable":		"ptable",
+	"host":			"host create",
+}
+
+def run_steps(steps):
+	# Runs a dependency graph of steps. steps is a list of (name, dependencies, function, args);
+	# every step runs in its own thread as soon as all of its dependencies have finished, so
+	# independent chains (e.g. Satellite checks and Kerberos/IPA) overlap. If a step fails,
+	# the steps depending on it are skipped and run_steps exits like the helpers do.
+	finished = dict((name, threading.Event()) for name, dependencies, function, args in steps)
+	results = {}
+	failed = []
+
+	def run_step(name, dependencies, function, args):
+		set_phase(STEP_PHASES.get(name.split("_eth")[0].split(" ")[0], name))
+		try:
+			for dependency in dependencies:
+				finished[dependency].wait()
+			if [dependency for dependency in dependencies if dependency in failed]:
+				failed.append(name)
+			else:
+				results[name] = function(*args)
+		except SystemExit:
+			failed.append(name)
+		except Exception:
+			print log.ERROR + "ERROR: step " + name + " failed:\n" + traceback.format_exc() + log.END
+			failed.append(name)
+		finally:
+			finished[name].set()
+
+	threads = []
+	for step in steps:
+		thread = threading.Thread(target=run_step, args=step, name="step-" + step[0])
+		thread.daemon = True
+		thread.start()
+		threads.append(thread)
+	for thread in threads:
+		while thread.is_alive():
+			thread.join(1)
+	if failed:
+		sys.exit(1)
+	return results
+
+def resolve_puppet_env(host):
+	host["puppet_env_id"] = resolve_once(("puppet_env", host["environment"]), get_environment_id, DEFAULT_CONTENT_VIEW, host["environment"])
+	return host["puppet_env_id"]
+
+def resolve_hostgroup(host):
+	return resolve_once(("hostgroup", host["hostgroup"]), ensure_child_hostgroup, host["hostgroup"], host["parent_hostgroup"], host["initial_parent_hostgroup"], host["puppet_env_id"], host["environment"], host["activation_key"], "hostgroup" in host.get("unconfirmed_steps", ()))
+
+def resolve_subnet(host,nic):
+	nic["subnet_id"] = resolve_once(("subnet", nic["network"]), ensure_subnet, nic, host["domain"])
+	return nic["subnet_id"]
 
+def resolve_ptable(host):
+	return resolve_once(("ptable", host["ptable"]), ensure_partitioning_table, host["ptable"], host["ptable_layout"], "ptable" in host.get("unconfirmed_steps", ()))
+
+def ensure_partitioning_table(ptable,layout,repair=False):
+	# Upload the content addressed table and assign it to the OS only if no table with this
+	# layout exists yet. resolve_once() makes sure this runs once per layout and run.
+	if not verify_partitioning_table(ptable):
+		upload_partitioning_table(ptable,layout)
+		assign_os_to_partitioning_table(ptable)
+	else:
+		print log.INFO + "INFO: partition table " + ptable + " found. Proceed..." + log.END
+		if repair:	# an interrupted run may have uploaded it without assigning the OS
+			assign_os_to_partitioning_table(ptable)
+	return ptable
+
+def create_host(host):
+	present = host.get("present")		# known from the plan with --apply
+	if present is None:
+		present = verify_hostname(host["client_fqdn"])
+	if not present:
+		try:
+			conflicts = find_host_conflicts(host)
+		except:
+			print log.ERROR + "ERROR: could not check the addresses of " + host["client_fqdn"] + " on Satellite" + log.END
+			sys.exit(1)
+		if conflicts:
+			for conflict in conflicts:
+				print log.ERROR + "ERROR: " + conflict + "." + log.END
+			sys.exit(1)
+		return queue_host_create(host)
+	elif "host" in host.get("unconfirmed_steps", ()):
+		print log.INFO + "INFO: host " + host["client_fqdn"] + " was created by the interrupted run " + host["run_id"] + ". Proceed..." + log.END
+		queue_host_iso(host)
+		return "created"
+	elif UPDATE_HOST:
+		return update_host(host)
+	else:
+		print log.INFO + "INFO: host " + host["client_fqdn"] + " is already present on Satellite. Maybe you want to update the host? If yes, please run this script again with option --update-host instead of --create-host." + log.END
+		return "already present"
+
+def provision_host(host):
+	steps = [
+		##### Verifiying some needed parameters
+		("organization", (), resolve_once, (("organization", ORGANIZATION), ensure_organization, ORGANIZATION)),
+		("location", (), resolve_once, (("location", host["location"]), ensure_location, host["location"])),
+		("lifecycle", (), resolve_once, (("lifecycle", host["environment"]), ensure_lifecycle, host["environment"])),
+		("puppet_env", (), resolve_puppet_env, (host,)),
+
+		## Verify if Satellite hostgroups are present
+		("parent_hostgroup", ("organization",), resolve_once, (("parent_hostgroup", host["parent_hostgroup"]), ensure_parent_hostgroup, host["parent_hostgroup"], host["initial_parent_hostgroup"])),
+		("hostgroup", ("parent_hostgroup", "lifecycle", "puppet_env"), resolve_hostgroup, (host,)),
+
+		## Verify if IPA hostgroups are present, independent of all Satellite steps
+		("kerberos", (), resolve_once, (("kerberos", PRINCIPAL), ipa_login)),
+		("ipa_hostgroup", ("kerberos",), resolve_once, (("ipa_hostgroup", host["ipa_hostgroup"]), ensure_ipa_hostgroup, host["ipa_hostgroup"])),
+	]
+
+	## Verify subnets of all network interfaces
+	set_phase("verification")
+	for nic in host["nics"]:
+		if not nic["network"]:
+			locate_nic_subnet(nic)
+		elif not nic["mask"]:
+			verify_nic_network(nic)
+	for nic in host["nics"]:
+		steps.append(("subnet_" + nic["identifier"], ("organization",), resolve_subnet, (host, nic)))
+	host_dependencies = ["location", "hostgroup", "ipa_hostgroup"] + ["subnet_" + nic["identifier"] for nic in host["nics"]]
+
+	# Create custom host partition table
+	if host["ptable"]:
+		steps.append(("ptable", ("organization",), resolve_ptable, (host,)))
+		host_dependencies.append("ptable")
+
+	##### Now lets create a new host (or update the existing one), as soon as everything it needs is in place
+	if CREATE_HOST:
+		steps.append(("host", tuple(host_dependencies), create_host, (host,)))
+	else:
+		steps.append(("host", tuple(host_dependencies), update_host, (host,)))
+	if JOURNAL and host.get("run_id"):
+		return resume_host(host, steps)
+	return run_steps(steps)["host"]
+
+def queue_host_create(host):
+	# Submits the creation of host and returns its HostCreateJob. As soon as the host exists,
+	# it is added to the host index, journaled and its boot ISO is queued.
+	def callback(job):
+		if job.state == "present" and JOURNAL and host.get("run_id"):
+			JOURNAL.finish(host["run_id"], host["client_fqdn"], "host", "already present")
+		if job.state != "done":
+			return
+		invalidate_inventory_cache("host")
+		record_host(host)
+		if JOURNAL and host.get("run_id"):
+			JOURNAL.finish(host["run_id"], host["client_fqdn"], "host", "created")
+		queue_host_iso(host)
+	host["create_job"] = get_host_create_queue().submit(host, callback)
+	return host["create_job"]
+
+def queue_host_iso(host):
+	callback = None
+	if JOURNAL and host.get("run_id"):
+		JOURNAL.start(host["run_id"], host["client_fqdn"], "iso")
+		def callback(job):
+			if job.state == "done":
+				JOURNAL.finish(host["run_id"], host["client_fqdn"], "iso", job.checksum)
+	host["iso_job"] = get_host_iso(host["client_fqdn"], host["hostname"], callback)
+	return host["iso_job"]
+
+def resume_host(host,steps):
+	# Runs the steps of a host with the journal of its run id. Steps that a previous attempt
+	# of the same run finished are not run again, their results are taken from the journal
+	# and stored as resolved prerequisites. Steps that were started but never confirmed are
+	# run again with repair, which completes half finished hostgroups and partition tables.
+	journal = JOURNAL.load(host["run_id"], host["client_fqdn"])
+	host["unconfirmed_steps"] = set([step for step, (state, value) in journal.items() if state == "started"])
+	finished = [step for step, (state, value) in journal.items() if state == "done"]
+	if finished:
+		print log.INFO + "INFO: resuming run " + host["run_id"] + " for " + host["client_fqdn"] + ", " + str(len(finished)) + " steps already done." + log.END
+
+	def run_journaled(step, key, function, args):
+		state, value = journal.get(step, (None, None))
+		if state == "done":
+			if key is None:
+				return value
+			with PREREQUISITES_LOCK:
+				PREREQUISITES.setdefault(key, value)
+			return function(*args)
+		JOURNAL.start(host["run_id"], host["client_fqdn"], step)
+		value = function(*args)
+		if not isinstance(value, HostCreateJob):	# journaled by queue_host_create() once the host exists
+			JOURNAL.finish(host["run_id"], host["client_fqdn"], step, value)
+		return value
+
+	keys = {
+		"puppet_env": ("puppet_env", host["environment"]),
+		"hostgroup": ("hostgroup", host["hostgroup"]),
+		"ptable": ("ptable", host["ptable"]),
+		"host": None,
+	}
+	for nic in host["nics"]:
+		keys["subnet_" + nic["identifier"]] = ("subnet", nic["network"])
+	journaled_steps = []
+	for name, dependencies, function, args in steps:
+		if name == "kerberos":	# the ticket belongs to this process
+			journaled_steps.append((name, dependencies, function, args))
+			continue
+		key = keys.get(name, function == resolve_once and args[0] or None)
+		journaled_steps.append((name, dependencies, run_journaled, (name, key, function, args)))
+	result = run_steps(journaled_steps)["host"]
+
+	# The host exists, but the boot ISO of the previous attempt was never written
+	if result == "created" and not host.get("iso_job") and journal.get("iso", (None, None))[0] != "done":
+		queue_host_iso(host)
+	return result
+
+def provision_hosts(hosts,workers):
+	results = {}
+	host_queue = Queue.Queue()
+	for host in hosts:
+		host_queue.put(host)
+
+	def provision_worker():
+		while True:
+			try:
+				host = host_queue.get_nowait()
+			except Queue.Empty:
+				return
+			print log.HEADER + "### " + host["client_fqdn"] + " ###" + log.END
+			try:
+				results[host["client_fqdn"]] = provision_host(host)
+			except SystemExit:	# the helpers exit on errors, keep going with the remaining hosts
+				results[host["client_fqdn"]] = "failed"
+			except Exception:
+				print log.ERROR + "ERROR: unexpected error while provisioning " + host["client_fqdn"] + ":\n" + traceback.format_exc() + log.END
+				results[host["client_fqdn"]] = "failed"
+
+	threads = []
+	for i in range(max(1, min(workers, len(hosts)))):
+		thread = threading.Thread(target=provision_worker, name="provision-" + str(i))
+		thread.daemon = True
+		thread.start()
+		threads.append(thread)
+	for thread in threads:
+		while thread.is_alive():
+			thread.join(1)		# join with timeout, otherwise Ctrl-C is not delivered in Python 2
+	return [(host["client_fqdn"], get_host_result(results.get(host["client_fqdn"], "failed"))) for host in hosts]
+
+def print_results(results):
+	# Prints the summary of a run over many hosts, returns the hosts that failed
+	print log.SUMM + "### Summary ###" + log.END
+	for client_fqdn, result in results:
+		if result == "failed":
+			print log.ERROR + client_fqdn + " - " + result + log.END
+		else:
+			print log.INFO + client_fqdn + " - " + result + log.END
+	return [client_fqdn for client_fqdn, result in results if result == "failed"]
+
+def get_ipa_hostgroups(hostgroups):
+	# Returns {hostgroup: {"hostgroup": found, "automember_rule": found}}. The ipa command
+	# can only look up hostgroups, their automember rules are created together with them.
+	if IPA_API:
+		try:
+			return IPA_API.find_hostgroups(hostgroups)
+		except (IPAError, httplib.HTTPException, socket.error, ValueError) as e:
+			print log.ERROR + "ERROR: could not search IPA hostgroups: " + str(e) + log.END
+			sys.exit(1)
+	found = {}
+	for hostgroup in hostgroups:
+		hostgroup_found = get_ipa_hostgroup(hostgroup) == 0
+		found[hostgroup] = {"hostgroup": hostgroup_found, "automember_rule": hostgroup_found}
+	return found
+
+def apply_parent_hostgroup(parenthg,initial_hostgroup):
+	return ensure_parent_hostgroup(parenthg,initial_hostgroup)
+
+def apply_child_hostgroup(childhg,parenthg,initial_hostgroup,puppetenv,lifecycle,activation_key):
+	return ensure_child_hostgroup(childhg,parenthg,initial_hostgroup,puppetenv,lifecycle,activation_key)
+
+def apply_subnet(nic,domain):
+	create_subnet(nic["network"],nic["mask"],nic["gateway"],domain)
+	return get_subnet_id(nic["network"])
+
+def apply_ipa_hostgroup(hostgroup,create_hostgroup):
+	if IPA_API:
+		return ensure_ipa_hostgroup(hostgroup)
+	if create_hostgroup:
+		create_ipa_hostgroup(hostgroup)
+	create_ipa_automember_rule(hostgroup)
+	create_ipa_automember_rule_condition(hostgroup)
+	return True
+
+def apply_partitioning_table(ptable,layout):
+	upload_partitioning_table(ptable,layout)
+	assign_os_to_partitioning_table(ptable)
+	return ptable
+
+def build_plan(hosts,read_only=True):
+	# Diffs the desired state of all hosts against one snapshot of Satellite and IPA. Every
+	# Satellite list is read once, the hosts are looked up in the host index (one search, or
+	# one host list for a manifest, with --no-cache) and all IPA hostgroups with one batch request (one ipa call each without --ipa-api).
+	# Everything that already exists is stored as resolved prerequisite, so provisioning
+	# does not verify it again. Returns (actions, present, errors); actions are dicts with
+	# the prerequisite key, a description and the function that creates the object.
+	# A read_only plan never fetches a keytab or requests a Kerberos ticket: without a valid
+	# ticket (or an IPA password for --ipa-api) the IPA hostgroups are not looked up.
+	set_phase("verification")
+	actions = []
+	planned = set()
+	present = set()
+	errors = []
+
+	def exists(key, value):
+		if key[0] != "host":
+			with PREREQUISITES_LOCK:
+				PREREQUISITES[key] = value
+		present.add(key)
+
+	def plan(key, description, requires, function, *args):
+		if key not in planned:
+			planned.add(key)
+			actions.append({"key": key, "description": description, "requires": requires, "function": function, "args": args})
+
+	if verify_organization(ORGANIZATION):
+		exists(("organization", ORGANIZATION), True)
+	else:
+		errors.append("organization " + ORGANIZATION + " not found on Satellite")
+	environments = get_inventory_index("environment","name")
+	hostgroups = get_hostgroup_tree()
+	subnets = get_inventory_index("subnet","network")
+	subnet_index = get_subnet_index()
+	ptables = {}
+	if [host for host in hosts if host["ptable"]]:
+		ptables = get_inventory_index("partition-table","name")
+	if len(hosts) == 1 or get_host_index():
+		host_names = set([host["client_fqdn"] for host in hosts if verify_hostname(host["client_fqdn"])])
+	else:
+		host_names = get_inventory_index("host","name")
+
+	set_phase("ipa")
+	if not read_only:
+		ipa_login()
+		exists(("kerberos", PRINCIPAL), True)
+	if read_only and not (IPA_API and IPA_API.password) and not (get_kerberos_ticket_expiry() or 0) > time.time():
+		print log.WARN + "WARNING: no valid Kerberos ticket for " + PRINCIPAL + ", IPA hostgroups are not checked." + log.END
+		ipa_hostgroups = {}
+	else:
+		ipa_hostgroups = get_ipa_hostgroups(sorted(set([host["ipa_hostgroup"] for host in hosts])))
+	set_phase("verification")
+
+	for host in hosts:
+		if verify_location(host["location"]):
+			exists(("location", host["location"]), True)
+		else:
+			errors.append(host["client_fqdn"] + ": location " + host["location"] + " not found on Satellite")
+		if verify_lifecycle(host["environment"]):
+			exists(("lifecycle", host["environment"]), True)
+		else:
+			errors.append(host["client_fqdn"] + ": lifecycle environment " + host["environment"] + " not found on Satellite")
+		puppet_env = environments.get(get_puppet_environment_name(DEFAULT_CONTENT_VIEW, host["environment"]))
+		puppet_env_id = None
+		if puppet_env:
+			puppet_env_id = puppet_env["id"]
+			exists(("puppet_env", host["environment"]), puppet_env_id)
+		else:
+			errors.append(host["client_fqdn"] + ": Puppet environment " + get_puppet_environment_name(DEFAULT_CONTENT_VIEW, host["environment"]) + " not found on Satellite")
+
+		parent_row, child_row = hostgroups.find_path([host["initial_parent_hostgroup"], host["parent_hostgroup"], host["hostgroup"]])[1:]
+		if parent_row is not None:
+			exists(("parent_hostgroup", host["parent_hostgroup"]), True)
+		else:
+			plan(("parent_hostgroup", host["parent_hostgroup"]), "parent hostgroup " + host["parent_hostgroup"] + " (parent " + host["initial_parent_hostgroup"] + ")", [], apply_parent_hostgroup, host["parent_hostgroup"], host["initial_parent_hostgroup"])
+		if child_row is not None:
+			exists(("hostgroup", host["hostgroup"]), True)
+		else:
+			plan(("hostgroup", host["hostgroup"]), "hostgroup " + host["hostgroup"] + " (parent " + host["parent_hostgroup"] + ", lifecycle environment " + host["environment"] + ")", [("parent_hostgroup", host["parent_hostgroup"])], apply_child_hostgroup, host["hostgroup"], host["parent_hostgroup"], host["initial_parent_hostgroup"], puppet_env_id, host["environment"], host["activation_key"])
+
+		ipa_hostgroup = ipa_hostgroups.get(host["ipa_hostgroup"])
+		if ipa_hostgroup is None:
+			plan(("ipa_hostgroup", host["ipa_hostgroup"]), "IPA hostgroup " + host["ipa_hostgroup"] + " with automember rule, if missing (not checked)", [], ensure_ipa_hostgroup, host["ipa_hostgroup"])
+		elif ipa_hostgroup["hostgroup"] and ipa_hostgroup["automember_rule"]:
+			exists(("ipa_hostgroup", host["ipa_hostgroup"]), True)
+		elif ipa_hostgroup["hostgroup"]:
+			plan(("ipa_hostgroup", host["ipa_hostgroup"]), "IPA automember rule for hostgroup " + host["ipa_hostgroup"], [], apply_ipa_hostgroup, host["ipa_hostgroup"], False)
+		else:
+			plan(("ipa_hostgroup", host["ipa_hostgroup"]), "IPA hostgroup " + host["ipa_hostgroup"] + " with automember rule", [], apply_ipa_hostgroup, host["ipa_hostgroup"], True)
+
+		for nic in host["nics"]:
+			if not nic["network"]:
+				subnet = subnet_index.find(nic["ip"])
+				if subnet is None:
+					errors.append(host["client_fqdn"] + ": no Satellite subnet contains IP address " + nic["ip"] + " of " + nic["identifier"] + ", network and mask are needed to create it")
+					continue
+				nic["network"], nic["mask"] = subnet["network"], subnet["mask"]
+			if nic["network"] in subnets:
+				error = not nic["mask"] and get_nic_subnet_error(nic, subnets[nic["network"]])
+				if error:
+					errors.append(host["client_fqdn"] + ": " + error)
+					continue
+				exists(("subnet", nic["network"]), subnets[nic["network"]]["id"])
+			elif not (nic["mask"] and nic["gateway"]):
+				errors.append(host["client_fqdn"] + ": subnet " + nic["network"] + " not found on Satellite, mask and gateway of " + nic["identifier"] + " are needed to create it")
+			else:
+				plan(("subnet", nic["network"]), "subnet " + nic["network"] + "/" + nic["mask"] + " (gateway " + nic["gateway"] + ", domain " + host["domain"] + ")", [], apply_subnet, nic, host["domain"])
+
+		if host["ptable"]:
+			if host["ptable"] in ptables:
+				exists(("ptable", host["ptable"]), host["ptable"])
+			else:
+				plan(("ptable", host["ptable"]), "partition table " + host["ptable"] + " (" + host["partitioning"] + ")", [], apply_partitioning_table, host["ptable"], host["ptable_layout"])
+
+		host["present"] = host["client_fqdn"] in host_names
+		if host["present"]:
+			exists(("host", host["client_fqdn"]), True)
+		else:
+			errors.extend(find_host_conflicts(host))
+			plan(("host", host["client_fqdn"]), "host " + host["client_fqdn"] + " (hostgroup " + host["hostgroup"] + ", " + ", ".join([nic["identifier"] + " " + nic["ip"] for nic in host["nics"]]) + ")", [], None)
+	return actions, present, errors
+
+def print_plan(actions,present,errors):
+	print log.SUMM + "### Plan ###" + log.END
+	for action in actions:
+		print log.WARN + "  + " + action["description"] + log.END
+	for key in sorted(present):
+		if key[0] == "host":
+			print log.INFO + "  = host " + key[1] + " is already present on Satellite" + log.END
+	for error in errors:
+		print log.ERROR + "ERROR: " + error + log.END
+	print log.SUMM + "Plan: " + str(len(actions)) + " to create, " + str(len(present)) + " already present." + log.END
+
+def apply_plan(actions):
+	# Creates the planned prerequisites, every one as soon as the ones it needs exist, and
+	# stores them as resolved. Hosts are created afterwards by provision_host(s), which then
+	# finds all of its prerequisites resolved and only creates the host.
+	keys = [action["key"] for action in actions if action["function"]]
+	steps = []
+	for action in actions:
+		if action["function"]:
+			requires = tuple([" ".join(key) for key in action["requires"] if key in keys])
+			steps.append((" ".join(action["key"]), requires, apply_action, (action,)))
+	try:
+		run_steps(steps)
+	except SystemExit:	# hosts depending on a failed change verify and create it again and fail on their own
+		print log.WARN + "WARNING: not all planned changes could be applied." + log.END
+
+def apply_action(action):
+	value = action["function"](*action["args"])
+	with PREREQUISITES_LOCK:
+		PREREQUISITES[action["key"]] = value
+	return value
+
+################################## GARBAGE COLLECTION ##################################
+
+LEGACY_PTABLE_SUFFIX = "_ptable"		# older versions uploaded one partition table per host: <HOSTNAME>_ptable
+
+def get_live_hostnames():
+	# Short names of all hosts on Satellite. Always a fresh host list, never the inventory
+	# cache or the host index: whatever is missing here is removed.
+	hostnames = set([row.get("name", "").split(".")[0] for row in iter_hosts()])
+	hostnames.discard("")
+	return hostnames
+
+def find_orphan_ptables(hostnames):
+	orphans = []
+	for row in parse_inventory(fetch_inventory("partition-table")):
+		name = row.get("name", "")
+		hostname = name[:-len(LEGACY_PTABLE_SUFFIX)]
+		if name.endswith(LEGACY_PTABLE_SUFFIX) and hostname and hostname not in hostnames:
+			orphans.append({"kind": "partition table", "name": name, "size": 0, "reason": "host " + hostname + " is gone"})
+	return orphans
+
+HOSTNAME_CHARACTERS = set(string.ascii_letters + string.digits + "-")
+
+def is_short_hostname(name):
+	return 0 < len(name) <= 63 and set(name) <= HOSTNAME_CHARACTERS and not name.startswith("-") and not name.endswith("-")
+
+def is_host_iso_checksum(path, iso_name):
+	# True if path is the <iso>.sha256 file write_host_iso() wrote for iso_name
+	try:
+		with open(path) as checksum_file:
+			checksum, name = (checksum_file.read(200).split("  ", 1) + [""])[:2]
+	except IOError:
+		return False
+	return len(checksum) == 64 and not checksum.strip(string.hexdigits) and name == iso_name + "\n"
+
+def find_orphan_isos(hostnames):
+	# <HOSTNAME>.iso and <HOSTNAME>.iso.sha256 of hosts that are gone, and the hidden
+	# .<HOSTNAME>.iso.XXXXXX.part files write_host_iso() leaves behind when it is interrupted.
+	# The share may hold other files (e.g. installation media), so only ISOs with a short
+	# hostname as name and the checksum file of write_host_iso() are taken.
+	iso_dir, prefix = os.path.split(NFS_HOST_ISO_STORE)
+	now = time.time()
+	orphans = []
+	for file_name in sorted(os.listdir(iso_dir or ".")):
+		path = os.path.join(iso_dir, file_name)
+		if os.path.islink(path) or not os.path.isfile(path):
+			continue
+		reason = None
+		if file_name.startswith("." + prefix) and file_name.endswith(".part"):
+			hostname = file_name[1 + len(prefix):].split(".iso.")[0]
+			if is_short_hostname(hostname) and now - os.path.getmtime(path) >= GC_PART_AGE:
+				reason = "interrupted download"
+		elif file_name.startswith(prefix):
+			for suffix in (".iso", ".iso.sha256"):
+				hostname = file_name[len(prefix):-len(suffix)]
+				iso_name = prefix + hostname + ".iso"
+				if file_name.endswith(suffix) and is_short_hostname(hostname) and hostname not in hostnames and is_host_iso_checksum(os.path.join(iso_dir, iso_name + ".sha256"), iso_name):
+					reason = "host " + hostname + " is gone"
+		if reason:
+			orphans.append({"kind": "file", "name": path, "size": os.path.getsize(path), "reason": reason})
+	return orphans
+
+def delete_ptable(ptable):
+	cmd_delete_ptable = hammer_cmd + " partition-table delete --name " + ptable
+	if SATELLITE_API:
+		SATELLITE_API.delete_ptable(ptable)
+		return
+	exit_code, output = run_hammer(cmd_delete_ptable)
+	if exit_code not in (0, 128):		# 128: already gone
+		raise HammerError(cmd_delete_ptable, exit_code)
+
+def remove_orphan(orphan):
+	if orphan["kind"] == "partition table":
+		set_phase("ptable")
+		delete_ptable(orphan["name"])
+		return
+	set_phase("iso")
+	try:
+		os.remove(orphan["name"])
+	except OSError as e:
+		if e.errno != errno.ENOENT:
+			raise
+
+def format_size(size):
+	if size < 1024:
+		return str(size) + " B"
+	size = size / 1024.0
+	for unit in ("KB", "MB", "GB"):
+		if size < 1024:
+			break
+		size = size / 1024
+	else:
+		unit = "TB"
+	return "%.1f %s" % (size, unit)
+
+def describe_orphans(orphans):
+	ptables = len([orphan for orphan in orphans if orphan["kind"] == "partition table"])
+	files = [orphan for orphan in orphans if orphan["kind"] == "file"]
+	return str(ptables) + " partition tables and " + str(len(files)) + " files (" + format_size(sum([orphan["size"] for orphan in files])) + ")"
+
+def collect_garbage(remove=False):
+	# Finds the partition tables and boot ISOs of hosts that no longer exist on Satellite and
+	# prints them. With remove=True they are deleted in batches of GC_BATCH_SIZE. Returns
+	# the objects that could not be removed.
+	set_phase("verification")
+	try:
+		hostnames = get_live_hostnames()
+		orphans = find_orphan_ptables(hostnames)
+	except:
+		print log.ERROR + "ERROR: could not list the hosts and partition tables on Satellite" + log.END
+		sys.exit(1)
+	if not hostnames:
+		print log.ERROR + "ERROR: Satellite returned no hosts, refusing to remove anything." + log.END
+		sys.exit(1)
+	if NFS_HOST_ISO_STORE:
+		try:
+			orphans = orphans + find_orphan_isos(hostnames)
+		except OSError as e:
+			print log.ERROR + "ERROR: could not read " + NFS_HOST_ISO_STORE + ": " + str(e) + log.END
+			sys.exit(1)
+	else:
+		print log.WARN + "WARNING: NFS_HOST_ISO_STORE is not set, boot ISOs are not checked." + log.END
+
+	print log.SUMM + "### Garbage collection ###" + log.END
+	for orphan in orphans:
+		size = orphan["kind"] == "file" and ", " + format_size(orphan["size"]) or ""
+		print log.WARN + "  - " + orphan["kind"] + " " + orphan["name"] + " (" + orphan["reason"] + size + ")" + log.END
+	print log.SUMM + str(len(hostnames)) + " hosts on Satellite, " + describe_orphans(orphans) + (remove and " to remove." or " would be removed, run with --apply to remove them.") + log.END
+	if not remove or not orphans:
+		return []
+
+	failed = []
+	for start in range(0, len(orphans), GC_BATCH_SIZE):
+		if start:
+			print log.INFO + "INFO: removed " + str(start) + " of " + str(len(orphans)) + ", next batch in " + str(GC_BATCH_PAUSE) + " seconds." + log.END
+			time.sleep(GC_BATCH_PAUSE)
+		for orphan in orphans[start:start + GC_BATCH_SIZE]:
+			try:
+				remove_orphan(orphan)
+			except Exception as e:
+				print log.ERROR + "ERROR: could not remove " + orphan["kind"] + " " + orphan["name"] + ": " + str(e) + log.END
+				failed.append(orphan)
+	if [orphan for orphan in orphans if orphan["kind"] == "partition table"]:
+		invalidate_inventory_cache("partition-table")
+	removed = [orphan for orphan in orphans if orphan not in failed]
+	print log.SUMM + "Removed " + describe_orphans(removed) + ", " + str(len(failed)) + " failed." + log.END
+	return failed
+
+################################## SERVICE MODE ##################################
+
+class ServiceJob(object):
+	# One provisioning request of --serve
+	def __init__(self, job_id, host):
+		self.id = job_id
+		self.host = host
+		self.state = "queued"
+		self.result = None
+		self.submitted = time.time()
+		self.started = None
+		self.finished = None
+
+	def update(self):
+		# A created host is done when it exists and its boot ISO is written
+		if self.result == "creating":
+			if not self.host["create_job"].done():
+				return
+			self.result = get_host_result(self.host["create_job"])
+		iso_job = self.host.get("iso_job")
+		if self.state == "running" and self.result is not None:
+			if self.result == "created" and iso_job and not iso_job.done():
+				return
+			if self.result == "created" and iso_job and iso_job.state == "failed":
+				self.result = "failed"
+			self.state = self.result == "failed" and "failed" or "done"
+			self.finished = time.time()
+
+	def to_dict(self):
+		self.update()
+		job = {"id": self.id, "client_fqdn": self.host["client_fqdn"], "run_id": self.host["run_id"], "state": self.state, "result": self.result, "submitted": self.submitted, "started": self.started, "finished": self.finished}
+		iso_job = self.host.get("iso_job")
+		if iso_job:
+			job["iso"] = {"path": iso_job.iso, "state": iso_job.state, "sha256": iso_job.checksum, "error": iso_job.error}
+		return job
+
+class ProvisioningService(object):
+	# Long running provisioning service (--serve). The process keeps its Satellite API
+	# connections or hammer shell, the Kerberos ticket, IPA session and inventory indexes
+	# warm and provisions hosts submitted over HTTP exactly like --create-host does.
+	# Requests wait in a bounded queue; when it is full new requests are refused with 503,
+	# so a burst from the orchestrator cannot pile up unbounded work.
+	def __init__(self, defaults, workers, queue_size, history=1000):
+		self.defaults = defaults
+		self.workers = workers
+		self.queue = Queue.Queue(queue_size)
+		self.history = history
+		self.jobs = {}
+		self.job_order = []
+		self.next_id = 1
+		self.lock = threading.Lock()
+		self.prerequisites_reset = time.time()
+
+	def submit(self, row):
+		# Returns (HTTP status, answer)
+		row = dict(row)
+		run_id = row.pop("run-id", row.pop("run_id", None))
+		try:
+			values = get_host_values(row, self.defaults)
+		except ValueError as e:
+			return 400, {"errors": [str(e)]}
+		host, errors = build_host(values)
+		if errors:
+			return 400, {"errors": errors}
+		host["run_id"] = run_id and str(run_id)
+		with self.lock:
+			for job_id in reversed(self.job_order):
+				job = self.jobs[job_id]
+				job.update()
+				if job.host["client_fqdn"] == host["client_fqdn"] and job.state in ("queued", "running"):
+					return 409, {"errors": ["host " + host["client_fqdn"] + " is already being provisioned"], "job": job.to_dict()}
+			job = ServiceJob(str(self.next_id), host)
+			try:
+				self.queue.put_nowait(job)
+			except Queue.Full:
+				return 503, {"errors": ["request queue is full, try again later"]}
+			self.next_id = self.next_id + 1
+			self.jobs[job.id] = job
+			self.job_order.append(job.id)
+			self.forget_jobs()
+		return 202, job.to_dict()
+
+	def forget_jobs(self):
+		# Keeps at most "history" jobs, finished ones are dropped first
+		while len(self.job_order) > self.history:
+			for job_id in self.job_order:
+				self.jobs[job_id].update()
+			finished = [job_id for job_id in self.job_order if self.jobs[job_id].state in ("done", "failed")]
+			if not finished:
+				return
+			self.job_order.remove(finished[0])
+			del self.jobs[finished[0]]
+
+	def get_job(self, job_id):
+		with self.lock:
+			job = self.jobs.get(job_id)
+			return job and job.to_dict()
+
+	def list_jobs(self):
+		with self.lock:
+			return [self.jobs[job_id].to_dict() for job_id in self.job_order]
+
+	def status(self):
+		with self.lock:
+			states = {}
+			for job_id in self.job_order:
+				state = self.jobs[job_id].to_dict()["state"]
+				states[state] = states.get(state, 0) + 1
+		return {"queue": self.queue.qsize(), "queue_size": self.queue.maxsize, "workers": self.workers, "jobs": states}
+
+	def worker(self):
+		while True:
+			job = self.queue.get()
+			# Prerequisites are remembered for SERVICE_PREREQUISITE_TTL seconds only, so objects
+			# removed on Satellite or IPA and the Kerberos ticket are checked again.
+			with PREREQUISITES_LOCK:
+				if time.time() - self.prerequisites_reset > SERVICE_PREREQUISITE_TTL:
+					PREREQUISITES.clear()
+					self.prerequisites_reset = time.time()
+			ISO_QUEUE.forget_finished()
+			get_host_create_queue().forget_finished()
+			job.state = "running"
+			job.started = time.time()
+			print log.HEADER + "### " + job.host["client_fqdn"] + " (job " + job.id + ") ###" + log.END
+			try:
+				result = provision_host(job.host)
+			except SystemExit:	# the helpers exit on errors, keep serving
+				result = "failed"
+			except Exception:
+				print log.ERROR + "ERROR: unexpected error while provisioning " + job.host["client_fqdn"] + ":\n" + traceback.format_exc() + log.END
+				result = "failed"
+			if isinstance(result, HostCreateJob):	# the worker goes on, update() waits for the host
+				result = "creating"
+			with self.lock:
+				job.result = result
+				job.update()
+
+	def serve(self, listen):
+		for i in range(self.workers):
+			thread = threading.Thread(target=self.worker, name="service-" + str(i))
+			thread.daemon = True
+			thread.start()
+		if listen.startswith("/"):
+			if os.path.exists(listen):
+				os.remove(listen)
+			server = ThreadingUnixHTTPServer(listen, ServiceRequestHandler)
+			os.chmod(listen, 0660)
+		else:
+			address, port = listen.rsplit(":", 1)
+			server = ThreadingHTTPServer((address or "127.0.0.1", int(port)), ServiceRequestHandler)
+		server.service = self
+		signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))	# stop like Ctrl-C, e.g. under systemd
+		print log.INFO + "INFO: provisioning service listening on " + listen + "." + log.END
+		try:
+			server.serve_forever()
+		finally:
+			server.server_close()
+			if listen.startswith("/") and os.path.exists(listen):
+				os.remove(listen)
+
+class ServiceRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	# POST /hosts            provision a host, the body is a JSON object with the manifest fields
+	#                        and optionally "run-id" (see --run-id)
+	# GET  /jobs             all known jobs
+	# GET  /jobs/<id>        one job
+	# GET  /status           queue and job counters
+	protocol_version = "HTTP/1.1"
+
+	def reply(self, status, answer, headers=None):
+		body = json.dumps(answer) + "\n"
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		for name, value in (headers or {}).items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self):
+		path = self.path.split("?")[0].rstrip("/")
+		service = self.server.service
+		if path == "/status":
+			return self.reply(200, service.status())
+		if path == "/jobs":
+			return self.reply(200, service.list_jobs())
+		if path.startswith("/jobs/"):
+			job = service.get_job(path[len("/jobs/"):])
+			if job:
+				return self.reply(200, job)
+		return self.reply(404, {"errors": ["not found"]})
+
+	def do_POST(self):
+		path = self.path.split("?")[0].rstrip("/")
+		if path != "/hosts":
+			return self.reply(404, {"errors": ["not found"]})
+		try:
+			row = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+		except ValueError as e:
+			return self.reply(400, {"errors": ["invalid JSON: " + str(e)]})
+		if not isinstance(row, dict):
+			return self.reply(400, {"errors": ["expected a JSON object with the host fields"]})
+		status, answer = self.server.service.submit(row)
+		headers = {}
+		if status == 202:
+			headers["Location"] = "/jobs/" + answer["id"]
+		elif status == 503:
+			headers["Retry-After"] = "10"
+		return self.reply(status, answer, headers)
+
+	def address_string(self):
+		return self.client_address and str(self.client_address[0]) or "local"
+
+	def log_message(self, format, *args):
+		if VERBOSE:
+			print "%s - %s" % (self.address_string(), format % args)
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+class ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	daemon_threads = True
+
+################################## VARIABLES ##################################
+
+ORGANIZATION  = ""                                                                                  # Change this variable according to your needs
+REALM = ""                                                                                          # Change this variable to your IPA Realm
+ARCHITECTURE = "x86_64"
+MEDIUM= ""                                                                                          # Change this variable to your default installation medium
+OS = ""                                                                                             # Change this variable to your default operating system name in Satellite
+DEFAULT_CONTENT_VIEW = ""                                                                           # Change this variable to your Satellite default (composite) content view
+PRINCIPAL = ""                                                                                      # Change this variable to your IPA automation service user name
+KDC = ""                                                                                            # Change this variable to one of your IPA servers
+KEYTAB = "/home/svc-satellite-automation/"+PRINCIPAL+".keytab"					# Change this variable to the path to your principals Kerberos keytab file
+IPA_CONFIG = "/etc/ipa/default.conf"									# IPA client configuration, used with --ipa-api to find the IPA server
+IPA_CA_FILE = "/etc/ipa/ca.crt"										# IPA CA certificate, used with --ipa-api
+IPA_PASSWORD = ""											# Only needed for --ipa-api if python-kerberos is not installed: password of PRINCIPAL
+PTABLE_NAME_PREFIX = "ptable-"										# Change this variable to the name prefix of partition tables created by this script
+TMP_DIR = "/home/svc-satellite-automation/tmp"								# Change this variable to a local directory writable by the service user
+KRB5_CCACHE = os.path.join(TMP_DIR, "krb5cc_"+PRINCIPAL)						# Change this variable to the credential cache used for the IPA automation service user
+KRB5_CCACHE_LOCK = os.path.join(TMP_DIR, "krb5cc_"+PRINCIPAL+".lock")
+KERBEROS_RENEW_BEFORE = 600										# Renew the Kerberos ticket if it expires within this many seconds
+JOURNAL_FILE = "/home/svc-satellite-automation/tmp/journal.sqlite"				# Change this variable to the step journal used with --run-id
+JOURNAL_RETENTION = 86400										# Forget journaled runs after this many seconds
+SERVICE_PREREQUISITE_TTL = 300										# With --serve, verify hostgroups, subnets, IPA hostgroups, ... again after this many seconds
+NFS_HOST_ISO_STORE = ""                                                                             # Change this variable to your NFS mount where you want to store host iso images
+DNS_PRIMARY = ""                                                                                    # Change this variable to your primary DNS server
+DEFAULT_ACTIVATION_KEYS = {
+	"dev":	"",                                                                                 # Change this variable to your Satellite default activation key for environment "dev" 
+	"test":	"",                                                                                 # Change this variable to your Satellite default activation key for environment "test" 
+	"preprod":	"",                                                                         # Change this variable to your Satellite default activation key for environment "preprod" 
+	"prod":	"",                                                                                 # Change this variable to your Satellite default activation key for environment "prod" 
+}
+INTRANET_PUPPET_PROXY = ""                                                                          # Change this variable to your Satellite or Capsule server
+INTRANET_PUPPET_CA_PROXY = ""                                                                       # Change this variable to your Satellite or Capsule server
+DMZ_PUPPET_PROXY = ""                                                                               # Change this variable to your Satellite or Capsule server
+DMZ_PUPPET_CA_PROXY = ""                                                                            # Change this variable to your Satellite or Capsule server
+
+def get_site_config_errors():
+	errors = []
+	for name in ("ORGANIZATION", "OS", "DEFAULT_CONTENT_VIEW", "PRINCIPAL"):
+		if not globals()[name]:
+			errors.append(name + " is not set. Please change this variable in " + os.path.basename(__file__) + ".")
+	return errors
+
+# Set from the command line options by main()
+SAT6_FQDN = None
+VERBOSE = False
+CREATE_HOST = False
+UPDATE_HOST = False
+WORKERS = 1
+
+################################## OPTIONS PARSER ##################################
+
+def get_option_parser():
+	parser = OptionParser()
+	parser.add_option("--satellite-server", dest="sat6_fqdn", help="FQDN of Satellite - omit https://", metavar="SAT6_FQDN")
+	parser.add_option("--client-fqdn", dest="client_fqdn", help="FQDN of the client you want to deploy", metavar="CLIENT_FQDN")
+	parser.add_option("--location", dest="location", help="Label of the Location in Satellite that the host is to be associated with", metavar="LOCATION")
+	parser.add_option("--application-id", dest="application_id", help="Application ID as basis for the hostgroup the client should be assigned to", metavar="APPLICATION_ID")
+	parser.add_option("--environment", dest="environment", help="Environment should be one of dev/test/preprod/prod", metavar="ENVIRONMENT")
+	parser.add_option("--partitioning", dest="partitioning", help="Customized partitioning table", metavar="PARTITIONING")
+	parser.add_option("--primary-nic-ip", dest="primary_nic_ip", help="IP address of the primary/public network interface", metavar="PRIMARY_NIC_IP")
+	parser.add_option("--primary-nic-mask", dest="primary_nic_mask", help="Subnet mask of primary/public network interface (dotted or prefix length). If omitted together with the network, both are taken from the Satellite subnet that contains the IP", metavar="PRIMARY_NIC_MASK")
+	parser.add_option("--primary-nic-gateway", dest="primary_nic_gateway", help="Gateway of primary/public network interface", metavar="PRIMARY_NIC_GATEWAY")
+	parser.add_option("--primary-nic-mac", dest="primary_nic_mac", help="MAC address of the primary/public network interface", metavar="PRIMARY_NIC_MAC")
+	parser.add_option("--primary-nic-network", dest="primary_nic_network", help="Network of the primary/public network interface. Derived from IP and mask if omitted", metavar="PRIMARY_NIC_NETWORK")
+	parser.add_option("--secondary-nic-ip", dest="secondary_nic_ip", help="IP address of the inguest storage network interface", metavar="SECONDARY_NIC_IP")
+	parser.add_option("--secondary-nic-mask", dest="secondary_nic_mask", help="Subnet mask of the inguest storage network interface (dotted or prefix length). If omitted together with the network, both are taken from the Satellite subnet that contains the IP", metavar="SECONDARY_NIC_MASK")
+	parser.add_option("--secondary-nic-gateway", dest="secondary_nic_gateway", help="Gateway of the inguest storage network interface", metavar="SECONDARY_NIC_GATEWAY")
+	parser.add_option("--secondary-nic-mac", dest="secondary_nic_mac", help="MAC address of the inguest storage network interface", metavar="SECONDARY_NIC_MAC")
+	parser.add_option("--secondary-nic-network", dest="secondary_nic_network", help="Network of the inguest storage network interface. Derived from IP and mask if omitted", metavar="SECONDARY_NIC_NETWORK")
+	parser.add_option("--third-nic-ip", dest="third_nic_ip", help="IP address of the database replication network interface", metavar="THIRD_NIC_IP")
+	parser.add_option("--third-nic-mask", dest="third_nic_mask", help="Subnet mask of the database replication network interface (dotted or prefix length). If omitted together with the network, both are taken from the Satellite subnet that contains the IP", metavar="THIRD_NIC_MASK")
+	parser.add_option("--third-nic-gateway", dest="third_nic_gateway", help="Gateway of the database replication network interface", metavar="THIRD_NIC_GATEWAY")
+	parser.add_option("--third-nic-mac", dest="third_nic_mac", help="MAC address of the database replication network interface", metavar="THIRD_NIC_MAC")
+	parser.add_option("--third-nic-network", dest="third_nic_network", help="Network address of the database replication network interface. Derived from IP and mask if omitted", metavar="THIRD_NIC_NETWORK")
+	parser.add_option("--trange", dest="trange", help="Trange where you want to add your host [tr01 / tr02 / tr03] ", metavar="TRANGE")
+	parser.add_option("--create-host", dest="create_host", action="store_true", help="Create new host")
+	parser.add_option("--update-host", dest="update_host", action="store_true", help="Update existing host")
+	parser.add_option("--intranet", dest="intranet", action="store_true", help="Host should be placed in INTRANET")
+	parser.add_option("--dmz", dest="dmz", action="store_true", help="Host should be placed in DMZ")
+	parser.add_option("--application", dest="application", action="store_true", help="True if you want to install an application on the host")
+	parser.add_option("--infrastructure", dest="infrastructure", action="store_true", help="True if you want to install an infrastructure service on the host")
+	parser.add_option("--cache-ttl", dest="cache_ttl", help="Override inventory cache TTLs in seconds, e.g. host=60,subnet=7200 (0 disables caching for a resource)", metavar="CACHE_TTL")
+	parser.add_option("--no-cache", dest="no_cache", action="store_true", help="Do not use the local inventory cache, always query Satellite")
+	parser.add_option("--api", dest="api", action="store_true", help="Talk to the Satellite REST API directly instead of running hammer (credentials are read from ~/.hammer/cli_config.yml)")
+	parser.add_option("--manifest", dest="manifest", help="CSV or JSON file with many hosts to provision in one run. Columns are the long option names, e.g. client-fqdn,primary-nic-ip,... Options given on the command line are used as defaults for every host", metavar="MANIFEST")
+	parser.add_option("--hammer-shell", dest="hammer_shell", action="store_true", help="Send all hammer commands through one persistent 'hammer shell' instead of starting hammer for every call")
+	parser.add_option("--ipa-api", dest="ipa_api", action="store_true", help="Talk to the IPA JSON-RPC API directly instead of running the ipa command (the server is read from /etc/ipa/default.conf)")
+	parser.add_option("--workers", dest="workers", type="int", default=1, help="Number of hosts of a manifest that are provisioned in parallel (default: 1)", metavar="WORKERS")
+	parser.add_option("--create-workers", dest="create_workers", type="int", default=8, help="Number of hosts that are created on Satellite in parallel in the background (default: 8)", metavar="CREATE_WORKERS")
+	parser.add_option("--iso-workers", dest="iso_workers", type="int", default=2, help="Number of boot ISOs that are rendered and written to the NFS store in parallel in the background (default: 2)", metavar="ISO_WORKERS")
+	parser.add_option("--metrics-log", dest="metrics_log", help="Append one JSON line per external call (hammer, ipa, Kerberos, API requests) with phase, duration, exit code and bytes read to this file", metavar="METRICS_LOG")
+	parser.add_option("--metrics-textfile", dest="metrics_textfile", help="Write Prometheus metrics of this run to this file (node_exporter textfile collector), overrides METRICS_TEXTFILE", metavar="METRICS_TEXTFILE")
+	parser.add_option("--plan", dest="plan", action="store_true", help="Read-only: take one snapshot of Satellite and IPA and print which hostgroups, subnets, IPA hostgroups and rules, partition tables and hosts would be created")
+	parser.add_option("--apply", dest="apply", action="store_true", help="Print the plan (see --plan) and create exactly the objects it lists. With --gc: remove the objects it lists")
+	parser.add_option("--run-id", dest="run_id", help="Record every step in the step journal under this id. Running the script again with the same id (e.g. the retry of an orchestrator workflow) skips the steps that are already done and completes interrupted ones", metavar="RUN_ID")
+	parser.add_option("--serve", dest="serve", help="Run as provisioning service: keep sessions, Kerberos ticket and inventory warm and accept hosts as JSON on POST /hosts (job status on GET /jobs/<id>). LISTEN is HOST:PORT or the path of a unix socket. Options given on the command line are used as defaults for every host", metavar="LISTEN")
+	parser.add_option("--queue-size", dest="queue_size", type="int", default=100, help="Number of requests --serve accepts before it answers 503 (default: 100)", metavar="QUEUE_SIZE")
+	parser.add_option("--bulk-search", dest="bulk_search", help="With --update-host: apply --set-hostgroup and --set-parameter to all hosts matching this Satellite search, e.g. 'hostgroup_title ~ hg-app%'. Hosts that already match are skipped", metavar="SEARCH")
+	parser.add_option("--set-hostgroup", dest="set_hostgroup", help="Hostgroup the hosts of --bulk-search are moved to", metavar="HOSTGROUP")
+	parser.add_option("--set-parameter", dest="set_parameter", action="append", default=[], help="Host parameter set on the hosts of --bulk-search, can be given more than once", metavar="NAME=VALUE")
+	parser.add_option("--gc", dest="gc", action="store_true", help="Read-only unless --apply is given: list the partition tables (<HOSTNAME>_ptable) and boot ISOs in NFS_HOST_ISO_STORE of hosts that no longer exist on Satellite, with the number of objects and bytes that would be freed")
+	parser.add_option("-v", "--verbose", dest="verbose", action="store_true", help="Verbose output")
+	return parser
 
 ################################## MAIN ##################################
 
-##### Verifiying some needed parameters
-## Verify organization
-if not verify_organization(ORGANIZATION):
-	print log.ERROR + "ERROR: Please verify that your organization is configured properly on Satellite." + log.END
-	sys.exit(1)
+def main(argv=None):
+	global METRICS_TEXTFILE, METRICS_LOG, INVENTORY_CACHE_ENABLED, SAT6_FQDN, VERBOSE, CREATE_HOST, UPDATE_HOST, WORKERS, ISO_QUEUE, HOST_CREATE_QUEUE, SATELLITE_API, HAMMER_SHELL, IPA_API, JOURNAL, CALLS_LIMIT
 
-## Verify location
-if not verify_location(LOCATION):
-	print log.ERROR + "ERROR: Please verify that your location is configured properly on Satellite." + log.END
-	sys.exit(1)
+	parser = get_option_parser()
+	(options, args) = parser.parse_args(argv)
 
-## Verify lifecycle environment
-if not verify_lifecycle(ENVIRONMENT):
-	print log.ERROR + "ERROR: Please verify that the lifecycle environment " + ENVIRONMENT + " is configured properly on Satellite." + log.END
-        sys.exit(1)
+	if options.metrics_textfile:
+		METRICS_TEXTFILE = options.metrics_textfile
+	if options.metrics_log:
+		try:
+			METRICS_LOG = open(options.metrics_log, 'a')
+		except IOError as e:
+			print log.ERROR + "ERROR: could not open metrics log " + options.metrics_log + ": " + str(e) + log.END
+			sys.exit(1)
+	atexit.register(report_metrics)
+
+	if options.no_cache:
+		INVENTORY_CACHE_ENABLED = False
+	if options.cache_ttl:
+		for entry in str(options.cache_ttl).split(','):
+			try:
+				resource, ttl = entry.split('=')
+				INVENTORY_CACHE_TTL[resource.strip()] = int(ttl)
+			except ValueError:
+				print log.ERROR + "ERROR: invalid cache TTL " + entry + ". Use RESOURCE=SECONDS, e.g. host=60. See usage." + log.END
+				sys.exit(1)
+
+	if options.bulk_search and not (options.update_host and (options.set_hostgroup or options.set_parameter)):
+		print log.ERROR + "ERROR: --bulk-search needs --update-host and at least one of --set-hostgroup or --set-parameter. See usage." + log.END
+		sys.exit(1)
+	if (options.set_hostgroup or options.set_parameter) and not options.bulk_search:
+		print log.ERROR + "ERROR: --set-hostgroup and --set-parameter are only used with --bulk-search. See usage." + log.END
+		sys.exit(1)
+	if options.gc and (options.serve or options.bulk_search or options.client_fqdn or options.manifest or options.create_host or options.update_host or options.plan):
+		print log.ERROR + "ERROR: --gc can only be combined with --apply. See usage." + log.END
+		sys.exit(1)
+	bulk_parameters = []
+	for entry in options.set_parameter:
+		if '=' not in entry or not entry.split('=', 1)[0]:
+			print log.ERROR + "ERROR: invalid parameter " + entry + ". Use NAME=VALUE. See usage." + log.END
+			sys.exit(1)
+		bulk_parameters.append(tuple(entry.split('=', 1)))
+
+	if not options.serve and not options.bulk_search and not options.gc and not (( options.client_fqdn or options.manifest ) and ( options.create_host or options.update_host or options.plan or options.apply )):
+		print log.ERROR + "You must specify at least client fqdn (or a manifest) and if you want to create a new host (--create-host), update a host (--update-host) or only see what would be created (--plan). See usage:\n" + log.END
+		parser.print_help()
+		print "\nExample usage: ./satellite6-automation.py --client-fqdn client01.example.com --create-host"
+		print "               ./satellite6-automation.py --manifest hosts.csv --create-host"
+		print "               ./satellite6-automation.py --manifest hosts.csv --plan"
+		print "               ./satellite6-automation.py --serve 127.0.0.1:8080 --workers 4"
+		print "               ./satellite6-automation.py --update-host --bulk-search 'hostgroup_title ~ hg-app-dev%' --set-parameter role=web --workers 8"
+		print "               ./satellite6-automation.py --gc"
+		sys.exit(1)
+	SAT6_FQDN = options.sat6_fqdn
 
-## Verify if Satellite hostgroups are present
-if not verify_parent_hostgroup(PARENT_HOSTGROUP):
-	print log.ERROR + "ERROR: parent hostgroup " + PARENT_HOSTGROUP  + " not found. Create it now..." + log.END
-	create_parent_hostgroup(PARENT_HOSTGROUP,INITIAL_PARENT_HOSTGROUP)
-else:
-	print log.INFO + "INFO: parent hostgroup " + PARENT_HOSTGROUP + " found. Proceed..." + log.END
-if not verify_child_hostgroup(HOSTGROUP):
-	print log.ERROR + "ERROR: child hostgroup " + HOSTGROUP  + " not found. Create it now..." + log.END
-	create_child_hostgroup(HOSTGROUP,PARENT_HOSTGROUP,PUPPET_ENV_ID)
-	update_child_hostgroup(HOSTGROUP)
-else:
-	print log.INFO + "INFO: child hostgroup " + HOSTGROUP + " found. Proceed..." + log.END
-
-## Verify if IPA hostgroups are present
-# Destroy any existing Kerberos ticket first
-kerberos_destroy_ticket()
-
-if not os.path.exists(KEYTAB):
-	get_keytab(PRINCIPAL,KDC,KEYTAB)
-
-# Then get valid Kerberos ticket again
-if not get_kerberos_login_status():
-        print log.ERROR + "ERROR: No valid Kerberos ticket found." + log.END
-        print log.INFO + "INFO: try to connect to KDC via keytab file " + log.SUMM + KEYTAB + "." + log.END
-        ipa_connect_with_keytab(PRINCIPAL,KEYTAB)
-        if get_kerberos_login_status():
-                print log.INFO + "INFO: connection to IPA successfully established." + log.END
-else:
-        print log.INFO + "INFO: Valid Kerberos ticket found." + log.END
-
-# Now lets create needed IPA hostgroup
-if not get_ipa_hostgroup(IPA_HOSTGROUP) == 0:
-	print log.WARN + "WARNING: did not find hostgroup " + IPA_HOSTGROUP + " on IPA. Will create it now." + log.END
-	create_ipa_hostgroup(IPA_HOSTGROUP)
-	create_ipa_automember_rule(IPA_HOSTGROUP)
-	create_ipa_automember_rule_condition(IPA_HOSTGROUP)
-else:
-	print log.INFO + "INFO: hostgroup " + IPA_HOSTGROUP + " found in IPA." + log.END
-
-##### Now lets create a new host
-
-# Create custom host partition table
-if options.partitioning:
-	PARTITIONS = str(options.partitioning).split(';')
-	create_partitioning_table_header()
-
-	for entry in PARTITIONS:
-		mount= entry.split(':')[0]
-		size = entry.split(':')[1] 
-		create_partitioning_table(mount,size)
-
-	create_partitioning_table_eof()
-
-	# Now upload the hosts partitioning table to Satellite
-	upload_partitioning_table()
-
-	# Assign the hosts partitioning table 
-	assign_os_to_partitioning_table()
-
-	# Afterwards we can delete the partitioning table locally
-	delete_partitioning_table()
-
-if not verify_hostname(CLIENT_FQDN):
-	if (options.client_fqdn and options.create_host):
-		create_new_host(HOSTNAME,ORGANIZATION,LOCATION,HOSTGROUP,PUPPET_ENV_ID)
-		get_host_iso()
-else:
-	print log.INFO + "INFO: host " + CLIENT_FQDN + " is already present on Satellite. Maybe you want to update the host? If yes, please run this script again with option --update-host instead of --create-host." + log.END
+	# Settings that have to be configured in this script before it can talk to Satellite and IPA
+	for error in get_site_config_errors():
+		print log.ERROR + "ERROR: " + error + log.END
+	if get_site_config_errors():
+		sys.exit(1)
+	use_kerberos_cache()
+
+	if options.verbose:
+		VERBOSE=True
+	else:
+		VERBOSE=False
+
+	if options.create_host or options.apply or options.serve:
+		CREATE_HOST=True
+	else:
+		CREATE_HOST=False
+
+	if options.update_host:
+		UPDATE_HOST=True
+	else:
+		UPDATE_HOST=False
+
+	if options.workers < 1:
+		print log.ERROR + "ERROR: --workers must be at least 1. See usage." + log.END
+		sys.exit(1)
+	WORKERS = options.workers
+
+	if options.create_workers < 1:
+		print log.ERROR + "ERROR: --create-workers must be at least 1. See usage." + log.END
+		sys.exit(1)
+	if options.iso_workers < 1:
+		print log.ERROR + "ERROR: --iso-workers must be at least 1. See usage." + log.END
+		sys.exit(1)
+
+	if options.queue_size < 1:
+		print log.ERROR + "ERROR: --queue-size must be at least 1. See usage." + log.END
+		sys.exit(1)
+
+	# Every host is described by the same fields as the command line options. Without a
+	# manifest the command line describes exactly one host.
+	if options.serve or options.bulk_search or options.gc:
+		host_values = []
+	elif options.manifest:
+		host_values = read_manifest(options.manifest, dict((field, getattr(options, field)) for field in MANIFEST_FIELDS))
+	else:
+		host_values = [dict((field, getattr(options, field)) for field in MANIFEST_FIELDS)]
+
+	hosts = []
+	for values in host_values:
+		host, errors = build_host(values)
+		if host:
+			host["run_id"] = options.run_id
+		for error in errors:
+			print log.ERROR + "ERROR: " + str(values.get("client_fqdn")) + ": " + error + ". See usage." + log.END
+		if errors:
+			sys.exit(1)
+		hosts.append(host)
+
+	# Nothing below runs before the options, the site configuration and all hosts are valid
+	ISO_QUEUE = IsoQueue(options.iso_workers)
+	HOST_CREATE_QUEUE = HostCreateQueue(options.create_workers)
+	if options.api:
+		SATELLITE_API = connect_satellite_api(options.sat6_fqdn)
+	elif options.hammer_shell:
+		HAMMER_SHELL = HammerShell(hammer_cmd)
+		atexit.register(HAMMER_SHELL.stop)
+
+	if options.ipa_api:
+		IPA_API = connect_ipa_api()
+		atexit.register(IPA_API.close)
+
+	if options.run_id or options.serve:
+		JOURNAL = open_journal(JOURNAL_FILE)
+		atexit.register(JOURNAL.close)
+
+	if VERBOSE:
+		print log.SUMM + "### Verbose output ###" + log.END
+		print "ORGANIZATION - %s" % ORGANIZATION
+		print "CREATE_HOST - %s" % CREATE_HOST
+		print "UPDATE_HOST - %s" % UPDATE_HOST
+		for host in hosts:
+			print "CLIENT FQDN - %s" % host["client_fqdn"]
+			print "  LOCATION - %s" % host["location"]
+			print "  APPLICATION_ID - %s" % host["application_id"]
+			print "  ENVIRONMENT - %s" % host["environment"]
+			print "  PARTITION TABLE - %s" % host["partitioning"]
+			print "  HOSTGROUP - %s" % host["hostgroup"]
+
+	if options.serve:
+		CALLS_LIMIT = 100000
+		service = ProvisioningService(dict((field, getattr(options, field)) for field in MANIFEST_FIELDS), WORKERS, options.queue_size)
+		try:
+			service.serve(options.serve)
+		except KeyboardInterrupt:
+			pass
+		except (socket.error, OSError, ValueError) as e:
+			print log.ERROR + "ERROR: could not listen on " + options.serve + ": " + str(e) + log.END
+			sys.exit(1)
+		sys.exit(0)
+
+	if options.bulk_search:
+		if print_results(bulk_update_hosts(options.bulk_search, options.set_hostgroup, bulk_parameters, WORKERS)):
+			sys.exit(1)
+		sys.exit(0)
+
+	if options.gc:
+		if collect_garbage(options.apply):
+			sys.exit(1)
+		sys.exit(0)
+
+	if options.plan or options.apply:
+		plan, present, plan_errors = build_plan(hosts, not options.apply)
+		print_plan(plan, present, plan_errors)
+		if plan_errors:
+			sys.exit(1)
+		if not options.apply:
+			sys.exit(0)
+		apply_plan(plan)
+
+	if len(hosts) == 1:
+		result = get_host_result(provision_host(hosts[0]))
+		if ISO_QUEUE.wait() or result == "failed":
+			sys.exit(1)
+	else:
+		results = provision_hosts(hosts, WORKERS)
+		failed_isos = [job.client_fqdn for job in ISO_QUEUE.wait()]
+		results = [(client_fqdn, "failed" if client_fqdn in failed_isos else result) for client_fqdn, result in results]
+		if print_results(results):
+			sys.exit(1)
 
+if __name__ == "__main__":
+	main()